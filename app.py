@@ -1,10 +1,27 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import (Flask, Response, request, abort, jsonify,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 
-from models import setup_db, Actor, Movie, Movie_Actor
-from auth import AuthError, requires_auth
+from models import (setup_db, db, Actor, Movie, Movie_Actor, bump_versions,
+                    format_movies, unit_of_work, MOVIE_FIELDS)
+from auth import (AuthError, requires_auth, check_permissions, jwks_store,
+                  token_cache)
+from pagination import page_args, wants_all, wants_stream
+from listing import actor_listing, movie_listing
+from relations import cast, filmography, relation_ids
+from bulk import (BULK_DELETE_MAX_ROWS, batch_size_arg, bulk_delete,
+                  bulk_insert, delete_selection, iter_records,
+                  validate_actor, validate_movie)
+from streaming import stream_json_list
+from cache import cached, conditional, response_cache
+from formatting import request_locale
+from metrics import init_metrics, pool_stats
+from search import search, search_args
+from stats import (count_links, read_stats, rebuild_stats, schedule_rebuild,
+                   stage_links, stage_rows)
+from transfer import TRANSFER_FORMATS, export_table, import_table
 
 
 def create_app(test_config=None):
@@ -12,6 +29,7 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    init_metrics(app)
 
     '''
     @ADD:
@@ -20,6 +38,7 @@ def create_app(test_config=None):
     '''
     # API Start
     @app.route('/', methods=['GET'])
+    @cached()
     def get_api():
         # Put Message
         message = "This is the Capstone API!!!"
@@ -36,18 +55,54 @@ def create_app(test_config=None):
     '''
     # get actors
     @app.route('/actors', methods=['GET'])
+    @cached('actors')
+    @conditional('actors')
     def get_actors():
-        actors_info = Actor.query.order_by(Actor.id).all()
-        actors = [actor.format() for actor in actors_info]
+        # whitelisted filters and sort, as bound parameters, selecting
+        # only the columns of the requested fields
+        try:
+            query = actor_listing.filter(Actor.query, request.args)
+            sort = actor_listing.sort(request.args)
+            fields = actor_listing.fieldset(request.args)
+            query = actor_listing.load(query, fields, sort)
+        except ValueError:
+            abort(400)
 
-        # if there is no actor added
-        if len(actors_info) == 0:
-            abort(404)
+        # unpaginated list written out in chunks, for tables of any size
+        if wants_stream(request.args):
+            actors = stream_json_list(
+                'actors', actor_listing.order(query, sort),
+                lambda chunk: [actor.format(fields) for actor in chunk])
+            return Response(stream_with_context(actors),
+                            mimetype='application/json')
+
+        # unpaginated list, only meant for small tables
+        if wants_all(request.args):
+            actors_info = actor_listing.order(query, sort).all()
+            actors = [actor.format(fields) for actor in actors_info]
+
+            # if there is no actor added
+            if len(actors_info) == 0:
+                abort(404)
 
-        # retrun array of actors details
+            # retrun array of actors details
+            return jsonify({
+                'success': True,
+                'actors': actors
+            })
+
+        try:
+            actors_info, next_cursor = actor_listing.paginate(
+                query, sort, request.args)
+        except ValueError:
+            abort(400)
+        actors = [actor.format(fields) for actor in actors_info]
+
+        # retrun one page of actors details
         return jsonify({
             'success': True,
-            'actors': actors
+            'actors': actors,
+            'next_cursor': next_cursor
         })
 
     '''
@@ -57,20 +112,199 @@ def create_app(test_config=None):
     '''
     # get movies
     @app.route('/movies', methods=['GET'])
+    @cached('movies', 'actors')
+    @conditional('movies', 'actors')
     def get_movies():
-        movies_info = Movie.query.order_by(Movie.id).all()
-        movies = [movie.format() for movie in movies_info]
+        # whitelisted filters and sort, as bound parameters, selecting
+        # only the columns of the requested fields
+        try:
+            query = movie_listing.filter(Movie.query, request.args)
+            sort = movie_listing.sort(request.args)
+            fields = movie_listing.fieldset(request.args)
+            query = movie_listing.load(query, fields, sort)
+        except ValueError:
+            abort(400)
+
+        # unpaginated list written out in chunks, for tables of any size
+        if wants_stream(request.args):
+            locale = request_locale()
+            movies = stream_json_list(
+                'movies', movie_listing.order(query, sort),
+                lambda chunk: format_movies(chunk, locale, fields))
+            return Response(stream_with_context(movies),
+                            mimetype='application/json')
+
+        # unpaginated list, only meant for small tables
+        if wants_all(request.args):
+            movies_info = movie_listing.order(query, sort).all()
+            movies = format_movies(movies_info, request_locale(), fields)
+
+            # if there is no movie added
+            if len(movies_info) == 0:
+                abort(404)
+
+            # retrun array of movies details
+            return jsonify({
+                'success': True,
+                'movies': movies
+            })
+
+        try:
+            movies_info, next_cursor = movie_listing.paginate(
+                query, sort, request.args)
+        except ValueError:
+            abort(400)
+        movies = format_movies(movies_info, request_locale(), fields)
+
+        # retrun one page of movies details
+        return jsonify({
+            'success': True,
+            'movies': movies,
+            'next_cursor': next_cursor
+        })
+
+    '''
+    @ADD:
+    Create an endpoint to handle GET requests
+    to search actors and movies by name.
+    '''
+    @app.route('/search', methods=['GET'])
+    @cached('actors', 'movies')
+    @conditional('actors', 'movies')
+    def search_catalog():
+        try:
+            q, prefix, types, limit, position = search_args(request.args)
+        except ValueError:
+            abort(400)
+
+        results, next_cursor = search(q, prefix, types, limit, position)
+
+        # retrun one page of matches, best first
+        return jsonify({
+            'success': True,
+            'results': results,
+            'next_cursor': next_cursor
+        })
+
+    '''
+    @ADD:
+    Create endpoints to handle GET requests
+    for the movies of an actor and the actors of a movie,
+    one at a time or for many ids at once.
+    '''
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @cached('movies', 'actors')
+    @conditional('movies', 'actors')
+    def get_actor_movies(actor_id):
+        try:
+            limit, last_id = page_args(request.args)
+        except ValueError:
+            abort(400)
 
-        # if there is no movie added
-        if len(movies_info) == 0:
+        page = filmography.page(actor_id, limit, last_id)
+        if page is None:
             abort(404)
+        movies_info, next_cursor = page
+
+        # retrun one page of the movies of the actor
+        return jsonify({
+            'success': True,
+            'actor_id': actor_id,
+            'movies': format_movies(movies_info, request_locale(),
+                                    MOVIE_FIELDS[:-1]),
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @cached('movies', 'actors')
+    @conditional('movies', 'actors')
+    def get_movie_actors(movie_id):
+        try:
+            limit, last_id = page_args(request.args)
+        except ValueError:
+            abort(400)
+
+        page = cast.page(movie_id, limit, last_id)
+        if page is None:
+            abort(404)
+        actors_info, next_cursor = page
+
+        # retrun one page of the actors of the movie
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+            'actors': [actor.format() for actor in actors_info],
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/actors/movies', methods=['GET'])
+    @cached('movies', 'actors')
+    @conditional('movies', 'actors')
+    def get_actors_movies():
+        try:
+            actor_ids, limit = relation_ids(request.args)
+        except ValueError:
+            abort(400)
+
+        # the first page of every actor from one query, the next pages
+        # come from /actors/<id>/movies with the cursor
+        locale = request_locale()
+        filmographies = [{
+            'actor_id': actor_id,
+            'movies': format_movies(movies_info, locale, MOVIE_FIELDS[:-1]),
+            'next_cursor': next_cursor
+        } for actor_id, (movies_info, next_cursor)
+            in filmography.pages(actor_ids, limit).items()]
 
-        # retrun array of movies details
         return jsonify({
             'success': True,
-            'movies': movies
+            'filmographies': filmographies
+        })
+
+    @app.route('/movies/actors', methods=['GET'])
+    @cached('movies', 'actors')
+    @conditional('movies', 'actors')
+    def get_movies_actors():
+        try:
+            movie_ids, limit = relation_ids(request.args)
+        except ValueError:
+            abort(400)
+
+        # the first page of every movie from one query, the next pages
+        # come from /movies/<id>/actors with the cursor
+        casts = [{
+            'movie_id': movie_id,
+            'actors': [actor.format() for actor in actors_info],
+            'next_cursor': next_cursor
+        } for movie_id, (actors_info, next_cursor)
+            in cast.pages(movie_ids, limit).items()]
+
+        return jsonify({
+            'success': True,
+            'casts': casts
         })
 
+    '''
+    @ADD:
+    Create an endpoint to handle GET requests
+    for the catalog statistics.
+    '''
+    @app.route('/stats', methods=['GET'])
+    @cached('actors', 'movies', 'stats')
+    @conditional('actors', 'movies', 'stats')
+    def get_stats():
+        # read from the counters kept by the write handlers, never from
+        # the actors and movies tables
+        stats, rebuilt_at = read_stats()
+        if rebuilt_at is None:
+            with unit_of_work():
+                rebuild_stats()
+            stats, rebuilt_at = read_stats()
+        else:
+            schedule_rebuild(app, rebuilt_at)
+
+        return jsonify(dict(success=True, **stats))
+
     '''
     @ADD:
     Create an endpoint to handle POST requests
@@ -86,11 +320,15 @@ def create_app(test_config=None):
             new_age = body.get("age", None)
             new_gender = body.get("gender", None)
             actor = Actor(name=new_name, age=new_age, gender=new_gender)
-            actor.insert()
+            # INSERT ... RETURNING sets the id of the new actor
+            with unit_of_work():
+                actor.insert()
+                stage_rows(Actor, [actor])
+                # last, the versions row stays locked until the commit
+                bump_versions('actors')
 
             # Get inserted new actor details
-            new_actor = Actor.query.order_by(Actor.id.desc()).limit(1).first()
-            new_actor = new_actor.format()
+            new_actor = actor.format()
 
             return jsonify({
                 'success': True,
@@ -113,11 +351,16 @@ def create_app(test_config=None):
             new_title = body.get("title", None)
             new_release_date = body.get("release_date", None)
             movie = Movie(title=new_title, release_date=new_release_date)
-            movie.insert()
+            # INSERT ... RETURNING sets the id of the new movie
+            with unit_of_work():
+                movie.insert()
+                stage_rows(Movie, [movie])
+                # last, the versions row stays locked until the commit
+                bump_versions('movies')
 
-            # Get inserted new movie details
-            new_movie = Movie.query.order_by(Movie.id.desc()).limit(1).first()
-            new_movie = new_movie.format()
+            # Get inserted new movie details, a new movie has no cast yet
+            new_movie = movie.format(selected_actors=[],
+                                     locale=request_locale())
 
             return jsonify({
                 'success': True,
@@ -126,6 +369,39 @@ def create_app(test_config=None):
         except BaseException:
             abort(422)
 
+    '''
+    @ADD:
+    Create endpoints to handle bulk POST requests
+    for actors and movies, as a JSON array or NDJSON.
+    '''
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def add_actors_bulk(actor):
+        try:
+            batch_size = batch_size_arg(request.args)
+            records = iter_records(request)
+        except ValueError:
+            abort(400)
+
+        # stream one result line per record
+        results = bulk_insert(Actor, validate_actor, records, batch_size)
+        return Response(stream_with_context(results),
+                        mimetype='application/x-ndjson')
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def add_movies_bulk(movie):
+        try:
+            batch_size = batch_size_arg(request.args)
+            records = iter_records(request)
+        except ValueError:
+            abort(400)
+
+        # stream one result line per record
+        results = bulk_insert(Movie, validate_movie, records, batch_size)
+        return Response(stream_with_context(results),
+                        mimetype='application/x-ndjson')
+
     '''
     @ADD:
     Create an endpoint to handle PATCH requests
@@ -141,19 +417,25 @@ def create_app(test_config=None):
             age = body.get("age", None)
 
             # Update Actor
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-
-            if actor is None:
-                abort(404)
-
-            if name:
-                actor.name = name
-            if gender:
-                actor.gender = gender
-            if age:
-                actor.age = age
-
-            actor.update()
+            with unit_of_work():
+                actor = Actor.query.filter(
+                    Actor.id == actor_id).one_or_none()
+
+                if actor is None:
+                    abort(404)
+
+                # move the actor out of its old statistics buckets
+                stage_rows(Actor, [actor], -1)
+                if name:
+                    actor.name = name
+                if gender:
+                    actor.gender = gender
+                if age:
+                    actor.age = age
+                stage_rows(Actor, [actor])
+
+                bump_versions('actors')
+                actor.update()
             updated_actor = actor.format()
 
             return jsonify({
@@ -178,32 +460,30 @@ def create_app(test_config=None):
             release_date = body.get("release_date", None)
             actor_ids = body.get("selected_actors", None)
 
-            # Update Movie
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-            if movie is None:
-                abort(404)
-
-            if title:
-                movie.title = title
-            if release_date:
-                movie.release_date = release_date
-
-            movie.update()
-            updated_movie = movie.format()
-
-            # Check actors are already assigned
-            movie_actors = Movie_Actor.query.filter(
-                Movie_Actor.movie_id == movie_id).all()
-            if movie_actors:
-                for movie_actor in movie_actors:
-                    movie_actor.delete()
-
-            # Set updated movie id and actor id in movie_actor table
-            if actor_ids:
-                for actor_id in actor_ids:
-                    movie_actor = Movie_Actor(
-                        movie_id=movie_id, actor_id=actor_id)
-                    movie_actor.insert()
+            # Update Movie, with its cast in the same commit
+            with unit_of_work():
+                movie = Movie.query.filter(
+                    Movie.id == movie_id).one_or_none()
+                if movie is None:
+                    abort(404)
+
+                stage_rows(Movie, [movie], -1)
+                if title:
+                    movie.title = title
+                if release_date:
+                    movie.release_date = release_date
+                stage_rows(Movie, [movie])
+
+                # Apply only the difference to the cast in movie_actor
+                # table, the cast is left alone when selected_actors is
+                # not sent
+                if actor_ids is not None:
+                    stage_links(movie.set_actors(
+                        int(actor_id) for actor_id in actor_ids))
+
+                bump_versions('movies')
+                movie.update()
+            updated_movie = movie.format(locale=request_locale())
 
             return jsonify({
                 'success': True,
@@ -223,12 +503,19 @@ def create_app(test_config=None):
     def delete_actor(actor, actor_id):
 
         try:
-            # Delete Actor
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-            if actor is None:
-                abort(404)
+            # Delete Actor with one statement, the database deletes
+            # the movie_actor rows of the actor, counted before for the
+            # statistics
+            with unit_of_work():
+                links = count_links(Actor, Actor.id == actor_id)
+                deleted = Actor.delete_by_id(actor_id)
+                if deleted is None:
+                    abort(404)
 
-            actor.delete()
+                stage_rows(Actor, [deleted], -1)
+                stage_links(-links)
+
+                bump_versions('actors')
 
             return jsonify({
                 'success': True,
@@ -248,12 +535,19 @@ def create_app(test_config=None):
     def delete_movie(movie, movie_id):
 
         try:
-            # Delete Movie
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-            if movie is None:
-                abort(404)
+            # Delete Movie with one statement, the database deletes
+            # the movie_actor rows of the movie, counted before for the
+            # statistics
+            with unit_of_work():
+                links = count_links(Movie, Movie.id == movie_id)
+                deleted = Movie.delete_by_id(movie_id)
+                if deleted is None:
+                    abort(404)
 
-            movie.delete()
+                stage_rows(Movie, [deleted], -1)
+                stage_links(-links)
+
+                bump_versions('movies')
 
             return jsonify({
                 'success': True,
@@ -263,6 +557,134 @@ def create_app(test_config=None):
         except BaseException:
             abort(400)
 
+    '''
+    @ADD:
+    Create endpoints to handle bulk DELETE requests
+    for actors and movies, by ids or by filter.
+    '''
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actors(actor):
+        try:
+            condition = delete_selection(
+                actor_listing, request.args, request.get_json(silent=True),
+                BULK_DELETE_MAX_ROWS)
+        except ValueError:
+            abort(400)
+
+        try:
+            # one DELETE ... RETURNING, rolled back as a whole when the
+            # selection is over the cap
+            with unit_of_work():
+                actor_ids = bulk_delete(Actor, condition,
+                                        BULK_DELETE_MAX_ROWS)
+                if len(actor_ids) > BULK_DELETE_MAX_ROWS:
+                    abort(422)
+
+                bump_versions('actors')
+        except BaseException:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'deleted': len(actor_ids),
+            'ids': actor_ids
+        })
+
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies(movie):
+        try:
+            condition = delete_selection(
+                movie_listing, request.args, request.get_json(silent=True),
+                BULK_DELETE_MAX_ROWS)
+        except ValueError:
+            abort(400)
+
+        try:
+            # one DELETE ... RETURNING, rolled back as a whole when the
+            # selection is over the cap
+            with unit_of_work():
+                movie_ids = bulk_delete(Movie, condition,
+                                        BULK_DELETE_MAX_ROWS)
+                if len(movie_ids) > BULK_DELETE_MAX_ROWS:
+                    abort(422)
+
+                bump_versions('movies')
+        except BaseException:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'deleted': len(movie_ids),
+            'ids': movie_ids
+        })
+
+    '''
+    @ADD:
+    Create endpoints to export and import a whole table
+    (actors, movies or movie_actor) as CSV or NDJSON.
+    '''
+    @app.route('/export/<any(actors, movies, movie_actor):table>',
+               methods=['GET'])
+    @requires_auth('get:actors')
+    def export_catalog(payload, table):
+        check_permissions('get:movies', payload)
+        fmt = request.args.get('format', 'csv')
+        if fmt not in TRANSFER_FORMATS:
+            abort(400)
+
+        # written out as the database produces it
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        response = Response(export_table(table, fmt), mimetype=mimetype)
+        response.headers['Content-Disposition'] = (
+            'attachment; filename=%s.%s' % (table, fmt))
+        return response
+
+    @app.route('/import/<any(actors, movies, movie_actor):table>',
+               methods=['POST'])
+    @requires_auth('post:movies')
+    def import_catalog(payload, table):
+        # an import creates rows as well as changing them
+        for permission in ('post:actors', 'patch:actors', 'patch:movies'):
+            check_permissions(permission, payload)
+        fmt = request.args.get('format', 'csv')
+        if fmt not in TRANSFER_FORMATS:
+            abort(400)
+
+        try:
+            # the body is read as a stream, never held in memory
+            with unit_of_work():
+                result = import_table(table, fmt, request.stream)
+                # the import may change any row, recount the statistics
+                rebuild_stats()
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'table': result['table'],
+            'rows': result['rows']
+        })
+
+    '''
+    @ADD:
+    Create an endpoint to handle GET requests
+    for internal cache, connection pool and replica statistics.
+    '''
+    @app.route('/internal/stats', methods=['GET'])
+    @requires_auth('get:internal-stats')
+    def get_internal_stats(payload):
+        return jsonify({
+            'success': True,
+            'response_cache': response_cache.stats(),
+            'token_cache': token_cache.stats(),
+            'jwks': jwks_store.stats(),
+            'pool': pool_stats(db.engine),
+            'replicas': (app.extensions['replicas'].stats()
+                         if app.extensions.get('replicas') else [])
+        })
+
     '''
     @ADD:
     Error Handling
@@ -1,14 +1,38 @@
 import os
 import json
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
 from flask import Flask, request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
+from jose.utils import base64url_decode
 from urllib.request import urlopen
 
+from metrics import observe_auth, observe_jwks_fetch
+
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+# JWKS location and refresh policy. JWKS_URL may point at a local file
+# (file:///path/jwks.json) or a stub server for tests and benchmarks.
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = float(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = float(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_TIMEOUT = float(os.environ.get('JWKS_TIMEOUT', 5))
+
+# Verified token cache, set TOKEN_CACHE_ENABLED=false to verify every call
+TOKEN_CACHE_ENABLED = os.environ.get(
+    'TOKEN_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -22,6 +46,224 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Key Store
+'''
+JWKSKeyStore
+    keeps the parsed signing keys of the JWKS endpoint indexed by kid
+
+    keys are loaded once, refreshed in the background when older than ttl
+    and refetched synchronously when a token names an unknown kid. Either
+    way the JWKS is fetched at most once every min_refresh_interval
+    seconds. When a refresh fails the previously loaded keys keep being
+    served.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url, ttl=3600, min_refresh_interval=30, timeout=5,
+                 algorithm='RS256'):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.algorithm = algorithm
+
+        self._keys = {}
+        self._loaded_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        if self._loaded_at is None:
+            if self._may_refetch(now):
+                self.refresh()
+        elif now - self._loaded_at >= self.ttl and self._may_refetch(now):
+            # a failed refresh leaves _loaded_at as it was, retry it at
+            # most once every min_refresh_interval too
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch(now):
+            # Unknown kid, the IdP may have rotated its signing keys
+            self.refresh()
+            key = self._keys.get(kid)
+
+        with self._lock:
+            if key is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return key
+
+    def refresh(self):
+        with self._fetch_lock:
+            self._last_attempt = time.monotonic()
+            start = time.perf_counter()
+            try:
+                keys = self._fetch()
+            except Exception:
+                observe_jwks_fetch('error', time.perf_counter() - start)
+                logger.exception('Unable to refresh JWKS from %s', self.url)
+                with self._lock:
+                    self.refresh_failures += 1
+                return False
+            observe_jwks_fetch('ok', time.perf_counter() - start)
+
+            with self._lock:
+                self._keys = keys
+                self._loaded_at = time.monotonic()
+                self.refreshes += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            age = None
+            if self._loaded_at is not None:
+                age = time.monotonic() - self._loaded_at
+            return {
+                'keys': len(self._keys),
+                'age': age,
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures
+            }
+
+    def _may_refetch(self, now):
+        return (self._last_attempt is None or
+                now - self._last_attempt >= self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(
+                    key, key.get('alg', self.algorithm))
+            except Exception:
+                logger.warning('Skipping unusable JWKS key %s',
+                               key.get('kid'))
+        return keys
+
+
+jwks_store = JWKSKeyStore(
+    JWKS_URL,
+    ttl=JWKS_TTL,
+    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+    timeout=JWKS_TIMEOUT)
+
+
+# Token Cache
+'''
+TokenCache
+    bounded LRU of verified tokens keyed by the sha256 of the token
+
+    each entry keeps the decoded payload and its permissions as a set until
+    the token's exp. Expired entries are dropped on lookup and purged before
+    the least recently used entry is evicted.
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=1024, enabled=True):
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token):
+        if not self.enabled:
+            return None
+
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, token, payload):
+        permissions = None
+        if 'permissions' in payload:
+            permissions = frozenset(payload['permissions'])
+
+        expires_at = payload.get('exp')
+        if not self.enabled or not isinstance(expires_at, (int, float)):
+            return payload, permissions
+
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        with self._lock:
+            self._entries[key] = (expires_at, payload, permissions)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._evict()
+        return payload, permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _evict(self):
+        now = time.time()
+        expired = [key for key, entry in self._entries.items()
+                   if entry[0] <= now]
+        for key in expired:
+            del self._entries[key]
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self.evictions += 1
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, enabled=TOKEN_CACHE_ENABLED)
+
+
 # Auth Header
 
 '''
@@ -75,18 +317,21 @@ def get_token_auth_header():
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in
          the payload permissions array
+    permissions can be passed as a precomputed set to skip the list scan
     return true otherwise
 '''
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -100,7 +345,7 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using the keys of jwks_store
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -109,35 +354,38 @@ def check_permissions(permission, payload):
 '''
 
 
+def verify_signature(token, key, algorithm):
+    # Verify with the already parsed key instead of letting jwt.decode
+    # rebuild it from the JWK on every call
+    if algorithm not in ALGORITHMS:
+        raise jwt.JWTError('The specified alg value is not allowed')
+
+    signing_input, _, crypto_segment = token.rpartition('.')
+    signature = base64url_decode(crypto_segment.encode('utf-8'))
+    if not key.verify(signing_input.encode('utf-8'), signature):
+        raise jwt.JWTError('Signature verification failed.')
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
 
     if rsa_key:
         try:
+            verify_signature(token, rsa_key, unverified_header.get('alg'))
             payload = jwt.decode(
                 token,
-                rsa_key,
+                '',
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
             return payload
         except jwt.ExpiredSignatureError:
@@ -162,13 +410,32 @@ def verify_decode_jwt(token):
     }, 401)
 
 
+'''
+decode_token(token)
+    returns the payload and permission set of a token, verifying it with
+    verify_decode_jwt only when it is not already in token_cache
+'''
+
+
+def decode_token(token):
+    start = time.perf_counter()
+    cached = token_cache.get(token)
+    if cached is not None:
+        observe_auth('cache', time.perf_counter() - start)
+        return cached
+    try:
+        return token_cache.put(token, verify_decode_jwt(token))
+    finally:
+        observe_auth('verify', time.perf_counter() - start)
+
+
 '''
 @ADD implement @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:actor')
 
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the decode_token method to decode the jwt
     it should use the check_permissions method validate claims
     and check the requested permission  return the decorator
     which passes the decoded payload to the decorated method
@@ -181,10 +448,10 @@ def requires_auth(permission=''):
         def wrapper(*args, **kwargs):
             # Get Auth header
             token = get_token_auth_header()
-            # Verify and decode jwt
-            payload = verify_decode_jwt(token)
+            # Verify and decode jwt, or reuse an already verified one
+            payload, permissions = decode_token(token)
             # check permission using payload
-            check_permissions(permission, payload)
+            check_permissions(permission, payload, permissions)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,46 @@
+'''
+Micro-benchmark of the requires_auth path with and without the verified
+token cache
+
+    python benchmarks/bench_auth.py [iterations]
+'''
+import sys
+
+import support
+
+private_pem = support.install_stub_jwks()
+
+from flask import Flask  # noqa: E402
+
+import auth  # noqa: E402
+
+
+def main(iterations=2000):
+    app = Flask(__name__)
+    token = support.sign_token(private_pem)
+
+    @auth.requires_auth('get:actors')
+    def endpoint(payload):
+        return payload
+
+    headers = {'Authorization': 'Bearer ' + token}
+    with app.test_request_context(headers=headers):
+        # load the JWKS once so both runs measure verification only
+        endpoint()
+
+        auth.token_cache.enabled = False
+        uncached = support.timed(endpoint, iterations)
+
+        auth.token_cache.enabled = True
+        auth.token_cache.clear()
+        cached = support.timed(endpoint, iterations)
+
+    print(f'iterations: {iterations}')
+    print(f'uncached:   {uncached * 1e6:10.1f} us/call')
+    print(f'cached:     {cached * 1e6:10.1f} us/call')
+    print(f'speedup:    {uncached / cached:10.1f}x')
+    print(f'cache:      {auth.token_cache.stats()}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
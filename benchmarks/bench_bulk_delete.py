@@ -0,0 +1,84 @@
+'''
+Deleting many actors: one DELETE /actors/<id> per row against one
+DELETE /actors by ids and by filter
+
+    python benchmarks/bench_bulk_delete.py [rows]
+
+inserts rows actors (500 by default) with five movie_actor links each into
+BENCH_DATABASE_URL before every run and removes them through the test
+client with a locally signed token, reporting the time and the SQL
+statements of each way
+'''
+import sys
+import time
+
+import support
+
+private_pem = support.install_stub_jwks()
+
+from sqlalchemy import event  # noqa: E402
+
+from app import create_app  # noqa: E402
+from bulk import BULK_DELETE_MAX_ROWS  # noqa: E402
+from models import (setup_db, db, Actor, Movie, Movie_Actor,  # noqa: E402
+                    unit_of_work)
+
+LINKS = 5
+
+
+def add_actors(rows, movie_ids):
+    with unit_of_work():
+        actors = [Actor(name='Cleanup %d' % n, gender='Male', age=120)
+                  for n in range(rows)]
+        db.session.add_all(actors)
+        db.session.flush()
+        db.session.execute(Movie_Actor.__table__.insert(), [
+            {'actor_id': actor.id, 'movie_id': movie_id}
+            for actor in actors for movie_id in movie_ids])
+    db.session.expunge_all()
+    return [actor.id for actor in actors]
+
+
+def main(rows=500):
+    rows = min(rows, BULK_DELETE_MAX_ROWS)
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + support.sign_token(private_pem)}
+
+    statements = []
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        with unit_of_work():
+            movies = [Movie(title='Movie %d' % n, release_date=None)
+                      for n in range(LINKS)]
+            db.session.add_all(movies)
+        movie_ids = [movie.id for movie in movies]
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(1))
+
+        cases = [
+            ('one per row', lambda ids: [
+                client.delete('/actors/%d' % actor_id, headers=headers)
+                for actor_id in ids]),
+            ('by ids', lambda ids: [
+                client.delete('/actors', json={'ids': ids},
+                              headers=headers)]),
+            ('by filter', lambda ids: [
+                client.delete('/actors?age_min=120', headers=headers)])
+        ]
+        print(f'{"mode":<12} {"rows":>6} {"ms":>10} {"statements":>11}')
+        for label, delete in cases:
+            ids = add_actors(rows, movie_ids)
+            del statements[:]
+            start = time.perf_counter()
+            responses = delete(ids)
+            ms = (time.perf_counter() - start) * 1000
+            assert all(res.status_code == 200 for res in responses)
+            assert Actor.query.filter(Actor.id.in_(ids)).count() == 0
+            print(f'{label:<12} {rows:6d} {ms:10.2f} {len(statements):11d}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
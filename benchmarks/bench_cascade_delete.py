@@ -0,0 +1,79 @@
+'''
+Latency of deleting an actor against the size of their filmography
+
+    python benchmarks/bench_cascade_delete.py [repeats]
+
+creates actors with 10 to 5,000 movie_actor links in BENCH_DATABASE_URL and
+deletes them two ways: loading the links into the session and deleting
+them from the ORM (what cascade="all, delete" without passive_deletes did),
+and Actor.delete_by_id(), one DELETE that the ON DELETE CASCADE foreign key
+completes in the database. Each delete is committed.
+'''
+import sys
+import time
+
+import support
+
+from app import create_app  # noqa: E402
+from models import (setup_db, db, Actor, Movie, Movie_Actor,  # noqa: E402
+                    unit_of_work)
+
+CAST_SIZES = (10, 100, 1000, 2000, 5000)
+
+
+def add_actor(movie_ids, size):
+    with unit_of_work():
+        actor = Actor(name='Star', gender='Female', age=50)
+        actor.insert()
+        db.session.execute(Movie_Actor.__table__.insert(), [
+            {'actor_id': actor.id, 'movie_id': movie_id}
+            for movie_id in movie_ids[:size]])
+    db.session.expunge_all()
+    return actor.id
+
+
+def orm_cascade(actor_id):
+    with unit_of_work():
+        actor = Actor.query.get(actor_id)
+        # the links are loaded and deleted one row at a time
+        for movie_actor in actor.movie_actors:
+            db.session.delete(movie_actor)
+        db.session.delete(actor)
+
+
+def database_cascade(actor_id):
+    with unit_of_work():
+        Actor.delete_by_id(actor_id)
+
+
+def main(repeats=5):
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    with app.app_context():
+
+        db.drop_all()
+        db.create_all()
+        with unit_of_work():
+            db.session.execute(Movie.__table__.insert(), [
+                {'title': 'Movie %d' % n, 'release_date': None}
+                for n in range(max(CAST_SIZES))])
+        movie_ids = [movie.id for movie in
+                     db.session.query(Movie.id).order_by(Movie.id)]
+
+        print(f'{"links":>6} {"orm cascade ms":>15} {"db cascade ms":>14}')
+        for size in CAST_SIZES:
+            timings = []
+            for delete in (orm_cascade, database_cascade):
+                total = 0
+                for _ in range(repeats):
+                    actor_id = add_actor(movie_ids, size)
+                    start = time.perf_counter()
+                    delete(actor_id)
+                    total += time.perf_counter() - start
+                    db.session.expunge_all()
+                timings.append(total / repeats * 1000)
+            print(f'{size:6d} {timings[0]:15.2f} {timings[1]:14.2f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,55 @@
+'''
+Release date formatting of 100k movies with babel.dates.format_date, as
+Movie.format() used to do it, against the cached DateFormatter
+
+    python benchmarks/bench_date_format.py [movies]
+
+release dates are spread over 50 years, so the memoized run has about
+18k distinct dates to format once
+'''
+import sys
+import time
+import random
+import datetime
+
+import support  # noqa: F401
+
+from babel.dates import format_date  # noqa: E402
+
+from formatting import DateFormatter, RELEASE_DATE_FORMAT  # noqa: E402
+from models import Movie  # noqa: E402
+
+
+def run(label, fn, dates):
+    start = time.perf_counter()
+    for release_date in dates:
+        fn(release_date)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<28} {elapsed:8.3f} s '
+          f'{elapsed / len(dates) * 1e6:8.2f} us/movie')
+
+
+def main(count=100000):
+    random.seed(1)
+    first = datetime.date(1970, 1, 1)
+    dates = [first + datetime.timedelta(days=random.randrange(50 * 365))
+             for _ in range(count)]
+    print(f'{count} movies, {len(set(dates))} distinct release dates')
+
+    run('babel format_date', lambda release_date: format_date(
+        release_date, RELEASE_DATE_FORMAT), dates)
+
+    formatter = DateFormatter(RELEASE_DATE_FORMAT)
+    run('DateFormatter (cold)', formatter.format, dates)
+    run('DateFormatter (warm)', formatter.format, dates)
+
+    movies = [Movie(title='Movie', release_date=release_date)
+              for release_date in dates]
+    for number, movie in enumerate(movies):
+        movie.id = number
+    run('Movie.format (no cast)',
+        lambda movie: movie.format(selected_actors=[]), movies)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,60 @@
+'''
+Payload size, latency and SQL statements of GET /movies and GET /actors
+for each ?fields= / ?include= mode
+
+    python benchmarks/bench_fieldsets.py [iterations]
+
+seeds BENCH_DATABASE_URL like loadtest.py (10k actors, 5k movies, 50k cast
+links) and calls the app through the test client with the response cache
+off, for a page of 500 and for the whole streamed list
+'''
+import sys
+import time
+
+import loadtest
+
+from sqlalchemy import event  # noqa: E402
+
+import support  # noqa: E402
+from app import create_app  # noqa: E402
+from cache import response_cache  # noqa: E402
+from models import setup_db, db  # noqa: E402
+
+MODES = [
+    ('/movies', ''),
+    ('/movies', 'fields=title'),
+    ('/movies', 'fields=title,release_date'),
+    ('/movies', 'fields=title&include=selected_actors'),
+    ('/actors', ''),
+    ('/actors', 'fields=name'),
+]
+
+
+def main(iterations=20):
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    loadtest.seed(app, 10000, 5000, 50000, 1)
+    response_cache.enabled = False
+    client = app.test_client()
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(1))
+
+    print(f'{"request":<58} {"bytes":>10} {"ms":>9} {"queries":>8}')
+    for path, mode in MODES:
+        for page in ('limit=500', 'stream=true'):
+            url = '%s?%s' % (path, '&'.join(filter(None, (page, mode))))
+            size = len(client.get(url).data)
+            del statements[:]
+            start = time.perf_counter()
+            for _ in range(iterations):
+                client.get(url).data
+            ms = (time.perf_counter() - start) / iterations * 1000
+            print(f'{url:<58} {size:10,d} {ms:9.2f} '
+                  f'{len(statements) / iterations:8.1f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
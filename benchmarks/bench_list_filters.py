@@ -0,0 +1,126 @@
+'''
+Filtered and sorted list pages with and without the 7a9e3c5b2d84 indexes,
+against fetching the whole table and filtering it in Python
+
+    python benchmarks/bench_list_filters.py [rows]
+
+truncates the tables in BENCH_DATABASE_URL (PostgreSQL) and seeds rows
+actors and rows movies (1M by default). Each case is a first page of
+GET /actors or GET /movies built by listing.py; the plan of each query is
+printed so the index scans can be checked.
+'''
+import sys
+import time
+
+import support
+
+from sqlalchemy import event, text  # noqa: E402
+from werkzeug.datastructures import MultiDict  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import setup_db, db, Actor, Movie  # noqa: E402
+from listing import actor_listing, movie_listing  # noqa: E402
+
+SEED = '''
+TRUNCATE movie_actor, actors, movies RESTART IDENTITY;
+INSERT INTO actors (name, gender, age)
+    SELECT 'actor ' || md5(i::text),
+           CASE WHEN i % 2 = 0 THEN 'Male' ELSE 'Female' END,
+           CASE WHEN i % 50 = 0 THEN NULL ELSE 18 + i % 70 END
+    FROM generate_series(1, :rows) i;
+INSERT INTO movies (title, release_date)
+    SELECT 'movie ' || md5(i::text), DATE '1950-01-01' + i % 27000
+    FROM generate_series(1, :rows) i;
+'''
+
+INDEXES = [
+    ('ix_actors_age_id', 'actors (age, id)'),
+    ('ix_actors_gender_age_id', 'actors (gender, age, id)'),
+    ('ix_actors_name_id', 'actors (name, id)'),
+    ('ix_movies_release_date_id', 'movies (release_date, id)'),
+    ('ix_movies_title_id', 'movies (title, id)'),
+]
+
+CASES = [
+    ('female actors aged 30-40', Actor, actor_listing,
+     {'gender': 'Female', 'age_min': '30', 'age_max': '40', 'sort': 'age'},
+     lambda actor: actor.gender == 'Female' and actor.age is not None and
+     30 <= actor.age <= 40),
+    ('actors by age, oldest first', Actor, actor_listing,
+     {'sort': '-age'}, lambda actor: True),
+    ('movies of 2019, newest first', Movie, movie_listing,
+     {'release_date_from': '2019-01-01', 'release_date_to': '2019-12-31',
+      'sort': '-release_date'},
+     lambda movie: movie.release_date is not None and
+     movie.release_date.year == 2019),
+    ('movies by title', Movie, movie_listing, {'sort': 'title'},
+     lambda movie: True),
+]
+
+
+def page(listing, model, args):
+    query = listing.filter(model.query, args)
+    return listing.paginate(query, listing.sort(args), args)
+
+
+def explain(listing, model, args):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, *rest):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    page(listing, model, args)
+    event.remove(db.engine, 'before_cursor_execute', capture)
+
+    statement, parameters = statements[-1]
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('EXPLAIN ' + statement, parameters)
+    return [line[0] for line in cursor.fetchall()]
+
+
+def timed_ms(fn, iterations):
+    return support.timed(fn, iterations) * 1000
+
+
+def run(label):
+    print(f'\n{label}:')
+    for name, model, listing, args, keep in CASES:
+        args = MultiDict(dict(args, limit='50'))
+        ms = timed_ms(lambda: page(listing, model, args), 20)
+        print(f'  {name:<30} {ms:10.2f} ms')
+        for line in explain(listing, model, args):
+            print('      ' + line)
+
+
+def main(rows=1000000):
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(text(SEED), {'rows': rows})
+        for name, _ in INDEXES:
+            db.session.execute('DROP INDEX IF EXISTS %s' % name)
+        db.session.execute('ANALYZE actors, movies')
+        db.session.commit()
+
+        # what clients do today: the whole table, filtered by the client
+        print('client-side filtering of the full table:')
+        for name, model, listing, args, keep in CASES[::2]:
+            start = time.perf_counter()
+            rows = [row for row in model.query.all() if keep(row)]
+            print(f'  {name:<30} '
+                  f'{(time.perf_counter() - start) * 1000:10.2f} ms '
+                  f'({len(rows)} rows)')
+            db.session.expunge_all()
+
+        run('without indexes')
+        for name, definition in INDEXES:
+            db.session.execute('CREATE INDEX %s ON %s' % (name, definition))
+        db.session.execute('ANALYZE actors, movies')
+        db.session.commit()
+        run('with indexes')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
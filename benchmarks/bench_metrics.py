@@ -0,0 +1,55 @@
+'''
+Overhead of the request metrics: the same requests through the test
+client with the metrics hooks on and off
+
+    python benchmarks/bench_metrics.py [iterations]
+
+the response cache is turned off so every request reaches its view and
+its SQL; runs alternate to even out noise
+'''
+import sys
+
+import support  # noqa: F401
+
+from app import create_app  # noqa: E402
+from cache import response_cache  # noqa: E402
+from metrics import registry  # noqa: E402
+
+PATHS = ['/', '/actors?limit=20', '/movies?limit=20']
+
+
+def main(iterations=2000, rounds=3):
+    app = create_app()
+    client = app.test_client()
+    response_cache.enabled = False
+
+    def requests(path):
+        return lambda: client.get(path)
+
+    results = {}
+    for _ in range(rounds):
+        for enabled in (False, True):
+            registry.enabled = enabled
+            for path in PATHS:
+                mean = support.timed(requests(path), iterations)
+                key = (path, enabled)
+                results[key] = min(results.get(key, mean), mean)
+
+    print(f'iterations: {iterations} x {rounds} rounds, best round shown')
+    print(f'{"path":<20} {"off us":>10} {"on us":>10} {"overhead":>10}')
+    for path in PATHS:
+        off, on = results[(path, False)], results[(path, True)]
+        print(f'{path:<20} {off * 1e6:10.1f} {on * 1e6:10.1f} '
+              f'{(on - off) * 1e6:8.1f}us')
+
+    observe = support.timed(lambda: registry.observe(
+        'capstone_http_request_duration_seconds',
+        (('route', '/'), ('method', 'GET'), ('status', '200')), 0.01),
+        100000)
+    render = support.timed(registry.render, 100)
+    print(f'histogram observe:   {observe * 1e6:10.2f} us')
+    print(f'render /metrics:     {render * 1e6:10.1f} us')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,106 @@
+'''
+Cast lookup and cascade delete cost on movie_actor before and after the
+3f1c2a7d9b10 indexes
+
+    python benchmarks/bench_movie_actor_indexes.py [links]
+
+works on scratch bench_* tables in BENCH_DATABASE_URL (PostgreSQL) seeded
+with about 1M movie_actor rows by default, and drops them afterwards
+'''
+import os
+import sys
+import time
+
+import support  # noqa: F401
+
+from sqlalchemy import create_engine, text
+
+SCHEMA = '''
+DROP TABLE IF EXISTS bench_movie_actor, bench_actors, bench_movies;
+CREATE TABLE bench_actors (id serial PRIMARY KEY, name varchar);
+CREATE TABLE bench_movies (id serial PRIMARY KEY, title varchar);
+CREATE TABLE bench_movie_actor (
+    id serial PRIMARY KEY,
+    actor_id integer NOT NULL
+        REFERENCES bench_actors (id) ON DELETE CASCADE,
+    movie_id integer NOT NULL
+        REFERENCES bench_movies (id) ON DELETE CASCADE
+);
+'''
+
+SEED = '''
+INSERT INTO bench_actors (name)
+    SELECT 'actor ' || n FROM generate_series(1, :actors) n;
+INSERT INTO bench_movies (title)
+    SELECT 'movie ' || n FROM generate_series(1, :movies) n;
+INSERT INTO bench_movie_actor (movie_id, actor_id)
+    SELECT 1 + (n % :movies), 1 + ((n / :movies + (n % :movies) * 37)
+                                   % :actors)
+    FROM generate_series(0, :links - 1) n;
+ANALYZE bench_actors, bench_movies, bench_movie_actor;
+'''
+
+INDEXES = '''
+ALTER TABLE bench_movie_actor
+    ADD CONSTRAINT bench_uq_movie_actor UNIQUE (movie_id, actor_id);
+CREATE INDEX bench_ix_actor_movie ON bench_movie_actor (actor_id, movie_id);
+ANALYZE bench_movie_actor;
+'''
+
+CAST_LOOKUP = text('''
+SELECT a.id, a.name FROM bench_movie_actor ma
+JOIN bench_actors a ON a.id = ma.actor_id
+WHERE ma.movie_id = :id ORDER BY a.id
+''')
+FILMOGRAPHY_LOOKUP = text(
+    'SELECT movie_id FROM bench_movie_actor WHERE actor_id = :id')
+CAST_WIPE = text('DELETE FROM bench_movie_actor WHERE movie_id = :id')
+CASCADE_DELETE = text('DELETE FROM bench_actors WHERE id = :id')
+
+
+def measure(engine, statement, ids):
+    '''mean milliseconds per statement, each run rolled back'''
+    timings = []
+    with engine.connect() as connection:
+        for record_id in ids:
+            transaction = connection.begin()
+            start = time.perf_counter()
+            connection.execute(statement, id=record_id)
+            timings.append(time.perf_counter() - start)
+            transaction.rollback()
+    return sum(timings) / len(timings) * 1000
+
+
+def run(engine, label):
+    ids = range(1, 21)
+    print(f'{label}:')
+    print(f'  cast lookup        {measure(engine, CAST_LOOKUP, ids):10.2f} ms')
+    print(f'  filmography lookup '
+          f'{measure(engine, FILMOGRAPHY_LOOKUP, ids):10.2f} ms')
+    print(f'  cast wipe          {measure(engine, CAST_WIPE, ids):10.2f} ms')
+    print(f'  actor cascade      '
+          f'{measure(engine, CASCADE_DELETE, ids):10.2f} ms')
+
+
+def main(links=1000000):
+    engine = create_engine(os.environ['DATABASE_URL'])
+    actors, movies = max(links // 20, 1), max(links // 10, 1)
+    with engine.begin() as connection:
+        connection.execute(text(SCHEMA))
+        connection.execute(text(SEED), actors=actors, movies=movies,
+                           links=links)
+    try:
+        print(f'{links} links, {actors} actors, {movies} movies')
+        run(engine, 'before')
+        with engine.begin() as connection:
+            connection.execute(text(INDEXES))
+        run(engine, 'after')
+    finally:
+        with engine.begin() as connection:
+            connection.execute(text(
+                'DROP TABLE IF EXISTS bench_movie_actor, bench_actors, '
+                'bench_movies'))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
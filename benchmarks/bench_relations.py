@@ -0,0 +1,67 @@
+'''
+Filmographies of a page of actors: one GET /actors/<id>/movies per actor
+against one batched GET /actors/movies?ids=..., and the same for casts
+
+    python benchmarks/bench_relations.py [iterations]
+
+seeds BENCH_DATABASE_URL like loadtest.py (10k actors, 5k movies, 50k cast
+links) and calls the app through the test client with the response cache
+off, for pages of 10, 50 and 100 ids
+'''
+import sys
+import time
+
+import loadtest
+
+from sqlalchemy import event  # noqa: E402
+
+import support  # noqa: E402
+from app import create_app  # noqa: E402
+from cache import response_cache  # noqa: E402
+from models import setup_db, db  # noqa: E402
+
+RELATIONS = [
+    ('filmographies', 'actor_ids', '/actors/%d/movies', '/actors/movies'),
+    ('casts', 'movie_ids', '/movies/%d/actors', '/movies/actors'),
+]
+
+
+def main(iterations=20):
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    dataset = loadtest.seed(app, 10000, 5000, 50000, 1)
+    response_cache.enabled = False
+    client = app.test_client()
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(1))
+
+    def measure(urls):
+        del statements[:]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for url in urls:
+                client.get(url).data
+        ms = (time.perf_counter() - start) / iterations * 1000
+        return ms, len(statements) / iterations
+
+    print(f'{"relation":<14} {"ids":>4} {"mode":<10} {"ms":>9} '
+          f'{"queries":>8}')
+    for name, key, single, batched in RELATIONS:
+        for count in (10, 50, 100):
+            ids = dataset[key][:count]
+            cases = [
+                ('one by one', [single % owner_id for owner_id in ids]),
+                ('batched', ['%s?ids=%s' % (batched, ','.join(
+                    str(owner_id) for owner_id in ids))])
+            ]
+            for mode, urls in cases:
+                ms, queries = measure(urls)
+                print(f'{name:<14} {count:4d} {mode:<10} {ms:9.2f} '
+                      f'{queries:8.1f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
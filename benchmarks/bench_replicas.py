@@ -0,0 +1,75 @@
+'''
+GET throughput with reads on the primary only and spread over replicas
+
+    BENCH_REPLICA_URLS=postgresql://replica1/capstone_bench,... \
+        python benchmarks/bench_replicas.py [requests] [threads]
+
+seeds BENCH_DATABASE_URL like loadtest.py (the replicas must follow it by
+streaming replication, or be copies of it) and sends GET /movies and
+GET /actors pages from threads through the test client, first without
+replicas and then with BENCH_REPLICA_URLS, printing requests per second
+and the statements each database ran
+'''
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import loadtest
+
+from sqlalchemy import event  # noqa: E402
+
+import support  # noqa: E402
+from app import create_app  # noqa: E402
+from cache import response_cache  # noqa: E402
+from models import setup_db, db  # noqa: E402
+
+BENCH_REPLICA_URLS = [url for url in os.environ.get(
+    'BENCH_REPLICA_URLS', '').split(',') if url]
+
+PATHS = ['/movies?limit=50', '/actors?limit=50&sort=name',
+         '/movies?limit=50&sort=-release_date']
+
+
+def run(app, requests, threads):
+    client = app.test_client()
+    engines = [('primary', db.get_engine(app))]
+    if app.extensions['replicas']:
+        engines += [('replica %d' % number, replica.engine) for number,
+                    replica in enumerate(app.extensions['replicas'].replicas)]
+    counts = {name: 0 for name, _ in engines}
+    for name, engine in engines:
+        event.listen(engine, 'before_cursor_execute',
+                     lambda *args, name=name: counts.__setitem__(
+                         name, counts[name] + 1))
+
+    def get(number):
+        return client.get(PATHS[number % len(PATHS)]).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        statuses = list(pool.map(get, range(requests)))
+    seconds = time.perf_counter() - start
+    assert set(statuses) == {200}, set(statuses)
+    return requests / seconds, counts
+
+
+def main(requests=2000, threads=8):
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL, [])
+    loadtest.seed(app, 10000, 5000, 50000, 1)
+    response_cache.enabled = False
+
+    for label, urls in (('primary only', []),
+                        ('with replicas', BENCH_REPLICA_URLS)):
+        if label != 'primary only' and not urls:
+            print('set BENCH_REPLICA_URLS to compare with replicas')
+            break
+        setup_db(app, support.BENCH_DATABASE_URL, urls)
+        rps, counts = run(app, requests, threads)
+        print(f'{label:<14} {rps:9.1f} requests/s  statements: ' +
+              ', '.join(f'{name} {count}' for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
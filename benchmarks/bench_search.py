@@ -0,0 +1,118 @@
+'''
+Latency of GET /search queries at a million actors and movies
+
+    python benchmarks/bench_search.py [rows]
+
+truncates the tables in BENCH_DATABASE_URL (PostgreSQL), seeds rows actors
+and rows movies (1M by default) with names made of random syllables,
+creates the 5d2b7e9c4a61 search indexes and reports p50/p95 milliseconds
+of search() for prefix and fuzzy queries, with the plan of each kind
+'''
+import sys
+import time
+import random
+
+import support
+
+from sqlalchemy import event, text  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import setup_db, db  # noqa: E402
+from search import SEARCH_TYPES, search  # noqa: E402
+
+SYLLABLES = ['ka', 'ri', 'to', 'mel', 'an', 'sor', 'vi', 'den', 'lu',
+             'par', 'os', 'te', 'ni', 'gal', 'ber', 'ya']
+
+SEED = '''
+TRUNCATE movie_actor, actors, movies RESTART IDENTITY;
+INSERT INTO actors (name, gender, age)
+    SELECT initcap(s[1 + abs(hashtext(i || 'a')) % 16] ||
+                   s[1 + abs(hashtext(i || 'b')) % 16] ||
+                   s[1 + abs(hashtext(i || 'c')) % 16]) || ' ' ||
+           initcap(s[1 + abs(hashtext(i || 'd')) % 16]) || 'son',
+           'Male', 30
+    FROM generate_series(1, :rows) i, CAST(:syllables AS text[]) s;
+INSERT INTO movies (title, release_date)
+    SELECT 'The ' || initcap(s[1 + abs(hashtext(i || 'e')) % 16] ||
+                             s[1 + abs(hashtext(i || 'f')) % 16] ||
+                             s[1 + abs(hashtext(i || 'g')) % 16] ||
+                             s[1 + abs(hashtext(i || 'h')) % 16]),
+           DATE '2000-01-01'
+    FROM generate_series(1, :rows) i, CAST(:syllables AS text[]) s;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS ix_actors_name_trgm
+    ON actors USING gin (lower(name) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_movies_title_trgm
+    ON movies USING gin (lower(title) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_actors_name_lower_c
+    ON actors (lower(name) COLLATE "C");
+CREATE INDEX IF NOT EXISTS ix_movies_title_lower_c
+    ON movies (lower(title) COLLATE "C");
+ANALYZE actors, movies;
+'''
+
+
+def word(rng, syllables):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(syllables))
+
+
+def measure(queries, prefix):
+    timings = []
+    for q in queries:
+        start = time.perf_counter()
+        search(q, prefix, SEARCH_TYPES, 20)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return (timings[len(timings) // 2],
+            timings[int(len(timings) * 0.95) - 1])
+
+
+def main(rows=1000000):
+    rng = random.Random(1)
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        db.session.execute(text(SEED), {'rows': rows,
+                                        'syllables': SYLLABLES})
+        db.session.commit()
+        print(f'seeded {rows:,} actors and movies in '
+              f'{time.perf_counter() - start:.1f} s')
+
+        cases = [
+            ('prefix, 2 chars', [word(rng, 1) for _ in range(200)], True),
+            ('prefix, 5 chars', [word(rng, 2)[:5] for _ in range(200)],
+             True),
+            ('fuzzy, 1 word', [word(rng, 3) for _ in range(200)], False),
+            ('fuzzy, typo', [word(rng, 3)[1:] + 'x' for _ in range(200)],
+             False)
+        ]
+        print(f'{"query":<18} {"p50 ms":>8} {"p95 ms":>8}')
+        for label, queries, prefix in cases:
+            # warm the caches with the first queries
+            measure(queries[:20], prefix)
+            p50, p95 = measure(queries, prefix)
+            print(f'{label:<18} {p50:8.2f} {p95:8.2f}')
+
+        for prefix in (True, False):
+            statements = []
+
+            def capture(conn, cursor, statement, parameters, *args):
+                statements.append((statement, parameters))
+
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            search(cases[1 if prefix else 2][1][0], prefix, SEARCH_TYPES, 20)
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+            # the statement as psycopg2 received it, with its parameters
+            statement, parameters = statements[-1]
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute('EXPLAIN ANALYZE ' + statement, parameters)
+            print(f'\nplan ({"prefix" if prefix else "fuzzy"}):')
+            for line in cursor.fetchall():
+                print('  ' + line[0])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
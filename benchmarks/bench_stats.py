@@ -0,0 +1,61 @@
+'''
+Catalog statistics from the counters against counting the tables
+
+    python benchmarks/bench_stats.py [requests]
+
+seeds BENCH_DATABASE_URL like loadtest.py at growing sizes and, for each,
+times GET /stats and the same aggregates computed with GROUP BY over the
+actors, movies and movie_actor tables on every request, printing the
+milliseconds per request of both
+'''
+import sys
+import time
+
+import loadtest
+
+import support  # noqa: E402
+from app import create_app  # noqa: E402
+from cache import response_cache  # noqa: E402
+from models import setup_db, db, unit_of_work  # noqa: E402
+from stats import read_stats, rebuild_stats  # noqa: E402
+
+SIZES = [(1000, 500, 5000), (10000, 5000, 50000), (100000, 50000, 500000)]
+
+
+def per_request(run, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        run()
+    return (time.perf_counter() - start) * 1000 / requests
+
+
+def main(requests=50):
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL, [])
+    response_cache.enabled = False
+    client = app.test_client()
+
+    def counters():
+        assert client.get('/stats').status_code == 200
+
+    def recount():
+        # the recount GET /stats would run without the counters, rolled
+        # back so the counters stay as they are
+        with app.app_context():
+            rebuild_stats()
+            read_stats()
+            db.session.rollback()
+
+    print(f'{"actors":>8} {"movies":>8} {"links":>8} '
+          f'{"counters ms":>12} {"recount ms":>11}')
+    for actors, movies, links in SIZES:
+        loadtest.seed(app, actors, movies, links, 1)
+        with app.app_context(), unit_of_work():
+            rebuild_stats()
+        print(f'{actors:8d} {movies:8d} {links:8d} '
+              f'{per_request(counters, requests):12.2f} '
+              f'{per_request(recount, requests):11.2f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,71 @@
+'''
+Peak RSS of GET /movies?all=true against GET /movies?stream=true as the
+catalog grows
+
+    python benchmarks/bench_stream_memory.py [rows ...]
+
+seeds BENCH_DATABASE_URL with the given numbers of movies (default 10000,
+50000 and 200000) and runs every request in a fresh process so ru_maxrss
+is the peak of that request alone
+'''
+import sys
+import datetime
+import resource
+import subprocess
+
+import support  # noqa: F401
+
+from flask import Flask  # noqa: E402
+
+from models import setup_db, db, Movie, Movie_Actor, insert_rows  # noqa
+
+
+def seed(rows):
+    app = Flask(__name__)
+    setup_db(app)
+    with app.app_context():
+        db.create_all()
+        Movie_Actor.query.delete()
+        Movie.query.delete()
+        release_date = datetime.date(2020, 1, 1)
+        for start in range(0, rows, 10000):
+            insert_rows(Movie.__table__, [
+                {'title': 'Movie %d' % number, 'release_date': release_date}
+                for number in range(start, min(start + 10000, rows))])
+        db.session.commit()
+
+
+def child(mode):
+    from app import app
+
+    response = app.test_client().get('/movies?%s=true' % mode)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(size, peak)
+
+
+def measure(mode):
+    output = subprocess.run(
+        [sys.executable, __file__, '--child', mode],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    size, peak = output.split()
+    return int(size), int(peak)
+
+
+def main(sizes=(10000, 50000, 200000)):
+    print(f'{"rows":>10} {"mode":>8} {"bytes":>12} {"peak rss kB":>12}')
+    for rows in sizes:
+        seed(rows)
+        for mode in ('all', 'stream'):
+            size, peak = measure(mode)
+            print(f'{rows:>10} {mode:>8} {size:>12} {peak:>12}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2])
+    else:
+        main(*[[int(arg) for arg in sys.argv[1:]]] if sys.argv[1:] else [])
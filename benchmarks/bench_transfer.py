@@ -0,0 +1,101 @@
+'''
+Throughput of the COPY based catalog export and import
+
+    python benchmarks/bench_transfer.py [rows]
+
+truncates the tables in BENCH_DATABASE_URL (PostgreSQL) and seeds them
+with rows movie_actor links (10M by default) over rows/10 actors and
+rows/10 movies, then times export_tables and import_table in both formats,
+first into emptied tables (inserts) and then over the same rows (updates).
+Peak RSS shows that memory does not grow with the row count.
+'''
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+import support
+
+from sqlalchemy import text  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import setup_db, db  # noqa: E402
+from transfer import TRANSFER_TABLES, export_tables, import_table  # noqa
+
+SEED = '''
+TRUNCATE movie_actor, actors, movies RESTART IDENTITY;
+INSERT INTO actors (name, gender, age)
+    SELECT 'actor ' || n, CASE WHEN n % 2 = 0 THEN 'Male' ELSE 'Female' END,
+           18 + n % 70
+    FROM generate_series(1, :entities) n;
+INSERT INTO movies (title, release_date)
+    SELECT 'movie ' || n, DATE '1950-01-01' + n % 25000
+    FROM generate_series(1, :entities) n;
+INSERT INTO movie_actor (movie_id, actor_id)
+    SELECT 1 + n / 10, 1 + (n * 7919) % :entities
+    FROM generate_series(0, :links - 1) n
+    ON CONFLICT DO NOTHING;
+ANALYZE actors, movies, movie_actor;
+'''
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(label, seconds, rows, size):
+    print(f'{label:<24} {seconds:8.2f} s {rows / seconds:12,.0f} rows/s '
+          f'{size / seconds / 2 ** 20:8.1f} MB/s  peak rss '
+          f'{peak_rss_mb():7.1f} MB')
+
+
+def load(directory, fmt):
+    for name in TRANSFER_TABLES:
+        path = os.path.join(directory, '%s.%s' % (name, fmt))
+        with open(path, 'rb') as source:
+            import_table(name, fmt, source)
+    db.session.commit()
+
+
+def main(links=10000000):
+    entities = max(1, links // 10)
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    directory = tempfile.mkdtemp(prefix='capstone-transfer-')
+    with app.app_context():
+        db.create_all()
+        db.session.execute(text(SEED), {'entities': entities,
+                                        'links': links})
+        db.session.commit()
+        rows = sum(db.session.execute(
+            'SELECT count(*) FROM %s' % name).scalar()
+            for name in TRANSFER_TABLES)
+        print(f'{rows:,} rows in {", ".join(TRANSFER_TABLES)}')
+
+        try:
+            for fmt in ('csv', 'ndjson'):
+                start = time.perf_counter()
+                paths = export_tables(directory, fmt)
+                size = sum(os.path.getsize(path) for path in paths)
+                report(f'export {fmt}', time.perf_counter() - start, rows,
+                       size)
+
+                db.session.execute('TRUNCATE movie_actor, actors, movies')
+                db.session.commit()
+                start = time.perf_counter()
+                load(directory, fmt)
+                report(f'import {fmt} (insert)', time.perf_counter() - start,
+                       rows, size)
+
+                start = time.perf_counter()
+                load(directory, fmt)
+                report(f'import {fmt} (update)', time.perf_counter() - start,
+                       rows, size)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
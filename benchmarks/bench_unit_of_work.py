@@ -0,0 +1,85 @@
+'''
+Write throughput of one commit per step against one commit per unit of work
+
+    python benchmarks/bench_unit_of_work.py [operations]
+
+each operation adds a movie with a cast of three actors, as POST /movies
+followed by PATCH /movies/<id> do: first committing after every staged
+step as the model methods used to, then with every step in a single
+unit_of_work(). On PostgreSQL every connection runs with
+synchronous_commit=on, so each commit waits for its WAL flush.
+'''
+import sys
+import time
+import datetime
+
+import support
+
+from sqlalchemy import event  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import (setup_db, db, Actor, Movie, Movie_Actor,  # noqa: E402
+                    bump_versions, unit_of_work)
+
+
+def add_movie(number, actor_ids, commit):
+    movie = Movie(title='Unit %d' % number,
+                  release_date=datetime.date(2000, 1, 1))
+    movie.insert()
+    bump_versions('movies')
+    commit()
+    for actor_id in actor_ids:
+        Movie_Actor(actor_id=actor_id, movie_id=movie.id).insert()
+        commit()
+    bump_versions('movies')
+    commit()
+
+
+def per_step(number, actor_ids):
+    add_movie(number, actor_ids, db.session.commit)
+
+
+def single_unit(number, actor_ids):
+    with unit_of_work():
+        add_movie(number, actor_ids, lambda: None)
+
+
+def main(operations=500):
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    with app.app_context():
+        if db.engine.dialect.name == 'postgresql':
+            @event.listens_for(db.engine, 'connect')
+            def synchronous_commit(dbapi_connection, record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute('SET synchronous_commit TO on')
+                cursor.close()
+            db.engine.dispose()
+
+        db.drop_all()
+        db.create_all()
+        with unit_of_work():
+            actors = [Actor(name='Cast %d' % n, gender='Male', age=30)
+                      for n in range(3)]
+            for actor in actors:
+                actor.insert()
+        actor_ids = [actor.id for actor in actors]
+
+        commits = []
+        event.listen(db.engine, 'commit', lambda conn: commits.append(1))
+
+        print(f'{"mode":<14} {"ops/s":>9} {"ms/op":>8} {"commits/op":>11}')
+        for label, operation in (('per step', per_step),
+                                 ('unit of work', single_unit)):
+            del commits[:]
+            start = time.perf_counter()
+            for number in range(operations):
+                operation(number, actor_ids)
+            seconds = time.perf_counter() - start
+            print(f'{label:<14} {operations / seconds:9.1f} '
+                  f'{seconds / operations * 1000:8.2f} '
+                  f'{len(commits) / operations:11.1f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,379 @@
+'''
+Load test of every endpoint over HTTP at a fixed concurrency
+
+    python benchmarks/loadtest.py [--actors N] [--movies M] [--links K]
+        [--concurrency C] [--requests R] [--only NAME ...]
+        [--output results.json] [--compare baseline.json]
+
+the tables in BENCH_DATABASE_URL are dropped and seeded with N actors,
+M movies and K movie_actor links from a fixed random seed, so two runs on
+the same machine measure the same data. The app is served by a threaded
+werkzeug server on a free local port and called with a locally signed
+JWT checked against a stub JWKS.
+
+Each scenario sends R requests from C threads and reports p50/p95/p99
+latency, requests per second and SQL statements per request. Results are
+written as JSON together with the commit and the settings; --compare
+prints the change against an earlier results file.
+'''
+import sys
+import json
+import math
+import time
+import random
+import logging
+import datetime
+import argparse
+import platform
+import subprocess
+import http.client
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import support
+
+private_pem = support.install_stub_jwks()
+
+from sqlalchemy import event, select  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import setup_db, db, Actor, Movie, Movie_Actor  # noqa: E402
+
+SEED_CHUNK = 5000
+BULK_RECORDS = 100
+RELATION_IDS = 20
+IMPORT_ROWS = 100
+
+
+'''
+Scenario
+    one endpoint under test; request(i) returns the method, path and body
+    of the i-th request, a JSON document or CSV text
+'''
+
+
+class Scenario:
+    def __init__(self, name, request, authenticated=True):
+        self.name = name
+        self.request = request
+        self.authenticated = authenticated
+
+
+def scenarios(dataset):
+    actor_ids, movie_ids = dataset['actor_ids'], dataset['movie_ids']
+    created = dataset['created']
+    rng = random.Random(dataset['seed'])
+
+    def actor(i):
+        return {'name': 'Load Actor %d' % i, 'age': 20 + i % 60,
+                'gender': ('Male', 'Female')[i % 2]}
+
+    def movie(i):
+        return {'title': 'Load Movie %d' % i,
+                'release_date': '20%02d-01-01' % (i % 30)}
+
+    def cast():
+        return rng.sample(actor_ids, min(3, len(actor_ids)))
+
+    def actors_csv(i):
+        # consecutive requests upsert disjoint actors
+        start = i * IMPORT_ROWS % len(actor_ids)
+        return 'id,name,gender,age\n' + ''.join(
+            '%d,Imported Actor %d,Female,%d\n' % (actor_id, actor_id,
+                                                  20 + actor_id % 60)
+            for actor_id in actor_ids[start:start + IMPORT_ROWS])
+
+    # the delete scenarios remove the rows made by the create scenarios
+    return [
+        Scenario('get_api', lambda i: ('GET', '/', None),
+                 authenticated=False),
+        Scenario('get_actors', lambda i: ('GET', '/actors?limit=50', None)),
+        Scenario('get_movies', lambda i: ('GET', '/movies?limit=50', None)),
+        Scenario('stream_actors',
+                 lambda i: ('GET', '/actors?stream=true', None)),
+        Scenario('stream_movies',
+                 lambda i: ('GET', '/movies?stream=true', None)),
+        Scenario('actor_movies', lambda i: (
+            'GET', '/actors/%d/movies' % rng.choice(actor_ids), None)),
+        Scenario('movie_actors', lambda i: (
+            'GET', '/movies/%d/actors' % rng.choice(movie_ids), None)),
+        Scenario('actors_movies', lambda i: (
+            'GET', '/actors/movies?ids=%s' % ','.join(
+                str(actor_id) for actor_id in rng.sample(
+                    actor_ids, min(RELATION_IDS, len(actor_ids)))), None)),
+        Scenario('stats', lambda i: ('GET', '/stats', None),
+                 authenticated=False),
+        Scenario('search', lambda i: (
+            'GET', '/search?q=actor+%d' % rng.randrange(1000), None),
+            authenticated=False),
+        Scenario('search_prefix', lambda i: (
+            'GET', '/search?q=movie+%d&prefix=true' % rng.randrange(100),
+            None), authenticated=False),
+        Scenario('export_actors',
+                 lambda i: ('GET', '/export/actors?format=csv', None)),
+        Scenario('import_actors',
+                 lambda i: ('POST', '/import/actors', actors_csv(i))),
+        Scenario('post_actor', lambda i: ('POST', '/actors', actor(i))),
+        Scenario('post_movie', lambda i: ('POST', '/movies', movie(i))),
+        Scenario('bulk_actors', lambda i: (
+            'POST', '/actors/bulk',
+            [actor(i * BULK_RECORDS + n) for n in range(BULK_RECORDS)])),
+        Scenario('bulk_movies', lambda i: (
+            'POST', '/movies/bulk',
+            [movie(i * BULK_RECORDS + n) for n in range(BULK_RECORDS)])),
+        Scenario('patch_actor', lambda i: (
+            'PATCH', '/actors/%d' % rng.choice(actor_ids),
+            {'age': 20 + i % 60})),
+        Scenario('patch_movie', lambda i: (
+            'PATCH', '/movies/%d' % rng.choice(movie_ids),
+            {'title': 'Patched %d' % i, 'selected_actors': cast()})),
+        Scenario('delete_actor', lambda i: (
+            'DELETE', '/actors/%d' % created['actors'][i], None)),
+        Scenario('delete_movie', lambda i: (
+            'DELETE', '/movies/%d' % created['movies'][i], None)),
+        Scenario('bulk_delete_actors', lambda i: (
+            'DELETE', '/actors', {'ids': created['bulk_actors'][i]})),
+        Scenario('bulk_delete_movies', lambda i: (
+            'DELETE', '/movies', {'ids': created['bulk_movies'][i]})),
+        Scenario('internal_stats',
+                 lambda i: ('GET', '/internal/stats', None)),
+        Scenario('metrics', lambda i: ('GET', '/metrics', None),
+                 authenticated=False)
+    ]
+
+
+def seed(app, actors, movies, links, seed_value):
+    '''drops the tables and inserts the dataset, returns the new ids'''
+    rng = random.Random(seed_value)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        def insert(table, rows):
+            for start in range(0, len(rows), SEED_CHUNK):
+                db.session.execute(table.insert(),
+                                   rows[start:start + SEED_CHUNK])
+
+        insert(Actor.__table__, [
+            {'name': 'Actor %d' % n, 'age': rng.randint(18, 90),
+             'gender': rng.choice(('Male', 'Female'))}
+            for n in range(actors)])
+        insert(Movie.__table__, [
+            {'title': 'Movie %d' % n,
+             'release_date': datetime.date(
+                 rng.randint(1950, 2020), rng.randint(1, 12),
+                 rng.randint(1, 28))}
+            for n in range(movies)])
+        actor_ids = [row.id for row in db.session.execute(
+            select([Actor.id]).order_by(Actor.id))]
+        movie_ids = [row.id for row in db.session.execute(
+            select([Movie.id]).order_by(Movie.id))]
+
+        # distinct (movie, actor) pairs
+        links = min(links, len(actor_ids) * len(movie_ids))
+        pairs = rng.sample(range(len(actor_ids) * len(movie_ids)), links)
+        insert(Movie_Actor.__table__, [
+            {'movie_id': movie_ids[pair // len(actor_ids)],
+             'actor_id': actor_ids[pair % len(actor_ids)]}
+            for pair in pairs])
+        db.session.commit()
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute('ANALYZE')
+            db.session.commit()
+        db.session.remove()
+
+    return {'actor_ids': actor_ids, 'movie_ids': movie_ids, 'seed': seed_value,
+            'created': {'actors': [], 'movies': [], 'bulk_actors': [],
+                        'bulk_movies': []}}
+
+
+def call(port, method, path, body, headers):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        request_headers = dict(headers)
+        payload = body
+        if isinstance(body, str):
+            request_headers['Content-Type'] = 'text/csv'
+        elif body is not None:
+            payload = json.dumps(body)
+            request_headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        connection.request(method, path, payload, request_headers)
+        response = connection.getresponse()
+        data = response.read()
+        return time.perf_counter() - start, response.status, data
+    finally:
+        connection.close()
+
+
+def percentile(timings, fraction):
+    '''nearest-rank percentile of sorted timings'''
+    if not timings:
+        return None
+    return timings[max(0, math.ceil(fraction * len(timings)) - 1)]
+
+
+def run_scenario(scenario, port, token, requests, concurrency, dataset,
+                 statements):
+    headers = {}
+    if scenario.authenticated:
+        headers['Authorization'] = 'Bearer ' + token
+
+    def one(i):
+        try:
+            method, path, body = scenario.request(i)
+        except IndexError:
+            return None, 0, b''
+        return call(port, method, path, body, headers)
+
+    before = statements['count']
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    queries = statements['count'] - before
+
+    timings = sorted(seconds for seconds, status, data in results
+                     if seconds is not None and status < 400)
+    errors = len(results) - len(timings)
+    collect_created(scenario.name, results, dataset['created'])
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'seconds': elapsed,
+        'rps': len(results) / elapsed,
+        'p50_ms': _ms(percentile(timings, 0.50)),
+        'p95_ms': _ms(percentile(timings, 0.95)),
+        'p99_ms': _ms(percentile(timings, 0.99)),
+        'mean_ms': _ms(sum(timings) / len(timings) if timings else None),
+        'queries_per_request': queries / len(results)
+    }
+
+
+def collect_created(name, results, created):
+    key = {'post_actor': 'actors', 'post_movie': 'movies'}.get(name)
+    if key is not None:
+        for seconds, status, data in results:
+            if status == 200:
+                created[key].append(json.loads(data)[key]['id'])
+
+    # the ids of each bulk request, deleted by one bulk delete
+    if name in ('bulk_actors', 'bulk_movies'):
+        for seconds, status, data in results:
+            if status != 200:
+                continue
+            lines = [json.loads(line) for line in data.splitlines()]
+            ids = [line['id'] for line in lines if 'id' in line]
+            if ids:
+                created[name].append(ids)
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=support.ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f'\n{"scenario":<18} {"p50":>9} {"p95":>9} {"p99":>9} {"rps":>9}'
+          f'   vs {baseline["meta"].get("commit")}')
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for field in ('p50_ms', 'p95_ms', 'p99_ms', 'rps'):
+            if not before.get(field) or result.get(field) is None:
+                changes.append(f'{"n/a":>9}')
+                continue
+            change = (result[field] - before[field]) / before[field] * 100
+            changes.append(f'{change:+8.1f}%')
+        print(f'{name:<18} ' + ' '.join(changes))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=5000)
+    parser.add_argument('--links', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--only', nargs='*', metavar='NAME',
+                        help='scenarios to run, all by default')
+    parser.add_argument('--output', default='loadtest-results.json')
+    parser.add_argument('--compare', metavar='BASELINE')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    app = create_app()
+    setup_db(app, support.BENCH_DATABASE_URL)
+    dataset = seed(app, args.actors, args.movies, args.links, args.seed)
+
+    statements = {'count': 0}
+    lock = threading.Lock()
+
+    def count_statement(*args):
+        with lock:
+            statements['count'] += 1
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+
+    # keep the request log out of the report
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    token = support.sign_token(private_pem)
+
+    results = {
+        'meta': {
+            'commit': commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'database': support.BENCH_DATABASE_URL.split(':', 1)[0],
+            'actors': args.actors, 'movies': args.movies,
+            'links': args.links, 'seed': args.seed,
+            'concurrency': args.concurrency, 'requests': args.requests
+        },
+        'scenarios': {}
+    }
+    print(f'{"scenario":<18} {"rps":>9} {"p50 ms":>9} {"p95 ms":>9} '
+          f'{"p99 ms":>9} {"queries":>8} {"errors":>7}')
+    try:
+        for scenario in scenarios(dataset):
+            if args.only and scenario.name not in args.only:
+                continue
+            result = run_scenario(scenario, server.server_port, token,
+                                  args.requests, args.concurrency, dataset,
+                                  statements)
+            results['scenarios'][scenario.name] = result
+            print(f'{scenario.name:<18} {result["rps"]:9.1f} '
+                  f'{result["p50_ms"] or 0:9.2f} {result["p95_ms"] or 0:9.2f} '
+                  f'{result["p99_ms"] or 0:9.2f} '
+                  f'{result["queries_per_request"]:8.1f} '
+                  f'{result["errors"]:7d}')
+    finally:
+        server.shutdown()
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'\nresults written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+'''
+Shared helpers for the benchmark scripts
+
+    the scripts run against a local database and locally signed JWTs so
+    they never touch Auth0. Import this module before app, auth or models:
+    it fills in the environment those modules read at import time.
+'''
+import os
+import sys
+import json
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('ALGORITHMS', "['RS256']")
+os.environ.setdefault('API_AUDIENCE', 'capstone_api')
+BENCH_DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql://localhost:5432/capstone_bench')
+os.environ.setdefault('DATABASE_URL', BENCH_DATABASE_URL)
+
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from jose import jwk, jwt  # noqa: E402
+
+KID = 'bench-key'
+ALL_PERMISSIONS = [
+    'get:actors', 'get:movies',
+    'post:actors', 'post:movies',
+    'patch:actors', 'patch:movies',
+    'delete:actors', 'delete:movies',
+    'get:internal-stats'
+]
+
+
+def generate_signing_key(kid=KID):
+    private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()).decode('utf-8')
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+    public_jwk = jwk.construct(public_pem, 'RS256').to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+    return private_pem, public_jwk
+
+
+def install_stub_jwks():
+    '''
+    generates a signing key, points JWKS_URL at a local JWKS file holding
+    its public half and returns the private PEM used by sign_token
+    '''
+    private_pem, public_jwk = generate_signing_key()
+    directory = tempfile.mkdtemp(prefix='capstone-jwks-')
+    path = os.path.join(directory, 'jwks.json')
+    with open(path, 'w') as jwks_file:
+        json.dump({'keys': [public_jwk]}, jwks_file)
+    os.environ['JWKS_URL'] = 'file://' + path
+    return private_pem
+
+
+def sign_token(private_pem, permissions=ALL_PERMISSIONS, lifetime=3600):
+    now = int(time.time())
+    claims = {
+        'iss': 'https://' + os.environ['AUTH0_DOMAIN'] + '/',
+        'aud': os.environ['API_AUDIENCE'],
+        'sub': 'bench|user',
+        'iat': now,
+        'exp': now + lifetime,
+        'permissions': list(permissions)
+    }
+    return jwt.encode(claims, private_pem, algorithm='RS256',
+                      headers={'kid': KID})
+
+
+def timed(fn, iterations):
+    '''runs fn iterations times and returns the mean seconds per call'''
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
@@ -0,0 +1,208 @@
+import os
+import json
+import datetime
+from itertools import islice
+
+from sqlalchemy import select
+
+from models import bump_versions, delete_returning, insert_rows, unit_of_work
+from stats import count_links, stage_links, stage_rows
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+MAX_BULK_BATCH_SIZE = int(os.environ.get('MAX_BULK_BATCH_SIZE', 10000))
+# Most rows a single bulk delete may remove
+BULK_DELETE_MAX_ROWS = int(os.environ.get('BULK_DELETE_MAX_ROWS', 1000))
+
+'''
+Bulk Create
+    records are read one at a time from a JSON array or a streamed NDJSON
+    body, validated, and inserted batch_size at a time with one multi-row
+    INSERT and one commit per batch. A result line is streamed back for
+    every record, so memory stays bounded by the batch size for NDJSON
+    uploads of any length.
+'''
+
+
+def batch_size_arg(args):
+    batch_size = args.get('batch_size', BULK_BATCH_SIZE)
+    try:
+        batch_size = int(batch_size)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid batch_size.')
+    if batch_size < 1:
+        raise ValueError('Invalid batch_size.')
+    return min(batch_size, MAX_BULK_BATCH_SIZE)
+
+
+'''
+iter_records(request)
+    returns an iterator of (line, record) pairs from the request body
+    a JSON array is parsed up front and raises ValueError when malformed,
+    NDJSON (application/x-ndjson) is read lazily line by line and a line
+    that is not valid JSON comes back with a ValueError as its record
+'''
+
+
+def iter_records(request):
+    if request.mimetype == 'application/x-ndjson':
+        return _iter_ndjson(request.stream)
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, list):
+        raise ValueError('Expected a JSON array or an NDJSON body.')
+    return enumerate(body, start=1)
+
+
+def _iter_ndjson(stream):
+    for line, raw in enumerate(stream, start=1):
+        if not raw.strip():
+            continue
+        try:
+            yield line, json.loads(raw)
+        except ValueError:
+            yield line, ValueError('Invalid JSON.')
+
+
+def validate_actor(record):
+    if not isinstance(record, dict):
+        raise ValueError('Expected a JSON object.')
+
+    name = record.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required.')
+    gender = record.get('gender')
+    if gender is not None and not isinstance(gender, str):
+        raise ValueError('gender must be a string.')
+    age = record.get('age')
+    if age is not None and (isinstance(age, bool) or
+                            not isinstance(age, int) or age < 0):
+        raise ValueError('age must be a positive integer.')
+
+    return {'name': name, 'gender': gender, 'age': age}
+
+
+def validate_movie(record):
+    if not isinstance(record, dict):
+        raise ValueError('Expected a JSON object.')
+
+    title = record.get('title')
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError('title is required.')
+    release_date = record.get('release_date')
+    if release_date is not None:
+        try:
+            release_date = datetime.date.fromisoformat(release_date)
+        except (TypeError, ValueError):
+            raise ValueError('release_date must be YYYY-MM-DD.')
+
+    return {'title': title, 'release_date': release_date}
+
+
+'''
+bulk_insert(model, validate, records, batch_size)
+    generator of NDJSON result lines: {"line", "id"} for a created record,
+    {"line", "error"} for a rejected one, then a summary line
+'''
+
+
+def bulk_insert(model, validate, records, batch_size):
+    created = failed = 0
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+
+        results = []
+        rows = []
+        for line, record in batch:
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                rows.append(validate(record))
+                results.append({'line': line})
+            except ValueError as error:
+                results.append({'line': line, 'error': str(error)})
+
+        valid = [result for result in results if 'error' not in result]
+        try:
+            # one commit per batch
+            with unit_of_work():
+                ids = insert_rows(model.__table__, rows)
+                stage_rows(model, rows)
+                if rows:
+                    bump_versions(model.__tablename__)
+        except Exception:
+            ids = None
+            for result in valid:
+                result['error'] = 'Unable to insert record.'
+        if ids is not None:
+            for result, record_id in zip(valid, ids):
+                result['id'] = record_id
+
+        for result in results:
+            if 'error' in result:
+                failed += 1
+            else:
+                created += 1
+        yield ''.join(json.dumps(result) + '\n' for result in results)
+
+    yield json.dumps({
+        'success': True,
+        'created': created,
+        'failed': failed
+    }) + '\n'
+
+
+'''
+Bulk Delete
+    the rows to delete are picked either by a list of ids in the JSON body
+    ({"ids": [1, 2]}) or by the whitelisted filters of the list endpoint in
+    the query string (?gender=Male&age_max=20), never both. They are
+    removed with one DELETE ... RETURNING id in the request's transaction,
+    at most BULK_DELETE_MAX_ROWS + 1 of them so the caller can tell when
+    the selection is over the cap and roll it back.
+'''
+
+
+def delete_selection(listing, args, body, limit=BULK_DELETE_MAX_ROWS):
+    '''
+    returns the condition picking the rows to delete, raises ValueError
+    when neither or both selections are given, or either is malformed,
+    so a request without a selection never deletes a whole table, and
+    when more than limit distinct ids are listed, before any IN (...) is
+    built for them
+    '''
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if set(args) - set(listing.filters):
+        raise ValueError('Invalid filter.')
+
+    if ids is not None:
+        if args or not isinstance(ids, list) or not ids:
+            raise ValueError('Invalid ids.')
+        if any(isinstance(value, bool) or not isinstance(value, int)
+               for value in ids):
+            raise ValueError('Invalid ids.')
+        ids = set(ids)
+        if len(ids) > limit:
+            raise ValueError('Too many ids.')
+        return listing.model.id.in_(sorted(ids))
+
+    condition = listing.filter(listing.model.query, args).whereclause
+    if condition is None:
+        raise ValueError('Missing ids or filter.')
+    return condition
+
+
+def bulk_delete(model, condition, limit=BULK_DELETE_MAX_ROWS):
+    '''
+    stages the delete of the first limit + 1 rows matching condition (by
+    id), and of their catalog statistics, and returns their ids in order;
+    more than limit ids means the selection is over the cap
+    '''
+    picked = model.id.in_(select([model.id]).where(condition).order_by(
+        model.id).limit(limit + 1))
+    stage_links(-count_links(model, picked))
+    rows = delete_returning(model.__table__, picked)
+    stage_rows(model, rows, -1)
+    return sorted(row.id for row in rows)
@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request
+from sqlalchemy import event
+
+from models import db, get_versions
+from formatting import request_locale
+
+'''
+Conditional GET
+    list responses carry an ETag built from the versions of the resources
+    they are made of, plus the request path, query string and locale, and a
+    Last-Modified of the newest of those resources. A matching
+    If-None-Match (or, without one, an If-Modified-Since that is not older
+    than Last-Modified) is answered with 304 after reading the versions
+    only, without running the view.
+
+    The versions are read before the view runs, so a write committed in
+    between can only make the ETag older than the body, never newer: the
+    client downloads once more instead of keeping a stale copy.
+'''
+
+
+def variant_key():
+    # The same URL is rendered differently per Accept-Language locale
+    locale = request_locale()
+    if locale is None:
+        return request.full_path
+    return request.full_path + '|' + locale
+
+
+def resource_etag(versions):
+    state = variant_key() + '|' + '|'.join(
+        '%s:%d' % (name, versions[name][0]) for name in sorted(versions))
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+def last_modified(versions):
+    stamps = [updated_at for _, updated_at in versions.values()
+              if updated_at is not None]
+    return max(stamps) if stamps else None
+
+
+def naive_utc(moment):
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc)
+    return moment.replace(tzinfo=None)
+
+
+def not_modified(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if modified is not None and request.if_modified_since is not None:
+        # HTTP dates have no sub-second part
+        return (naive_utc(modified).replace(microsecond=0) <=
+                naive_utc(request.if_modified_since))
+    return False
+
+
+'''
+@conditional(*resources)
+    route decorator adding ETag and Last-Modified to successful responses
+    and answering conditional requests with 304; resources may name items
+    with placeholders filled from the view arguments ('actors/{actor_id}')
+'''
+
+
+def conditional(*resources):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            names = [resource.format(**kwargs) for resource in resources]
+            versions = get_versions(names)
+            etag = resource_etag(versions)
+            modified = last_modified(versions)
+
+            if not_modified(etag, modified):
+                response = Response(status=304)
+            else:
+                response = f(*args, **kwargs)
+                if not isinstance(response, Response):
+                    return response
+                if response.status_code != 200:
+                    return response
+
+            if request_locale() is not None:
+                response.vary.add('Accept-Language')
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            return response
+        return wrapper
+    return conditional_decorator
+
+
+'''
+Response Cache
+    read-through cache of successful GET responses, keyed by path, query
+    string, locale and the tags (resource names) the response is built
+    from.
+    bump_versions records the resources a transaction writes and the cache
+    drops every entry tagged with one of them once that transaction
+    commits.
+
+    LocalCacheBackend is an in-process LRU: each gunicorn worker keeps its
+    own copy and only sees its own invalidations. Every entry therefore
+    keeps the versions of its tags, and a hit is only served while they
+    are still current (one resource_versions lookup), so a write handled
+    by another worker is never hidden by an older entry.
+    SharedCacheBackend keeps entries in a Redis compatible store shared by
+    all workers and invalidates through per-tag generation counters.
+'''
+
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'local')
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 30))
+
+
+class LocalCacheBackend:
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, tags):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, tags, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, tags, value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def size(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, tags, _ = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SharedCacheBackend:
+    def __init__(self, client, ttl=30, prefix='capstone:'):
+        # client is a redis.Redis or anything with get, set, mget and incr
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = None
+
+    def get(self, key, tags):
+        return self.client.get(self._entry_key(key, tags))
+
+    def set(self, key, tags, value):
+        self.client.set(self._entry_key(key, tags), value,
+                        ex=max(int(self.ttl), 1))
+
+    def invalidate(self, tags):
+        # Entries of the old generation are never read again and expire
+        for tag in tags:
+            self.client.incr(self.prefix + 'generation:' + tag)
+
+    def clear(self):
+        self.client.incr(self.prefix + 'generation:*')
+
+    def size(self):
+        return None
+
+    def _entry_key(self, key, tags):
+        names = ['*'] + sorted(tags)
+        generations = self.client.mget(
+            [self.prefix + 'generation:' + name for name in names])
+        state = key + '|' + '|'.join(
+            '%s:%s' % (name, int(generation or 0))
+            for name, generation in zip(names, generations))
+        return self.prefix + 'response:' + hashlib.sha1(
+            state.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.enabled = backend is not None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    def get(self, key, tags, versions=None):
+        '''
+        returns the entry of key, None when there is none or when versions
+        are given and differ from those the entry was stored with
+        '''
+        value = self.backend.get(key, tags)
+        entry = None if value is None else json.loads(value)
+        if entry is not None and versions is not None and \
+                entry.get('versions') != versions:
+            # a write this worker did not see, made by another worker
+            self.stale += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def set(self, key, tags, entry):
+        self.backend.set(key, tags, json.dumps(entry))
+
+    def invalidate(self, tags):
+        if self.backend is None or not tags:
+            return
+        self.invalidations += 1
+        self.backend.invalidate(sorted(tags))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'size': self.backend.size() if self.backend else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'evictions': self.backend.evictions if self.backend else 0,
+            'invalidations': self.invalidations
+        }
+
+
+def create_backend(kind=RESPONSE_CACHE, url=RESPONSE_CACHE_URL):
+    if kind == 'off':
+        return None
+    if kind == 'redis':
+        # Optional dependency, only needed for the shared backend
+        import redis
+        return SharedCacheBackend(redis.Redis.from_url(url),
+                                  ttl=RESPONSE_CACHE_TTL)
+    return LocalCacheBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+response_cache = ResponseCache(create_backend())
+
+
+def invalidate_committed(session):
+    response_cache.invalidate(session.info.pop('bumped_versions', None))
+
+
+def discard_rolled_back(session):
+    session.info.pop('bumped_versions', None)
+
+
+event.listen(db.session, 'after_commit', invalidate_committed)
+event.listen(db.session, 'after_rollback', discard_rolled_back)
+
+
+'''
+@cached(*tags)
+    route decorator serving successful responses from response_cache; put
+    it above @conditional so a hit only reads the versions of its tags.
+    tags may name items with placeholders filled from the view arguments.
+'''
+
+
+def version_numbers(names):
+    if not names:
+        return {}
+    return {name: version
+            for name, (version, _) in get_versions(names).items()}
+
+
+def cached(*tags):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not response_cache.enabled:
+                return f(*args, **kwargs)
+
+            names = [tag.format(**kwargs) for tag in tags]
+            key = variant_key()
+            # read before the view, like the ETag of @conditional, and from
+            # the same database as the body: a body built on a lagging
+            # replica carries that replica's versions and is dropped once
+            # it has replayed the write
+            versions = version_numbers(names)
+            entry = response_cache.get(key, names, versions)
+            if entry is not None:
+                if entry['etag'] and request.if_none_match.contains(
+                        entry['etag']):
+                    response = Response(status=304)
+                else:
+                    response = Response(entry['body'],
+                                        mimetype=entry['mimetype'])
+                if entry['etag']:
+                    response.set_etag(entry['etag'])
+                if entry['last_modified']:
+                    response.headers['Last-Modified'] = \
+                        entry['last_modified']
+                if request_locale() is not None:
+                    response.vary.add('Accept-Language')
+                return response
+
+            response = f(*args, **kwargs)
+            if (isinstance(response, Response) and
+                    response.status_code == 200 and
+                    not response.is_streamed):
+                response_cache.set(key, names, {
+                    'body': response.get_data(as_text=True),
+                    'mimetype': response.mimetype,
+                    'etag': response.get_etag()[0],
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'versions': versions
+                })
+            return response
+        return wrapper
+    return cached_decorator
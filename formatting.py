@@ -0,0 +1,77 @@
+import os
+import datetime
+from functools import lru_cache
+
+from babel import Locale
+from babel.dates import LC_TIME, format_date, parse_pattern
+from flask import has_request_context, request
+
+RELEASE_DATE_FORMAT = "EEEE, dd MMMM YYYY"
+DATE_CACHE_SIZE = int(os.environ.get('DATE_CACHE_SIZE', 65536))
+
+# Locales a client may pick with Accept-Language, e.g. "en-US,fr,de".
+# Without any, dates are formatted in the server locale as before.
+SUPPORTED_LOCALES = [locale.strip() for locale in os.environ.get(
+    'SUPPORTED_LOCALES', '').split(',') if locale.strip()]
+
+'''
+DateFormatter
+    formats dates like babel.dates.format_date(value, pattern, locale)
+
+    the pattern is compiled once, each locale is parsed once, and
+    formatted strings are memoized per (date, locale) in a bounded LRU
+'''
+
+
+class DateFormatter:
+    def __init__(self, pattern, default_locale=LC_TIME,
+                 maxsize=DATE_CACHE_SIZE):
+        self.pattern = pattern
+        self.default_locale = default_locale
+        self._compiled = parse_pattern(pattern)
+        self._locales = {}
+        self._format = lru_cache(maxsize=maxsize)(self._format_uncached)
+
+    def format(self, value, locale=None):
+        if value is None:
+            # format_date means today, which must not be memoized
+            return format_date(None, self.pattern,
+                               self.locale(locale))
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        return self._format(value, locale)
+
+    def locale(self, name=None):
+        if name is None:
+            name = self.default_locale
+        locale = self._locales.get(name)
+        if locale is None:
+            # Accept-Language tags use '-', babel identifiers use '_'
+            if isinstance(name, str) and '-' in name:
+                locale = Locale.parse(name, sep='-')
+            else:
+                locale = Locale.parse(name)
+            self._locales[name] = locale
+        return locale
+
+    def cache_info(self):
+        return self._format.cache_info()
+
+    def _format_uncached(self, value, locale):
+        return self._compiled.apply(value, self.locale(locale))
+
+
+release_dates = DateFormatter(RELEASE_DATE_FORMAT)
+
+
+'''
+request_locale()
+    returns the supported locale that best matches the Accept-Language of
+    the current request, or None for the server default
+'''
+
+
+def request_locale():
+    if not SUPPORTED_LOCALES or not has_request_context():
+        return None
+    return request.accept_languages.best_match(SUPPORTED_LOCALES)
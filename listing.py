@@ -0,0 +1,207 @@
+import datetime
+
+from sqlalchemy import and_, collate, func, or_, tuple_
+from sqlalchemy.orm import load_only
+
+from models import db, Actor, Movie, ACTOR_FIELDS, MOVIE_FIELDS
+from pagination import decode_cursor, encode_cursor, page_args
+from search import escape_like
+
+'''
+Listing
+    whitelisted filter and sort arguments of a list endpoint
+
+    filters maps an argument to (column, operator, parse) where operator is
+    'eq', 'ge', 'le' or 'prefix' (case insensitive); sorts maps a sort
+    name to its column. sort=name sorts ascending and sort=-name
+    descending, always followed by the id in the same direction. Values
+    are bound as parameters, never written into the SQL.
+
+    NULLs sort last ascending and first descending, as a btree on
+    (column, id) returns them read forwards and backwards. Pages are
+    keyset pages over (column, id); the cursor carries the sort value, the
+    id and the sort name.
+
+    fields (columns) and includes (related data such as the cast) are the
+    keys a client may pick with ?fields= and ?include=. Only the picked
+    columns are selected, and related data is only loaded when included.
+'''
+
+
+class Listing:
+    def __init__(self, model, filters, sorts, fields, includes=()):
+        self.model = model
+        self.filters = filters
+        self.sorts = sorts
+        self.fields = fields
+        self.includes = includes
+
+    def filter(self, query, args):
+        '''adds the filters found in args, raises ValueError when malformed'''
+        for name, (column, operator, parse) in self.filters.items():
+            raw = args.get(name)
+            if raw is None or raw == '':
+                continue
+            try:
+                value = parse(raw)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid %s.' % name)
+            query = query.filter(_condition(column, operator, value))
+        return query
+
+    def sort(self, args):
+        '''returns (sort name, column, descending) for the sort argument'''
+        name = args.get('sort') or 'id'
+        descending = name.startswith('-')
+        column = self.sorts.get(name[1:] if descending else name)
+        if column is None:
+            raise ValueError('Invalid sort.')
+        return name, column, descending
+
+    def fieldset(self, args):
+        '''
+        returns the output keys picked by the fields and include arguments,
+        every key when neither is given, raises ValueError for unknown keys
+        '''
+        if args.get('fields') is None and args.get('include') is None:
+            return self.fields + self.includes
+
+        picked = {'id'}
+        picked.update(_names(args.get('fields')) if args.get('fields')
+                      is not None else self.fields)
+        picked.update(_names(args.get('include')))
+        if not picked <= set(self.fields + self.includes):
+            raise ValueError('Invalid fields.')
+        return tuple(key for key in self.fields + self.includes
+                     if key in picked)
+
+    def load(self, query, fields, sort):
+        '''selects the columns of fields, and of the sort for the cursor'''
+        columns = {key for key in fields if key in self.fields}
+        columns.update({'id', sort[1].key})
+        return query.options(load_only(*sorted(columns)))
+
+    def order(self, query, sort):
+        name, column, descending = sort
+        id_column = self.model.id
+        if column is id_column:
+            return query.order_by(id_column.desc() if descending
+                                  else id_column)
+        if descending:
+            return query.order_by(column.desc().nullsfirst(),
+                                  id_column.desc())
+        return query.order_by(column.asc().nullslast(), id_column)
+
+    def paginate(self, query, sort, args):
+        '''
+        returns one page of query in sort order and the cursor of the next
+        page, or None when this is the last page
+        '''
+        limit, last_id = page_args(args)
+        name, column, descending = sort
+        if last_id is not None:
+            position = decode_cursor(args['cursor'])
+            if position.get('s', 'id') != name:
+                raise ValueError('Invalid cursor.')
+            query = query.filter(self._after(sort, position))
+        rows = self.order(query, sort).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            position = {'id': rows[-1].id}
+            if column is not self.model.id:
+                value = getattr(rows[-1], column.key)
+                if isinstance(value, datetime.date):
+                    value = value.isoformat()
+                position.update({'s': name, 'v': value})
+            elif descending:
+                position['s'] = name
+            next_cursor = encode_cursor(position)
+        return rows, next_cursor
+
+    def _after(self, sort, position):
+        name, column, descending = sort
+        id_column = self.model.id
+        last_id = position['id']
+        if column is id_column:
+            return id_column < last_id if descending else id_column > last_id
+
+        value = position.get('v')
+        if value is not None:
+            value = _cursor_value(column, value)
+
+        if descending:
+            # NULLs came first, then values from the highest down
+            if value is None:
+                return or_(column.isnot(None),
+                           and_(column.is_(None), id_column < last_id))
+            return tuple_(column, id_column) < tuple_(value, last_id)
+        # values from the lowest up, then NULLs
+        if value is None:
+            return and_(column.is_(None), id_column > last_id)
+        return or_(tuple_(column, id_column) > tuple_(value, last_id),
+                   column.is_(None))
+
+
+def _names(value):
+    return {name.strip() for name in (value or '').split(',')
+            if name.strip()}
+
+
+def _cursor_value(column, value):
+    python_type = column.type.python_type
+    try:
+        if python_type is datetime.date:
+            return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        raise ValueError('Invalid cursor.')
+    return value
+
+
+def _condition(column, operator, value):
+    if operator == 'eq':
+        return column == value
+    if operator == 'ge':
+        return column >= value
+    if operator == 'le':
+        return column <= value
+    lowered = func.lower(column)
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # served by the ix_*_lower_c prefix index of the search migration
+        lowered = collate(lowered, 'C')
+    return lowered.like(escape_like(value.lower()) + '%', escape='\\')
+
+
+def _non_negative(value):
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+actor_listing = Listing(
+    Actor,
+    filters={
+        'gender': (Actor.gender, 'eq', str),
+        'age_min': (Actor.age, 'ge', _non_negative),
+        'age_max': (Actor.age, 'le', _non_negative)
+    },
+    sorts={'id': Actor.id, 'name': Actor.name, 'age': Actor.age},
+    fields=ACTOR_FIELDS)
+
+movie_listing = Listing(
+    Movie,
+    filters={
+        'title_prefix': (Movie.title, 'prefix', str),
+        'release_date_from': (Movie.release_date, 'ge',
+                              datetime.date.fromisoformat),
+        'release_date_to': (Movie.release_date, 'le',
+                            datetime.date.fromisoformat)
+    },
+    sorts={'id': Movie.id, 'title': Movie.title,
+           'release_date': Movie.release_date},
+    fields=MOVIE_FIELDS[:-1],
+    includes=('selected_actors',))
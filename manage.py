@@ -1,8 +1,12 @@
+import os
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, unit_of_work
+from stats import rebuild_stats as rebuild_catalog_stats
+from transfer import TRANSFER_TABLES, export_tables, import_table
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +14,38 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-d', '--directory', dest='directory', default='export')
+@manager.option('-f', '--format', dest='fmt', default='csv',
+                choices=('csv', 'ndjson'))
+def export_catalog(directory, fmt):
+    """Export actors, movies and movie_actor with COPY"""
+    for path in export_tables(directory, fmt):
+        print('exported', path)
+
+
+@manager.option('-d', '--directory', dest='directory', default='export')
+@manager.option('-f', '--format', dest='fmt', default='csv',
+                choices=('csv', 'ndjson'))
+def import_catalog(directory, fmt):
+    """Import the files written by export_catalog in one transaction"""
+    with unit_of_work():
+        for name in TRANSFER_TABLES:
+            path = os.path.join(directory, '%s.%s' % (name, fmt))
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as source:
+                result = import_table(name, fmt, source)
+            print('imported %(rows)d rows into %(table)s' % result)
+        rebuild_catalog_stats()
+
+
+@manager.command
+def rebuild_stats():
+    """Recount the catalog statistics served by GET /stats"""
+    with unit_of_work():
+        rebuilt = rebuild_catalog_stats()
+    print('rebuilt' if rebuilt else 'another worker is rebuilding')
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,405 @@
+import os
+import glob
+import json
+import time
+import atexit
+import bisect
+import tempfile
+import threading
+
+from flask import Response, has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# Request metrics, set METRICS_ENABLED=false to turn the hooks off.
+# With several workers, each one writes its metrics to a file in
+# METRICS_MULTIPROC_DIR at most every METRICS_FLUSH_INTERVAL seconds and
+# /metrics adds up the files of all workers.
+METRICS_ENABLED = os.environ.get(
+    'METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+AUTH_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1,
+                0.5, 1.0)
+
+'''
+PoolStats
+    counters of one connection pool: checkouts, the time spent waiting for
+    a connection, checkout timeouts, new connections and invalidations
+'''
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.connects = 0
+        self.invalidations = 0
+        self.soft_invalidations = 0
+        self.overflow_max = 0
+
+    def listen(self, pool):
+        event.listen(pool, 'connect', self._on_connect)
+        event.listen(pool, 'invalidate', self._on_invalidate)
+        event.listen(pool, 'soft_invalidate', self._on_soft_invalidate)
+
+    def checked_out(self, pool, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            self.overflow_max = max(self.overflow_max, pool.overflow())
+
+    def timed_out(self):
+        with self._lock:
+            self.checkout_timeouts += 1
+
+    def snapshot(self, pool):
+        with self._lock:
+            return {
+                'pool_size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+                'overflow_max': self.overflow_max,
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.checkout_timeouts,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'wait_seconds_avg': (self.wait_seconds_total /
+                                     self.checkouts if self.checkouts
+                                     else 0.0),
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+                'soft_invalidations': self.soft_invalidations
+            }
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def _on_soft_invalidate(self, dbapi_connection, connection_record,
+                            exception):
+        with self._lock:
+            self.soft_invalidations += 1
+
+
+'''
+InstrumentedQueuePool
+    QueuePool that records PoolStats, including how long each checkout
+    waited (pre-ping and reconnects included). The stats survive
+    recreate(), which the engine calls after a disconnect.
+'''
+
+
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        recreated = '_dispatch' in kwargs
+        super().__init__(*args, **kwargs)
+        if not recreated:
+            self.stats = PoolStats()
+            self.stats.listen(self)
+
+    def connect(self):
+        return self._timed_checkout(super().connect)
+
+    def unique_connection(self):
+        # Engine.connect() checks out through here, not connect()
+        return self._timed_checkout(super().unique_connection)
+
+    def _timed_checkout(self, checkout):
+        start = time.perf_counter()
+        try:
+            connection = checkout()
+        except exc.TimeoutError:
+            self.stats.timed_out()
+            raise
+        self.stats.checked_out(self, time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        # listeners are carried over with the dispatch, keep their stats
+        pool.stats = self.stats
+        return pool
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats.snapshot(pool)
+    return {'status': pool.status()}
+
+
+'''
+MetricsRegistry
+    counters and histograms keyed by metric name and label values,
+    rendered in the Prometheus text format
+
+    only counters and histograms are kept, so the metrics of several
+    workers can be summed. In multi-process mode each worker flushes its
+    values to <directory>/metrics_<pid>.json and collect() merges the files
+    of every worker, dead ones included, as their counts stay part of the
+    totals. Empty the directory when the server is (re)started.
+'''
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=True, directory='', flush_interval=5):
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._values = {}
+        self._flushed_at = 0.0
+
+    def counter(self, name, documentation):
+        self._metrics[name] = ('counter', documentation, None)
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self._metrics[name] = ('histogram', documentation, tuple(buckets))
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = self._metrics[name][2]
+        key = (name, labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, +Inf last, then the sum
+                counts = self._values[key] = [0] * (len(buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            return [[name, [list(label) for label in labels],
+                     list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in self._values.items()]
+
+    def flush(self, force=False):
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < self.flush_interval:
+            return
+        self._flushed_at = now
+        path = os.path.join(self.directory, 'metrics_%d.json' % os.getpid())
+        # written aside and renamed, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(self.samples(), tmp_file)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        if not self.directory:
+            return self._merge([self.samples()])
+
+        self.flush(force=True)
+        workers = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+            try:
+                with open(path) as worker_file:
+                    workers.append(json.load(worker_file))
+            except (OSError, ValueError):
+                continue
+        return self._merge(workers)
+
+    def render(self):
+        merged = self.collect()
+        lines = []
+        for name in sorted(self._metrics):
+            kind, documentation, buckets = self._metrics[name]
+            lines.append('# HELP %s %s' % (name, documentation))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels in sorted(merged.get(name, {})):
+                value = merged[name][labels]
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (
+                        name, _labels(labels), _number(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _labels(labels + (('le', _number(bound)),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (
+                    name, _labels(labels), _number(value[-1])))
+                lines.append('%s_count%s %d' % (
+                    name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _merge(self, workers):
+        merged = {}
+        for samples in workers:
+            for name, labels, value in samples:
+                if name not in self._metrics:
+                    continue
+                labels = tuple(tuple(label) for label in labels)
+                values = merged.setdefault(name, {})
+                total = values.get(labels)
+                if total is None:
+                    values[labels] = value
+                elif isinstance(value, list):
+                    values[labels] = [a + b for a, b in zip(total, value)]
+                else:
+                    values[labels] = total + value
+        return merged
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+registry = MetricsRegistry(
+    enabled=METRICS_ENABLED,
+    directory=METRICS_MULTIPROC_DIR,
+    flush_interval=METRICS_FLUSH_INTERVAL)
+registry.histogram('capstone_http_request_duration_seconds',
+                   'Time spent handling a request, by route')
+registry.counter('capstone_http_response_bytes_total',
+                 'Bytes of response bodies, by route')
+registry.counter('capstone_sql_statements_total',
+                 'SQL statements executed, by route')
+registry.counter('capstone_sql_duration_seconds_total',
+                 'Time spent executing SQL statements, by route')
+registry.histogram('capstone_auth_verify_duration_seconds',
+                   'Time spent decoding a bearer token, by source',
+                   buckets=AUTH_BUCKETS)
+registry.histogram('capstone_jwks_fetch_duration_seconds',
+                   'Time spent fetching the JWKS, by result')
+if registry.directory:
+    atexit.register(registry.flush, force=True)
+
+
+def route_label():
+    if not has_request_context():
+        return 'none'
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+def observe_auth(source, seconds):
+    if registry.enabled:
+        registry.observe('capstone_auth_verify_duration_seconds',
+                         (('source', source),), seconds)
+
+
+def observe_jwks_fetch(result, seconds):
+    if registry.enabled:
+        registry.observe('capstone_jwks_fetch_duration_seconds',
+                         (('result', result),), seconds)
+
+
+'''
+SQL timing
+    before/after_cursor_execute listeners on every engine count each
+    statement and its execution time against the route being served
+'''
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if registry.enabled:
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('metrics_start')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    labels = (('route', route_label()),)
+    registry.inc('capstone_sql_statements_total', labels)
+    registry.inc('capstone_sql_duration_seconds_total', labels, seconds)
+
+
+'''
+init_metrics(app)
+    records the latency and response size of every request and serves
+    the registry at GET /metrics
+
+    latency is measured until the view returns; the bytes of a streamed
+    body are counted as they are sent
+'''
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_timer():
+        request.environ['capstone.metrics_start'] = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = request.environ.get('capstone.metrics_start')
+        if not registry.enabled or start is None:
+            return response
+
+        route = route_label()
+        registry.observe(
+            'capstone_http_request_duration_seconds',
+            (('route', route), ('method', request.method),
+             ('status', str(response.status_code))),
+            time.perf_counter() - start)
+
+        labels = (('route', route),)
+        if response.is_streamed:
+            response.response = _counted(response.response, labels)
+        else:
+            registry.inc('capstone_http_response_bytes_total', labels,
+                         response.calculate_content_length() or 0)
+        registry.flush()
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+def _counted(body, labels):
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        registry.inc('capstone_http_response_bytes_total', labels, sent)
+        if hasattr(body, 'close'):
+            body.close()
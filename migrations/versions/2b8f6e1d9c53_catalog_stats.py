@@ -0,0 +1,31 @@
+"""catalog_stats counters for GET /stats
+
+Revision ID: 2b8f6e1d9c53
+Revises: 7a9e3c5b2d84
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b8f6e1d9c53'
+down_revision = '7a9e3c5b2d84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled by the first GET /stats or python manage.py rebuild_stats
+    op.create_table(
+        'catalog_stats',
+        sa.Column('metric', sa.String(), nullable=False),
+        sa.Column('bucket', sa.String(), nullable=False),
+        sa.Column('value', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('metric', 'bucket')
+    )
+
+
+def downgrade():
+    op.drop_table('catalog_stats')
@@ -0,0 +1,47 @@
+"""movie_actor indexes and unique cast constraint
+
+Revision ID: 3f1c2a7d9b10
+Revises:
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Block concurrent cast writes so no duplicate can slip in between the
+    # cleanup and the constraint; reads are not blocked
+    op.execute('LOCK TABLE movie_actor IN SHARE ROW EXCLUSIVE MODE')
+
+    # Keep the oldest row of every (movie_id, actor_id) pair
+    op.execute("""
+        DELETE FROM movie_actor duplicate
+        USING movie_actor original
+        WHERE duplicate.movie_id = original.movie_id
+          AND duplicate.actor_id = original.actor_id
+          AND duplicate.id > original.id
+    """)
+
+    # The unique constraint's index serves (movie_id, actor_id) lookups
+    op.create_unique_constraint(
+        'uq_movie_actor_movie_id_actor_id',
+        'movie_actor',
+        ['movie_id', 'actor_id'])
+    op.create_index(
+        'ix_movie_actor_actor_id_movie_id',
+        'movie_actor',
+        ['actor_id', 'movie_id'])
+
+
+def downgrade():
+    op.drop_index('ix_movie_actor_actor_id_movie_id', table_name='movie_actor')
+    op.drop_constraint(
+        'uq_movie_actor_movie_id_actor_id', 'movie_actor', type_='unique')
@@ -0,0 +1,40 @@
+"""trigram and prefix indexes for name and title search
+
+Revision ID: 5d2b7e9c4a61
+Revises: 8c4e6d2f1a37
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2b7e9c4a61'
+down_revision = '8c4e6d2f1a37'
+branch_labels = None
+depends_on = None
+
+SEARCHED = (('actors', 'name'), ('movies', 'title'))
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    for table, column in SEARCHED:
+        # Substring and similarity (%) matches of lower(column)
+        op.execute(
+            'CREATE INDEX ix_%s_%s_trgm ON %s '
+            'USING gin (lower(%s) gin_trgm_ops)' % (
+                table, column, table, column))
+        # Prefix matches in lower(column) order, LIKE 'q%' needs the
+        # byte order of the C collation to use a btree
+        op.execute(
+            'CREATE INDEX ix_%s_%s_lower_c ON %s (lower(%s) COLLATE "C")' % (
+                table, column, table, column))
+
+
+def downgrade():
+    for table, column in SEARCHED:
+        op.drop_index('ix_%s_%s_lower_c' % (table, column), table_name=table)
+        op.drop_index('ix_%s_%s_trgm' % (table, column), table_name=table)
@@ -0,0 +1,36 @@
+"""indexes for the filters and sorts of the list endpoints
+
+Revision ID: 7a9e3c5b2d84
+Revises: 5d2b7e9c4a61
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a9e3c5b2d84'
+down_revision = '5d2b7e9c4a61'
+branch_labels = None
+depends_on = None
+
+# Every index ends with id, the tie breaker of the keyset pages, so a
+# filtered and sorted page is one index range scan read in either direction
+INDEXES = (
+    ('ix_actors_age_id', 'actors', ['age', 'id']),
+    ('ix_actors_gender_age_id', 'actors', ['gender', 'age', 'id']),
+    ('ix_actors_name_id', 'actors', ['name', 'id']),
+    ('ix_movies_release_date_id', 'movies', ['release_date', 'id']),
+    ('ix_movies_title_id', 'movies', ['title', 'id']),
+)
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
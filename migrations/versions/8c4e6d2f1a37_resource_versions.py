@@ -0,0 +1,33 @@
+"""resource_versions change counters for conditional GET
+
+Revision ID: 8c4e6d2f1a37
+Revises: 3f1c2a7d9b10
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e6d2f1a37'
+down_revision = '3f1c2a7d9b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    resource_versions = op.create_table(
+        'resource_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.execute(
+        "INSERT INTO resource_versions (name, version, updated_at) "
+        "VALUES ('actors', 1, now()), ('movies', 1, now())")
+
+
+def downgrade():
+    op.drop_table('resource_versions')
@@ -0,0 +1,26 @@
+"""drop the unused per item rows of resource_versions
+
+Revision ID: 9e5a1c7f3b26
+Revises: 2b8f6e1d9c53
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9e5a1c7f3b26'
+down_revision = '2b8f6e1d9c53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 'actors/<id>' and 'movies/<id>' versions were written on every update
+    # and delete but never read; only collection versions are kept
+    op.execute("DELETE FROM resource_versions WHERE name LIKE '%/%'")
+
+
+def downgrade():
+    # the pruned versions are not needed by any reader
+    pass
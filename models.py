@@ -1,34 +1,133 @@
 import os
 import json
-import babel
-from babel.dates import format_date
-from flask_sqlalchemy import SQLAlchemy
+import sqlite3
+import datetime
+from contextlib import contextmanager
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
 from sqlalchemy import (
     Column,
     String,
     Integer,
     Date,
+    DateTime,
+    BigInteger,
     LargeBinary,
-    create_engine
+    create_engine,
+    event,
+    select
 )
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import sessionmaker, validates
+
+from formatting import release_dates
+from metrics import InstrumentedQueuePool
+from replicas import DATABASE_REPLICA_URLS, ReplicaSet
 
 database_path = os.environ['DATABASE_URL']
 
-db = SQLAlchemy()
+# Connection pool settings, ignored for SQLite
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get(
+    'DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+'''
+RoutingSession
+    a session that reads from a replica of the app's ReplicaSet during
+    GET and HEAD requests, and from the primary otherwise
+
+    the first read of a request picks the replica, the later ones stay on
+    it. A flush, an INSERT, UPDATE or DELETE or a unit_of_work() pins the
+    session to the primary for the rest of the request, so a request reads
+    its own writes. Without replicas, or with none healthy, everything
+    goes to the primary.
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        primary = SignallingSession.get_bind(self, mapper, clause)
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['primary'] = True
+        if self.info.get('primary') or not has_request_context() or \
+                request.method not in ('GET', 'HEAD'):
+            return primary
+
+        replica = self.info.get('replica')
+        if replica is None:
+            replicas = self.app.extensions.get('replicas')
+            replica = (replicas and replicas.engine()) or primary
+            self.info['replica'] = replica
+        return replica
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# Objects keep their loaded state after commit, so a created or updated
+# row can be formatted without being selected again
+db = RoutingSQLAlchemy(session_options={'expire_on_commit': False})
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    with an instrumented connection pool configured from DB_POOL_*
+    and the read replicas of replica_urls (DATABASE_REPLICA_URLS)
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path,
+             replica_urls=DATABASE_REPLICA_URLS):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
 
+    previous = app.extensions.get('replicas')
+    if previous is not None:
+        previous.dispose()
+    app.extensions['replicas'] = None
+    if replica_urls:
+        app.extensions['replicas'] = ReplicaSet(
+            replica_urls, engine_options(replica_urls[0]))
+
+
+def engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+# SQLite enforces foreign keys, and so the ON DELETE CASCADE of movie_actor
+# that deletes rely on, only on connections that turn them on. Listened on
+# every engine: the app, replica stand-ins and the search fallback.
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+# Keys of Actor.format() and Movie.format(), in output order
+ACTOR_FIELDS = ('id', 'name', 'gender', 'age')
+MOVIE_FIELDS = ('id', 'title', 'release_date', 'selected_actors')
+
 
 '''
 Actor_Movie
@@ -40,6 +139,12 @@ Actor_Movie
 
 class Movie_Actor(db.Model):
     __tablename__ = 'movie_actor'
+    __table_args__ = (
+        db.UniqueConstraint(
+            'movie_id', 'actor_id',
+            name='uq_movie_actor_movie_id_actor_id'),
+        db.Index('ix_movie_actor_actor_id_movie_id', 'actor_id', 'movie_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     actor_id = db.Column(
@@ -61,11 +166,10 @@ class Movie_Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
 
 
 '''
@@ -76,6 +180,11 @@ Movie
 
 class Movie(db.Model):
     __tablename__ = 'movies'
+    # Serve the filters and sorts of GET /movies (see listing.py)
+    __table_args__ = (
+        db.Index('ix_movies_release_date_id', 'release_date', 'id'),
+        db.Index('ix_movies_title_id', 'title', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
@@ -83,6 +192,7 @@ class Movie(db.Model):
     movie_actors = db.relationship(
         'Movie_Actor',
         cascade="all, delete",
+        passive_deletes=True,
         backref='movies',
         lazy=True)
 
@@ -90,42 +200,76 @@ class Movie(db.Model):
         self.title = title
         self.release_date = release_date
 
+    @validates('release_date')
+    def validate_release_date(self, key, release_date):
+        # Keep a date, as loaded from the database, for format(); a time
+        # part ('1997-07-25T00:00:00') is accepted and dropped
+        if isinstance(release_date, str):
+            return datetime.datetime.fromisoformat(release_date).date()
+        if isinstance(release_date, datetime.datetime):
+            return release_date.date()
+        return release_date
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.add(self)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
-
-    def format(self):
-        # Get actor detais for the movie
-        selected_actors = []
-        actors_info = db.session.query(
-            Actor.id, Actor.name).filter(
-            Movie_Actor.movie_id == self.id,
-            Movie_Actor.actor_id == Actor.id).order_by(
-            Actor.id).all()
-        for actor in actors_info:
-            selected_actors.append({
-                "id": actor.id,
-                "name": actor.name
-            })
-
-        # set release date in format
-        formatDate = "EEEE, dd MMMM YYYY"
-        format_release_date = babel.dates.format_date(
-            self.release_date, formatDate)
-
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': format_release_date,
-            'selected_actors': selected_actors
-        }
+
+    @classmethod
+    def delete_by_id(cls, movie_id):
+        '''stages the delete of one movie, returns its row or None'''
+        rows = delete_returning(cls.__table__, cls.id == movie_id)
+        return rows[0] if rows else None
+
+    def set_actors(self, actor_ids):
+        '''
+        stages the movie_actor changes that make the cast of this movie
+        exactly actor_ids: one bulk DELETE for the removed actors and one
+        multi-row INSERT for the added ones, nothing when the cast is
+        unchanged. Committed with the movie by the unit of work.
+        returns how many actors the cast gained, negative when it shrank
+        '''
+        current = {movie_actor.actor_id for movie_actor in db.session.query(
+            Movie_Actor.actor_id).filter(Movie_Actor.movie_id == self.id)}
+        wanted = set(actor_ids)
+
+        removed = current - wanted
+        if removed:
+            Movie_Actor.query.filter(
+                Movie_Actor.movie_id == self.id,
+                Movie_Actor.actor_id.in_(removed)).delete(
+                synchronize_session=False)
+
+        added = wanted - current
+        if added:
+            db.session.execute(Movie_Actor.__table__.insert().values([
+                {'movie_id': self.id, 'actor_id': actor_id}
+                for actor_id in sorted(added)]))
+
+        return len(added) - len(removed)
+
+    def format(self, selected_actors=None, locale=None, fields=MOVIE_FIELDS):
+        movie = {field: getattr(self, field)
+                 for field in fields if field in ('id', 'title')}
+
+        # set release date in format "EEEE, dd MMMM YYYY"
+        if 'release_date' in fields:
+            movie['release_date'] = release_dates.format(
+                self.release_date, locale)
+
+        # Get actor detais for the movie unless they were batch loaded,
+        # the cast is not read at all when it is not asked for
+        if 'selected_actors' in fields:
+            if selected_actors is None:
+                selected_actors = load_casts([self.id])[self.id]
+            movie['selected_actors'] = selected_actors
+
+        return movie
 
 
 '''
@@ -136,6 +280,12 @@ Actor
 
 class Actor(db.Model):
     __tablename__ = 'actors'
+    # Serve the filters and sorts of GET /actors (see listing.py)
+    __table_args__ = (
+        db.Index('ix_actors_age_id', 'age', 'id'),
+        db.Index('ix_actors_gender_age_id', 'gender', 'age', 'id'),
+        db.Index('ix_actors_name_id', 'name', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -144,6 +294,7 @@ class Actor(db.Model):
     movie_actors = db.relationship(
         'Movie_Actor',
         cascade="all, delete",
+        passive_deletes=True,
         backref='actors',
         lazy=True)
 
@@ -152,21 +303,219 @@ class Actor(db.Model):
         self.gender = gender
         self.age = age
 
+    @validates('age')
+    def validate_age(self, key, age):
+        # Keep an int, as loaded from the database, for the statistics;
+        # clients may send the age as a string. Raises ValueError when it
+        # is not a number.
+        if isinstance(age, str):
+            return int(age)
+        return age
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
 
     def update(self):
-        db.session.commit()
+        db.session.add(self)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
-
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'gender': self.gender,
-            'age': self.age
-        }
+
+    @classmethod
+    def delete_by_id(cls, actor_id):
+        '''stages the delete of one actor, returns its row or None'''
+        rows = delete_returning(cls.__table__, cls.id == actor_id)
+        return rows[0] if rows else None
+
+    def format(self, fields=ACTOR_FIELDS):
+        return {field: getattr(self, field) for field in fields}
+
+
+'''
+unit_of_work()
+    the transaction of a request: insert(), update() and delete() only
+    stage their changes (insert() flushes so the new id is known), the
+    block commits them all once when it ends or rolls them all back when
+    it raises. A nested block joins the outermost one.
+'''
+
+
+@contextmanager
+def unit_of_work():
+    depth = db.session.info.get('unit_of_work', 0)
+    db.session.info['unit_of_work'] = depth + 1
+    # reads in a unit of work see its writes
+    db.session.info['primary'] = True
+    try:
+        yield db.session
+        if depth == 0:
+            db.session.commit()
+    except BaseException:
+        if depth == 0:
+            db.session.rollback()
+        raise
+    finally:
+        db.session.info['unit_of_work'] = depth
+
+
+'''
+Resource_Version
+
+'''
+# Change counter of a collection ('actors') or an item ('actors/5'), bumped
+# in the same transaction as every write so all workers agree on it
+
+
+class Resource_Version(db.Model):
+    __tablename__ = 'resource_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+'''
+Catalog_Stat
+
+'''
+# One counter of GET /stats, e.g. ('actors_by_gender', 'Female'), kept up
+# to date by the write handlers and rebuilt from the tables (see stats.py)
+
+
+class Catalog_Stat(db.Model):
+    __tablename__ = 'catalog_stats'
+
+    metric = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+'''
+bump_versions(*names)
+    stages a version increment of every resource in names, committed
+    together with the write that changed them, with one upsert on
+    PostgreSQL however many names there are
+'''
+
+
+def bump_versions(*names):
+    table = Resource_Version.__table__
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if not names:
+        return
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # rows are locked in name order, as in the loop below
+        db.session.execute(pg_insert(table).values([
+            {'name': name, 'version': 1, 'updated_at': now}
+            for name in sorted(set(names))]).on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={'version': table.c.version + 1, 'updated_at': now}))
+    else:
+        for name in sorted(set(names)):
+            updated = db.session.execute(table.update().where(
+                table.c.name == name).values(
+                version=table.c.version + 1, updated_at=now))
+            if updated.rowcount == 0:
+                db.session.execute(table.insert().values(
+                    name=name, version=1, updated_at=now))
+
+    # Read by the response cache to invalidate these resources on commit
+    db.session.info.setdefault('bumped_versions', set()).update(names)
+
+
+'''
+get_versions(names)
+    returns {name: (version, updated_at)} with one primary key lookup,
+    a resource that was never written has version 0 and no updated_at
+'''
+
+
+def get_versions(names):
+    versions = {name: (0, None) for name in names}
+    rows = db.session.query(Resource_Version).filter(
+        Resource_Version.name.in_(list(versions))).all()
+    for row in rows:
+        versions[row.name] = (row.version, row.updated_at)
+    return versions
+
+
+'''
+load_casts(movie_ids)
+    returns the selected actors of every movie in movie_ids, keyed by
+    movie id, using a single query for the whole batch
+'''
+
+
+def load_casts(movie_ids):
+    casts = {movie_id: [] for movie_id in movie_ids}
+    if not casts:
+        return casts
+
+    actors_info = db.session.query(
+        Movie_Actor.movie_id, Actor.id, Actor.name).filter(
+        Movie_Actor.movie_id.in_(list(casts)),
+        Movie_Actor.actor_id == Actor.id).order_by(
+        Movie_Actor.movie_id, Actor.id).all()
+    for actor in actors_info:
+        casts[actor.movie_id].append({
+            "id": actor.id,
+            "name": actor.name
+        })
+    return casts
+
+
+'''
+format_movies(movies, locale=None, fields=MOVIE_FIELDS)
+    formats a list of movies with their casts loaded in one batch and
+    their release dates in locale (the server locale when None)
+    only the given fields are returned, the casts are only loaded when
+    selected_actors is one of them
+'''
+
+
+def format_movies(movies, locale=None, fields=MOVIE_FIELDS):
+    casts = {}
+    if 'selected_actors' in fields:
+        casts = load_casts([movie.id for movie in movies])
+    return [movie.format(casts.get(movie.id), locale, fields)
+            for movie in movies]
+
+
+'''
+insert_rows(table, rows)
+    inserts rows (a list of column dicts) into table with one multi-row
+    INSERT ... RETURNING id, returns the new ids in the order of rows
+'''
+
+
+def insert_rows(table, rows):
+    if not rows:
+        return []
+    if db.session.get_bind().dialect.name != 'postgresql':
+        # No RETURNING on the test engines, insert row by row
+        return [db.session.execute(table.insert().values(row))
+                .inserted_primary_key[0] for row in rows]
+    result = db.session.execute(
+        table.insert().values(rows).returning(table.c.id))
+    return [row.id for row in result]
+
+
+'''
+delete_returning(table, condition)
+    deletes the rows of table matching condition with one
+    DELETE ... RETURNING and returns the deleted rows. Their movie_actor
+    rows are removed by the ON DELETE CASCADE of the foreign keys, never
+    loaded into the session.
+'''
+
+
+def delete_returning(table, condition):
+    if db.session.get_bind().dialect.name != 'postgresql':
+        # No RETURNING on the test engines, read the rows first
+        rows = db.session.execute(select([table]).where(condition)).fetchall()
+        if rows:
+            db.session.execute(table.delete().where(condition))
+        return rows
+    return db.session.execute(
+        table.delete().where(condition).returning(*table.c)).fetchall()
@@ -0,0 +1,67 @@
+import os
+import json
+import base64
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+'''
+Keyset Pagination
+    pages start after the last row of the previous page (by id, or by the
+    sort column and id, see Listing.paginate in listing.py) instead of
+    skipping rows with OFFSET, so a deep page costs the same index range
+    scan as the first one. The position is handed to clients as an opaque
+    cursor; this module encodes and decodes it and reads the page size.
+'''
+
+
+def encode_cursor(position):
+    data = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except Exception:
+        raise ValueError('Invalid cursor.')
+    if not isinstance(position, dict):
+        raise ValueError('Invalid cursor.')
+    return position
+
+
+'''
+page_args(args)
+    reads limit and cursor from the request arguments
+    raises ValueError when either is malformed
+    returns the page size and the last id of the previous page (or None)
+'''
+
+
+def page_args(args):
+    limit = args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid limit.')
+    if limit < 1:
+        raise ValueError('Invalid limit.')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    last_id = None
+    cursor = args.get('cursor')
+    if cursor:
+        last_id = decode_cursor(cursor).get('id')
+        # bool is an int too, {"id": true} is not a position
+        if not isinstance(last_id, int) or isinstance(last_id, bool):
+            raise ValueError('Invalid cursor.')
+    return limit, last_id
+
+
+def wants_all(args):
+    return args.get('all', '').lower() in ('1', 'true', 'yes')
+
+
+def wants_stream(args):
+    return args.get('stream', '').lower() in ('1', 'true', 'yes')
@@ -0,0 +1,108 @@
+import os
+
+from sqlalchemy import func
+
+from models import db, Actor, Movie, Movie_Actor
+from pagination import encode_cursor, page_args
+
+# Most actors or movies a batched request may ask for
+RELATION_MAX_IDS = int(os.environ.get('RELATION_MAX_IDS', 100))
+
+'''
+Relation
+    one direction of the movie_actor many-to-many: the movies of an actor
+    (filmography) or the actors of a movie (cast)
+
+    Pages are read from movie_actor joined to the related table, ordered
+    by the related id, so one owner is a range scan of the
+    ix_movie_actor_actor_id_movie_id index (filmography) or of the
+    uq_movie_actor_movie_id_actor_id constraint (cast). The cursor of a
+    page is the last related id, as on the list endpoints.
+'''
+
+
+class Relation:
+    def __init__(self, owner, target, owner_key, target_key):
+        self.owner = owner
+        self.target = target
+        self.owner_key = owner_key
+        self.target_key = target_key
+
+    def page(self, owner_id, limit, last_id=None):
+        '''
+        returns one page of the related rows of owner_id and the cursor of
+        the next page, or None when owner_id does not exist
+        '''
+        query = db.session.query(self.target).join(
+            Movie_Actor, self.target_key == self.target.id).filter(
+            self.owner_key == owner_id)
+        if last_id is not None:
+            query = query.filter(self.target_key > last_id)
+        rows = query.order_by(self.target_key).limit(limit + 1).all()
+
+        # an empty page is either the end of the list or an unknown owner
+        if not rows and db.session.query(self.owner.id).filter(
+                self.owner.id == owner_id).scalar() is None:
+            return None
+        return _page(rows, limit)
+
+    def pages(self, owner_ids, limit):
+        '''
+        returns {owner id: (first page, next cursor)} for every id of
+        owner_ids with one query, numbering the links of each owner with
+        row_number() and keeping the first limit + 1 of them
+        '''
+        ranked = db.session.query(
+            self.owner_key.label('owner_id'),
+            self.target_key.label('target_id'),
+            func.row_number().over(
+                partition_by=self.owner_key,
+                order_by=self.target_key).label('position')).filter(
+            self.owner_key.in_(owner_ids)).subquery()
+        rows = db.session.query(ranked.c.owner_id, self.target).join(
+            self.target, self.target.id == ranked.c.target_id).filter(
+            ranked.c.position <= limit + 1).order_by(
+            ranked.c.owner_id, ranked.c.target_id).all()
+
+        related = {owner_id: [] for owner_id in owner_ids}
+        for owner_id, target in rows:
+            related[owner_id].append(target)
+        return {owner_id: _page(targets, limit)
+                for owner_id, targets in related.items()}
+
+
+def _page(rows, limit):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor({'id': rows[-1].id})
+    return rows, next_cursor
+
+
+'''
+relation_ids(args)
+    reads the comma separated ids argument of a batched request
+    raises ValueError when it is missing, malformed or too long
+    returns the distinct ids in the order given
+'''
+
+
+def relation_ids(args):
+    try:
+        ids = [int(value) for value in args.get('ids', '').split(',')]
+    except ValueError:
+        raise ValueError('Invalid ids.')
+    ids = list(dict.fromkeys(ids))
+    if not 0 < len(ids) <= RELATION_MAX_IDS or min(ids) < 1:
+        raise ValueError('Invalid ids.')
+    if args.get('cursor'):
+        # the next pages are read one owner at a time
+        raise ValueError('Invalid cursor.')
+    limit, _ = page_args(args)
+    return ids, limit
+
+
+filmography = Relation(Actor, Movie, Movie_Actor.actor_id,
+                       Movie_Actor.movie_id)
+
+cast = Relation(Movie, Actor, Movie_Actor.movie_id, Movie_Actor.actor_id)
@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+import itertools
+
+from sqlalchemy import create_engine, event, text
+
+from metrics import pool_stats
+
+# Read replicas for the GET endpoints, a comma separated list of database
+# URLs. A replica is checked at most every REPLICA_CHECK_INTERVAL seconds
+# and left out while it cannot be reached or replays more than
+# REPLICA_MAX_LAG seconds behind the primary.
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.environ.get(
+        'DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+
+# Seconds the standby is behind, 0 when it has replayed all it received
+# (an idle primary sends nothing, so the last replay time alone would grow)
+LAG_QUERY = text('''
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+''')
+
+'''
+Replica
+    one replica engine and the result of its last health check
+'''
+
+
+class Replica:
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.lag = None
+        self.error = None
+        self.checked = None
+
+    def stats(self):
+        return {
+            'url': repr(self.engine.url),
+            'healthy': self.healthy,
+            'lag_seconds': self.lag,
+            'error': self.error,
+            'checked_seconds_ago': None if self.checked is None else round(
+                time.monotonic() - self.checked, 3),
+            'pool': pool_stats(self.engine)
+        }
+
+
+'''
+ReplicaSet
+    the replicas reads may be sent to, picked round robin among the healthy
+    ones
+
+    a replica due for a check is checked by the first request that picks
+    it, the others keep its last result meanwhile. A replica whose
+    connection fails is left out at once until its next check succeeds.
+'''
+
+
+class ReplicaSet:
+    def __init__(self, urls, engine_options=None, max_lag=REPLICA_MAX_LAG,
+                 check_interval=REPLICA_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.replicas = []
+        for url in urls:
+            engine = create_engine(url, **(engine_options or {}))
+            replica = Replica(engine)
+            event.listen(engine, 'handle_error',
+                         lambda context, replica=replica:
+                         self._on_error(replica, context))
+            self.replicas.append(replica)
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def engine(self):
+        '''returns the engine of a healthy replica, None when there is none'''
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._turn) % len(self.replicas)]
+            if self._due(replica) and self._lock.acquire(blocking=False):
+                try:
+                    self.check(replica)
+                finally:
+                    self._lock.release()
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as connection:
+                if connection.dialect.name == 'postgresql':
+                    replica.lag = float(connection.scalar(LAG_QUERY) or 0)
+                else:
+                    # stand-in databases (SQLite files) do not replicate
+                    connection.scalar(text('SELECT 1'))
+                    replica.lag = 0.0
+            replica.error = None
+            replica.healthy = replica.lag <= self.max_lag
+        except Exception as error:
+            replica.error = str(error).splitlines()[0]
+            replica.healthy = False
+        replica.checked = time.monotonic()
+
+    def stats(self):
+        return [replica.stats() for replica in self.replicas]
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def _due(self, replica):
+        return (replica.checked is None or
+                time.monotonic() - replica.checked >= self.check_interval)
+
+    def _on_error(self, replica, context):
+        # a lost or refused connection, not an error in the statement
+        if context.is_disconnect or context.connection is None:
+            replica.healthy = False
+            replica.error = str(context.original_exception).splitlines()[0]
+            replica.checked = time.monotonic()
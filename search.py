@@ -0,0 +1,154 @@
+import os
+
+from sqlalchemy import (Float, case, cast, collate, func, literal, or_,
+                        select, tuple_, union_all)
+
+from models import db, Actor, Movie
+from pagination import decode_cursor, encode_cursor, page_args
+
+SEARCH_MAX_LENGTH = int(os.environ.get('SEARCH_MAX_LENGTH', 100))
+# shorter queries have no trigram to look up and are matched as prefixes
+SEARCH_MIN_FUZZY_LENGTH = 3
+SEARCH_TYPES = ('actors', 'movies')
+
+'''
+Search
+    Actor.name and Movie.title are matched case insensitively and returned
+    in one list of {"type", "id", "name" or "title"} items
+
+    prefix (type-ahead) search returns names starting with q in
+    alphabetical order, read from the btree index on lower(name) COLLATE
+    "C". Fuzzy search returns names containing q or similar to it
+    (pg_trgm), found through the trigram GIN index and ranked exact match
+    first, then prefix matches, then by similarity. SQLite, used by the
+    tests, has no pg_trgm: fuzzy search there is a substring match.
+
+    Pages are keyset pages over (sort key, type, id) with an opaque cursor.
+    The sort key is the name for a prefix search and the rank for a fuzzy
+    one, so the cursor records which of the two it belongs to.
+'''
+
+_SEARCHED = (
+    ('actor', 'actors', Actor, 'name'),
+    ('movie', 'movies', Movie, 'title')
+)
+
+
+'''
+search_args(args)
+    reads q, prefix, type, limit and cursor from the request arguments
+    raises ValueError when any of them is malformed
+    returns (q, prefix, types, limit, position)
+'''
+
+
+def search_args(args):
+    q = args.get('q', '').strip()
+    if not q or len(q) > SEARCH_MAX_LENGTH:
+        raise ValueError('Invalid q.')
+    prefix = (args.get('prefix', '').lower() in ('1', 'true', 'yes') or
+              len(q) < SEARCH_MIN_FUZZY_LENGTH)
+
+    types = SEARCH_TYPES
+    if args.get('type'):
+        types = tuple(args['type'].split(','))
+        if not set(types) <= set(SEARCH_TYPES):
+            raise ValueError('Invalid type.')
+
+    limit, last_id = page_args(args)
+    position = None
+    if last_id is not None:
+        position = decode_cursor(args['cursor'])
+        # a name for a prefix search, a rank for a fuzzy one
+        sort_type = str if prefix else (int, float)
+        if (position.get('m') != _mode(prefix) or
+                not isinstance(position.get('t'), str) or
+                not isinstance(position.get('s'), sort_type) or
+                isinstance(position.get('s'), bool)):
+            raise ValueError('Invalid cursor.')
+    return q, prefix, types, limit, position
+
+
+'''
+search(q, prefix, types, limit, position)
+    returns one page of results and the cursor of the next page, or None
+    when this is the last page
+'''
+
+
+def search(q, prefix, types, limit, position=None):
+    postgresql = db.session.get_bind().dialect.name == 'postgresql'
+    prefix = prefix or len(q) < SEARCH_MIN_FUZZY_LENGTH
+
+    branches = []
+    for kind, name, model, field in _SEARCHED:
+        if name not in types:
+            continue
+        column = getattr(model, field)
+        sort, match = _matching(column, q.lower(), prefix, postgresql)
+        query = select([literal(kind).label('type'), model.id,
+                        column.label('label'), sort.label('sort')]).where(
+            match)
+        if position is not None:
+            query = query.where(_after(kind, sort, model.id, position))
+        # each branch stops at one page, from its index when prefix
+        branches.append(query.order_by(sort, model.id).limit(limit + 1))
+
+    results = union_all(*[branch.alias().select() for branch in branches])
+    results = results.alias('results')
+    rows = db.session.execute(
+        select([results]).order_by(results.c.sort, results.c.type,
+                                   results.c.id).limit(limit + 1)).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor({'m': _mode(prefix), 's': last.sort,
+                                     't': last.type, 'id': last.id})
+    return [_format(row) for row in rows], next_cursor
+
+
+def _mode(prefix):
+    return 'prefix' if prefix else 'fuzzy'
+
+
+def _matching(column, q, prefix, postgresql):
+    lowered = func.lower(column)
+    pattern = escape_like(q)
+    if prefix:
+        if postgresql:
+            # matches ix_*_lower_c, whose order is the byte order LIKE needs
+            lowered = collate(lowered, 'C')
+        return lowered, lowered.like(pattern + '%', escape='\\')
+
+    rank = (case([(lowered == q, 3.0)], else_=0.0) +
+            case([(lowered.like(pattern + '%', escape='\\'), 2.0)],
+                 else_=0.0))
+    # substring and similarity both use the trigram index on lower()
+    match = lowered.like('%' + pattern + '%', escape='\\')
+    if postgresql:
+        # pg_trgm's % operator, doubled for psycopg2's paramstyle
+        match = or_(match, lowered.op('%%')(q))
+        rank = rank + func.similarity(lowered, q)
+    # the best match sorts first
+    return cast(-rank, Float), match
+
+
+def _after(kind, sort, id_column, position):
+    last_sort, last_type = position['s'], position['t']
+    if kind > last_type:
+        return sort >= last_sort
+    if kind < last_type:
+        return sort > last_sort
+    return tuple_(sort, id_column) > tuple_(last_sort, position['id'])
+
+
+def escape_like(value):
+    return (value.replace('\\', '\\\\').replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _format(row):
+    field = 'name' if row.type == 'actor' else 'title'
+    return {'type': row.type, 'id': row.id, field: row.label}
@@ -0,0 +1,235 @@
+import os
+import time
+import datetime
+import logging
+import threading
+from collections import Counter
+
+from sqlalchemy import event, extract, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import (db, Actor, Movie, Movie_Actor, Catalog_Stat,
+                    bump_versions, unit_of_work)
+
+# Seconds between full rebuilds of the counters, started by GET /stats
+STATS_REBUILD_INTERVAL = float(os.environ.get('STATS_REBUILD_INTERVAL', 3600))
+AGE_BUCKET_SIZE = 10
+# PostgreSQL advisory lock held by the worker rebuilding the counters
+REBUILD_LOCK_KEY = 0x5ca7
+
+logger = logging.getLogger(__name__)
+
+'''
+Catalog Statistics
+    GET /stats reads a few hundred counters from catalog_stats, whatever
+    the size of the catalog: actors by gender and by age bucket, movies by
+    release year, and the movie_actor links for the average cast size.
+
+    The write handlers stage the changes of the rows they add, update or
+    delete with stage_rows() and stage_links(); the staged deltas of a
+    transaction are added to the counters with one upsert when it commits
+    and dropped when it rolls back. rebuild_stats() recounts everything
+    from the tables, to correct drift (writes made outside the handlers),
+    at most every STATS_REBUILD_INTERVAL seconds.
+'''
+
+
+def age_bucket(age):
+    if age is None:
+        return 'unknown'
+    low = age // AGE_BUCKET_SIZE * AGE_BUCKET_SIZE
+    return '%d-%d' % (low, low + AGE_BUCKET_SIZE - 1)
+
+
+def year_bucket(year):
+    return 'unknown' if year is None else str(int(year))
+
+
+def _field(row, key):
+    return row[key] if isinstance(row, dict) else getattr(row, key)
+
+
+def _buckets(model, row):
+    if model is Actor:
+        return [('actors', 'total'),
+                ('actors_by_gender', _field(row, 'gender') or 'unknown'),
+                ('actors_by_age', age_bucket(_field(row, 'age')))]
+    release_date = _field(row, 'release_date')
+    return [('movies', 'total'),
+            ('movies_by_release_year',
+             year_bucket(release_date and release_date.year))]
+
+
+def _staged():
+    return db.session.info.setdefault('catalog_stats', Counter())
+
+
+def stage_rows(model, rows, sign=1):
+    '''
+    stages the counters of actors or movies (objects, dicts or result
+    rows) being added, sign 1, or removed, sign -1
+    '''
+    staged = _staged()
+    for row in rows:
+        for key in _buckets(model, row):
+            staged[key] += sign
+
+
+def stage_links(count):
+    '''stages count movie_actor links added, removed when negative'''
+    _staged()[('cast', 'links')] += count
+
+
+def count_links(model, condition):
+    '''
+    returns the movie_actor links of the actors or movies matching
+    condition, to be counted before a delete cascades them
+    '''
+    column = Movie_Actor.actor_id if model is Actor else Movie_Actor.movie_id
+    return db.session.query(func.count()).select_from(Movie_Actor).filter(
+        column.in_(select([model.id]).where(condition))).scalar()
+
+
+def _apply_staged(session):
+    staged = session.info.pop('catalog_stats', None) or {}
+    rows = [{'metric': metric, 'bucket': bucket, 'value': value}
+            for (metric, bucket), value in sorted(staged.items()) if value]
+    if not rows:
+        return
+    table = Catalog_Stat.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        # rows are locked in key order, as in the loop below
+        insert = pg_insert(table).values(rows)
+        session.execute(insert.on_conflict_do_update(
+            index_elements=[table.c.metric, table.c.bucket],
+            set_={'value': table.c.value + insert.excluded.value}))
+        return
+
+    for row in rows:
+        updated = session.execute(table.update().where(
+            (table.c.metric == row['metric']) &
+            (table.c.bucket == row['bucket'])).values(
+            value=table.c.value + row['value']))
+        if updated.rowcount == 0:
+            session.execute(table.insert().values(row))
+
+
+def _discard_staged(session):
+    session.info.pop('catalog_stats', None)
+
+
+event.listen(db.session, 'before_commit', _apply_staged)
+event.listen(db.session, 'after_rollback', _discard_staged)
+
+
+'''
+rebuild_stats()
+    replaces the counters with a recount of the tables in the current
+    transaction, returns False without doing anything when another worker
+    is rebuilding them (advisory lock, PostgreSQL)
+'''
+
+
+def rebuild_stats():
+    if db.session.get_bind().dialect.name == 'postgresql':
+        locked = db.session.execute(select([
+            func.pg_try_advisory_xact_lock(REBUILD_LOCK_KEY)])).scalar()
+        if not locked:
+            return False
+
+    # the recount already sees the writes of this transaction
+    _discard_staged(db.session)
+    counts = Counter()
+    for gender, age, count in db.session.query(
+            Actor.gender, Actor.age, func.count()).group_by(
+            Actor.gender, Actor.age):
+        for key in _buckets(Actor, {'gender': gender, 'age': age}):
+            counts[key] += count
+
+    year = extract('year', Movie.release_date)
+    for release_year, count in db.session.query(
+            year, func.count()).group_by(year):
+        counts[('movies', 'total')] += count
+        counts[('movies_by_release_year', year_bucket(release_year))] += count
+
+    counts[('cast', 'links')] = db.session.query(
+        func.count()).select_from(Movie_Actor).scalar()
+    counts[('meta', 'rebuilt_at')] = int(time.time())
+
+    table = Catalog_Stat.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert(), [
+        {'metric': metric, 'bucket': bucket, 'value': value}
+        for (metric, bucket), value in sorted(counts.items())])
+    bump_versions('stats')
+    return True
+
+
+'''
+read_stats()
+    returns the GET /stats document and the time of the last rebuild in
+    seconds since the epoch, None when the counters were never built
+'''
+
+
+def read_stats():
+    counters = {}
+    for row in db.session.query(Catalog_Stat):
+        counters.setdefault(row.metric, {})[row.bucket] = row.value
+
+    rebuilt_at = counters.pop('meta', {}).get('rebuilt_at')
+    movies = counters.get('movies', {}).get('total', 0)
+    links = counters.get('cast', {}).get('links', 0)
+
+    def buckets(metric):
+        return {bucket: value for bucket, value in
+                sorted(counters.get(metric, {}).items()) if value}
+
+    stats = {
+        'actors': {
+            'total': counters.get('actors', {}).get('total', 0),
+            'by_gender': buckets('actors_by_gender'),
+            'by_age': buckets('actors_by_age')
+        },
+        'movies': {
+            'total': movies,
+            'by_release_year': buckets('movies_by_release_year')
+        },
+        'cast': {
+            'links': links,
+            'average_size': round(links / movies, 2) if movies else 0
+        },
+        'rebuilt_at': None if rebuilt_at is None else
+        datetime.datetime.fromtimestamp(
+            rebuilt_at, datetime.timezone.utc).isoformat()
+    }
+    return stats, rebuilt_at
+
+
+_rebuilding = threading.Lock()
+
+'''
+schedule_rebuild(app, rebuilt_at)
+    starts rebuild_stats() in a background thread when the last rebuild
+    is older than STATS_REBUILD_INTERVAL and this worker is not already
+    rebuilding, returns whether it did
+'''
+
+
+def schedule_rebuild(app, rebuilt_at):
+    if time.time() - rebuilt_at < STATS_REBUILD_INTERVAL:
+        return False
+    if not _rebuilding.acquire(blocking=False):
+        return False
+
+    def rebuild():
+        try:
+            with app.app_context(), unit_of_work():
+                rebuild_stats()
+        except Exception:
+            logger.exception('Unable to rebuild the catalog statistics')
+        finally:
+            _rebuilding.release()
+
+    threading.Thread(target=rebuild, daemon=True).start()
+    return True
@@ -0,0 +1,34 @@
+import os
+from itertools import islice
+
+from flask import json
+
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 1000))
+
+'''
+stream_json_list(key, query, format_rows, chunk_size)
+    generator of the JSON document {key: [...], "success": true}, the same
+    shape jsonify produces for the unpaginated lists
+
+    rows are fetched chunk_size at a time through a server-side cursor
+    (yield_per with stream_results) and each chunk is formatted with
+    format_rows and written out before the next one is fetched, so memory
+    stays flat whatever the size of the table
+'''
+
+
+def stream_json_list(key, query, format_rows, chunk_size=STREAM_CHUNK_SIZE):
+    rows = iter(query.execution_options(
+        stream_results=True).yield_per(chunk_size))
+
+    yield '{%s:[' % json.dumps(key)
+    separator = ''
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        items = [json.dumps(item, separators=(',', ':'))
+                 for item in format_rows(chunk)]
+        yield separator + ','.join(items)
+        separator = ','
+    yield '],"success":true}'
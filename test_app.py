@@ -1,15 +1,76 @@
 import os
 import unittest
 import json
+import datetime
+import tempfile
+import time
 import urllib.request
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask, request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
+from sqlalchemy import create_engine, event, exc
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 
 from app import create_app
-from models import setup_db, Actor, Movie, Movie_Actor
-from auth import AuthError, requires_auth
+from models import (setup_db, db, Actor, Movie, Movie_Actor, Catalog_Stat,
+                    Resource_Version, bump_versions, engine_options,
+                    format_movies, unit_of_work)
+from metrics import InstrumentedQueuePool, MetricsRegistry, pool_stats
+import formatting
+from babel.dates import format_date
+from formatting import DateFormatter, RELEASE_DATE_FORMAT, request_locale
+from pagination import encode_cursor
+from streaming import stream_json_list
+import stats
+from stats import read_stats, rebuild_stats
+from cache import (LocalCacheBackend, ResponseCache, SharedCacheBackend,
+                   response_cache)
+from auth import (AuthError, requires_auth, JWKSKeyStore, TokenCache,
+                  check_permissions, verify_signature)
+
+
+def generate_signing_key(kid):
+    """Return a private PEM and its public JWK for locally signed JWTs"""
+    private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()).decode('utf-8')
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+    public_jwk = jwk.construct(public_pem, 'RS256').to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+    return private_pem, public_jwk
+
+
+def write_jwks(path, *keys):
+    with open(path, 'w') as jwks_file:
+        json.dump({'keys': list(keys)}, jwks_file)
+
+
+@contextmanager
+def count_queries(app):
+    """Collect the SQL statements run against the app's engine"""
+    statements = []
+    with app.app_context():
+        engine = db.get_engine()
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
 
 
 class CapstoneTestCase(unittest.TestCase):
@@ -49,9 +110,13 @@ class CapstoneTestCase(unittest.TestCase):
                     'Authorization': "Bearer $DIRECTOR_TOKEN"
                     }
 
+        # Query behaviour is tested without the response cache in front
+        response_cache.enabled = False
+        response_cache.clear()
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        response_cache.enabled = True
 
     """
     @ADD
@@ -69,6 +134,191 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['actors'])
 
+    def test_get_actors_by_page(self):
+        res = self.client().get('/actors?limit=2')
+        data = json.loads(res.data)
+        first_ids = [actor['id'] for actor in data['actors']]
+
+        res = self.client().get(
+            '/actors?limit=2&cursor=%s' % data['next_cursor'])
+        next_page = json.loads(res.data)
+        next_ids = [actor['id'] for actor in next_page['actors']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(first_ids), 2)
+        self.assertTrue(next_ids)
+        self.assertTrue(min(next_ids) > max(first_ids))
+
+    def test_get_all_actors_unpaginated(self):
+        res = self.client().get('/actors?all=true')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['actors'])
+        self.assertNotIn('next_cursor', data)
+
+    def test_stream_actors_matches_full_list(self):
+        res = self.client().get('/actors?stream=true')
+        streamed = json.loads(res.data)
+        full = json.loads(self.client().get('/actors?all=true').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(streamed, full)
+
+    def test_filter_actors_by_gender_and_age(self):
+        res = self.client().get(
+            '/actors?all=true&gender=Female&age_min=30&age_max=56')
+        data = json.loads(res.data)
+        expected = [actor.id for actor in Actor.query.order_by(Actor.id)
+                    if actor.gender == 'Female' and actor.age is not None and
+                    30 <= actor.age <= 56]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], expected)
+
+    def test_sort_actors_by_age_descending_by_page(self):
+        with unit_of_work():
+            Actor(name='Ageless', gender='Female', age=None).insert()
+        ids = []
+        cursor = ''
+        while True:
+            res = self.client().get(
+                '/actors?sort=-age&limit=3' + cursor)
+            data = json.loads(res.data)
+            ids += [actor['id'] for actor in data['actors']]
+            if data['next_cursor'] is None:
+                break
+            cursor = '&cursor=' + data['next_cursor']
+        actors = Actor.query.all()
+        # NULL ages first, then the oldest, ties by id descending
+        expected = [actor.id for actor in sorted(
+            actors, key=lambda actor: (actor.age is not None,
+                                       -(actor.age or 0), -actor.id))]
+
+        self.assertEqual(ids, expected)
+        with unit_of_work():
+            Actor.query.filter(Actor.name == 'Ageless').first().delete()
+
+    def test_filter_movies_by_release_date_newest_first(self):
+        res = self.client().get(
+            '/movies?release_date_from=1995-01-01'
+            '&release_date_to=2005-12-31&sort=-release_date&limit=500')
+        data = json.loads(res.data)
+        movies = Movie.query.filter(
+            Movie.release_date.between(datetime.date(1995, 1, 1),
+                                       datetime.date(2005, 12, 31))).all()
+        expected = [movie.id for movie in sorted(
+            movies, key=lambda movie: (movie.release_date, movie.id),
+            reverse=True)]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], expected)
+
+    def test_filter_movies_by_title_prefix(self):
+        res = self.client().get('/movies?all=true&title_prefix=KIN')
+        data = json.loads(res.data)
+
+        self.assertTrue(data['movies'])
+        for movie in data['movies']:
+            self.assertTrue(movie['title'].lower().startswith('kin'))
+
+    def test_400_for_unknown_sort_or_filter_value(self):
+        for query in ('sort=gender', 'age_min=old', 'sort=--age'):
+            res = self.client().get('/actors?' + query)
+            self.assertEqual(res.status_code, 400)
+        res = self.client().get('/movies?release_date_from=2019')
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_for_boolean_cursor_id(self):
+        cursor = encode_cursor({'id': True})
+        for path in ('/actors', '/movies', '/actors/5/movies'):
+            res = self.client().get('%s?cursor=%s' % (path, cursor))
+            self.assertEqual(res.status_code, 400)
+
+    def test_400_for_cursor_of_another_sort(self):
+        res = self.client().get('/actors?sort=age&limit=1')
+        cursor = json.loads(res.data)['next_cursor']
+        res = self.client().get('/actors?sort=name&cursor=%s' % cursor)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_for_invalid_actors_cursor(self):
+        res = self.client().get('/actors?cursor=not-a-cursor')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_304_for_unchanged_actors(self):
+        res = self.client().get('/actors')
+        etag = res.headers['ETag']
+        with count_queries(self.app) as statements:
+            cached = self.client().get(
+                '/actors', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+
+    def test_actors_etag_changes_after_update(self):
+        etag = self.client().get('/actors').headers['ETag']
+        self.client().patch('actors/8', json={'age': 55},
+                            headers=self.executive_producer_jwt)
+        res = self.client().get('/actors', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertTrue(res.headers['Last-Modified'])
+
+    def test_update_bumps_only_collection_version(self):
+        self.client().patch('actors/8', json={'age': 55},
+                            headers=self.executive_producer_jwt)
+        names = [version.name for version in Resource_Version.query.all()]
+
+        self.assertIn('actors', names)
+        self.assertNotIn('actors/8', names)
+
+    def test_actors_served_from_response_cache(self):
+        response_cache.enabled = True
+        first = self.client().get('/actors?limit=3')
+        with count_queries(self.app) as statements:
+            second = self.client().get('/actors?limit=3')
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('resource_versions', statements[0])
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+
+    def test_actor_update_invalidates_response_cache(self):
+        response_cache.enabled = True
+        self.client().get('/actors?limit=500')
+        self.client().patch('actors/8', json={'age': 57},
+                            headers=self.executive_producer_jwt)
+        res = self.client().get('/actors?limit=500')
+        data = json.loads(res.data)
+        actor = [actor for actor in data['actors'] if actor['id'] == 8]
+
+        self.assertEqual(actor[0]['age'], 57)
+
+    def test_response_cache_sees_writes_of_other_workers(self):
+        response_cache.enabled = True
+        first = self.client().get('/actors?limit=500')
+        # written by another worker, this worker's entries are not dropped
+        with mock.patch.object(response_cache, 'invalidate'):
+            self.client().patch('actors/8', json={'age': 56},
+                                headers=self.executive_producer_jwt)
+        res = self.client().get('/actors?limit=500',
+                                headers={'If-None-Match':
+                                         first.headers['ETag']})
+        data = json.loads(res.data)
+        actor = [actor for actor in data['actors'] if actor['id'] == 8]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(actor[0]['age'], 56)
+
     def test_405_if_actor_not_found(self):
         res = self.client().get('/actors/35')
         data = json.loads(res.data)
@@ -86,6 +336,214 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['movies'])
 
+    def test_get_last_movies_page(self):
+        res = self.client().get('/movies?limit=500')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['movies'])
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_stream_movies_matches_full_list(self):
+        res = self.client().get('/movies?stream=true')
+        streamed = json.loads(res.data)
+        full = json.loads(self.client().get('/movies?all=true').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(streamed, full)
+
+    def test_stream_movies_in_small_chunks(self):
+        with self.app.app_context():
+            movies = ''.join(stream_json_list(
+                'movies', Movie.query.order_by(Movie.id), format_movies,
+                chunk_size=2))
+            full = json.loads(self.client().get('/movies?all=true').data)
+
+        self.assertEqual(json.loads(movies), full)
+
+    def test_400_for_invalid_movies_limit(self):
+        res = self.client().get('/movies?limit=0')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_movie_titles_skip_the_cast(self):
+        with count_queries(self.app) as statements:
+            res = self.client().get('/movies?fields=title')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['movies'])
+        for movie in data['movies']:
+            self.assertEqual(set(movie), {'id', 'title'})
+        self.assertFalse([statement for statement in statements
+                          if 'movie_actor' in statement])
+        self.assertFalse([statement for statement in statements
+                          if 'movies.release_date' in statement])
+
+    def test_movie_fields_with_cast(self):
+        res = self.client().get(
+            '/movies?fields=title&include=selected_actors')
+        titles = json.loads(res.data)['movies']
+        res = self.client().get('/movies?include=selected_actors')
+        full = json.loads(res.data)['movies']
+
+        self.assertEqual(set(titles[0]), {'id', 'title', 'selected_actors'})
+        self.assertEqual(set(full[0]),
+                         {'id', 'title', 'release_date', 'selected_actors'})
+
+    def test_actor_fields(self):
+        with count_queries(self.app) as statements:
+            res = self.client().get('/actors?fields=name,age&sort=age')
+        data = json.loads(res.data)
+
+        self.assertEqual(set(data['actors'][0]), {'id', 'name', 'age'})
+        self.assertFalse([statement for statement in statements
+                          if 'actors.gender' in statement])
+
+    def test_400_for_unknown_fields(self):
+        for path in ('/movies?fields=budget', '/actors?include=movies',
+                     '/actors?fields=selected_actors'):
+            res = self.client().get(path)
+            self.assertEqual(res.status_code, 400)
+
+    def add_filmography(self, movies):
+        """Add an actor cast in movies new movies, return their ids"""
+        with self.app.app_context(), unit_of_work():
+            actor = Actor(name='Filmography Actor', gender='Male', age=40)
+            actor.insert()
+            movie_ids = []
+            for number in range(movies):
+                movie = Movie(title='Film %d' % number,
+                              release_date=datetime.date(2020, 1, 1))
+                movie.insert()
+                Movie_Actor(actor_id=actor.id, movie_id=movie.id).insert()
+                movie_ids.append(movie.id)
+        return actor.id, movie_ids
+
+    def remove_filmography(self, actor_id, movie_ids):
+        with self.app.app_context(), unit_of_work():
+            for movie_id in movie_ids:
+                Movie.query.get(movie_id).delete()
+            Actor.query.get(actor_id).delete()
+
+    def test_actor_movies_by_page(self):
+        actor_id, movie_ids = self.add_filmography(3)
+        res = self.client().get('/actors/%d/movies?limit=2' % actor_id)
+        first = json.loads(res.data)
+        res = self.client().get('/actors/%d/movies?limit=2&cursor=%s' % (
+            actor_id, first['next_cursor']))
+        second = json.loads(res.data)
+        self.remove_filmography(actor_id, movie_ids)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in first['movies']],
+                         movie_ids[:2])
+        self.assertEqual([movie['id'] for movie in second['movies']],
+                         movie_ids[2:])
+        self.assertEqual(second['next_cursor'], None)
+        self.assertEqual(set(first['movies'][0]),
+                         {'id', 'title', 'release_date'})
+
+    def test_movie_actors(self):
+        actor_id, movie_ids = self.add_filmography(1)
+        res = self.client().get('/movies/%d/actors' % movie_ids[0])
+        data = json.loads(res.data)
+        self.remove_filmography(actor_id, movie_ids)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie_id'], movie_ids[0])
+        self.assertEqual([actor['id'] for actor in data['actors']],
+                         [actor_id])
+        self.assertEqual(data['actors'][0]['name'], 'Filmography Actor')
+
+    def test_404_for_movies_of_unknown_actor(self):
+        res = self.client().get('/actors/100000/movies')
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get('/movies/100000/actors')
+        self.assertEqual(res.status_code, 404)
+
+    def test_filmographies_in_one_query(self):
+        actor_id, movie_ids = self.add_filmography(3)
+        with count_queries(self.app) as statements:
+            res = self.client().get(
+                '/actors/movies?ids=%d,100000&limit=2' % actor_id)
+        data = json.loads(res.data)
+        with count_queries(self.app) as statements_for_one:
+            self.client().get('/actors/movies?ids=%d' % actor_id)
+        self.remove_filmography(actor_id, movie_ids)
+
+        self.assertEqual(res.status_code, 200)
+        first, unknown = data['filmographies']
+        self.assertEqual(first['actor_id'], actor_id)
+        self.assertEqual([movie['id'] for movie in first['movies']],
+                         movie_ids[:2])
+        self.assertTrue(first['next_cursor'])
+        self.assertEqual(unknown, {'actor_id': 100000, 'movies': [],
+                                   'next_cursor': None})
+        self.assertEqual(len(statements), len(statements_for_one))
+
+    def test_casts_of_many_movies(self):
+        actor_id, movie_ids = self.add_filmography(2)
+        res = self.client().get('/movies/actors?ids=%d,%d' % tuple(
+            movie_ids))
+        data = json.loads(res.data)
+        self.remove_filmography(actor_id, movie_ids)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie_cast['movie_id']
+                          for movie_cast in data['casts']], movie_ids)
+        for movie_cast in data['casts']:
+            self.assertEqual([actor['id'] for actor in movie_cast['actors']],
+                             [actor_id])
+
+    def test_400_for_invalid_relation_ids(self):
+        for path in ('/actors/movies', '/actors/movies?ids=a',
+                     '/movies/actors?ids=0',
+                     '/movies/actors?ids=1&cursor=abc',
+                     '/movies/actors?ids=' + ','.join(
+                         str(movie_id) for movie_id in range(1, 200))):
+            res = self.client().get(path)
+            self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_query_count_is_constant(self):
+        with count_queries(self.app) as before:
+            self.client().get('/movies')
+
+        with self.app.app_context(), unit_of_work():
+            actor = Actor(name='Cast Member', gender='Female', age=30)
+            actor.insert()
+            actor_id = actor.id
+            movie_ids = []
+            for number in range(3):
+                movie = Movie(title='Sequel %d' % number,
+                              release_date=datetime.date(2021, 1, 1))
+                movie.insert()
+                Movie_Actor(actor_id=actor_id, movie_id=movie.id).insert()
+                movie_ids.append(movie.id)
+
+        with count_queries(self.app) as after:
+            res = self.client().get('/movies')
+
+        with self.app.app_context(), unit_of_work():
+            for movie_id in movie_ids:
+                Movie.query.get(movie_id).delete()
+            Actor.query.get(actor_id).delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(after), len(before))
+
+    def test_movies_etag_changes_after_actor_update(self):
+        etag = self.client().get('/movies').headers['ETag']
+        self.client().patch('actors/9', json={'age': 59},
+                            headers=self.executive_producer_jwt)
+        res = self.client().get('/movies', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
     def test_405_if_movie_not_found(self):
         res = self.client().get('/movies/35')
         data = json.loads(res.data)
@@ -105,6 +563,46 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['actors'])
         self.assertTrue(len(data['actors']))
 
+    def test_add_actor_runs_single_actor_statement(self):
+        with count_queries(self.app) as statements:
+            res = self.client().post('/actors', json=self.new_actor,
+                                     headers=self.executive_producer_jwt)
+        data = json.loads(res.data)
+        actor = Actor.query.get(data['actors']['id'])
+
+        actor_statements = [statement for statement in statements
+                            if 'actors' in statement.split('(')[0]]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(actor_statements), 1)
+        self.assertTrue(actor_statements[0].startswith('INSERT'))
+        self.assertEqual(actor.format(), data['actors'])
+
+    def test_parallel_add_actor_returns_own_row(self):
+        def add_actor(number):
+            res = self.app.test_client().post(
+                '/actors',
+                json={'name': 'Parallel %d' % number, 'age': 20 + number,
+                      'gender': 'Female'},
+                headers=self.executive_producer_jwt)
+            return number, json.loads(res.data)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(add_actor, range(16)))
+
+        created_ids = []
+        for number, data in results:
+            self.assertEqual(data['success'], True)
+            created_ids.append(data['actors']['id'])
+            actor = Actor.query.get(data['actors']['id'])
+            self.assertEqual(actor.name, 'Parallel %d' % number)
+            self.assertEqual(actor.age, 20 + number)
+        self.assertEqual(len(set(created_ids)), 16)
+
+        with unit_of_work():
+            for actor_id in created_ids:
+                Actor.query.get(actor_id).delete()
+
     def test_405_if_actor_addition_not_allowed(self):
         res = self.client().post('/actors/45', json=self.new_actor,
                                  headers=self.executive_producer_jwt)
@@ -113,6 +611,206 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'method not allowed')
 
+    # Run test to add Actors in bulk and Error occures
+
+    def test_add_actors_bulk(self):
+        res = self.client().post(
+            '/actors/bulk?batch_size=2',
+            json=[self.new_actor, {'name': '', 'age': 30},
+                  {'name': 'Kate Winslet', 'age': 45, 'gender': 'Female'}],
+            headers=self.executive_producer_jwt)
+        results = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['line'] for result in results[:3]],
+                         [1, 2, 3])
+        self.assertIn('id', results[0])
+        self.assertEqual(results[1]['error'], 'name is required.')
+        self.assertEqual(Actor.query.get(results[2]['id']).name,
+                         'Kate Winslet')
+        self.assertEqual(results[3], {'success': True, 'created': 2,
+                                      'failed': 1})
+
+        with unit_of_work():
+            for result in (results[0], results[2]):
+                Actor.query.get(result['id']).delete()
+
+    def test_add_movies_bulk_ndjson(self):
+        body = '\n'.join([
+            json.dumps(self.new_movie),
+            '{not json',
+            json.dumps({'title': 'Dune', 'release_date': '2021-10-22'})])
+        res = self.client().post(
+            '/movies/bulk', data=body, content_type='application/x-ndjson',
+            headers=self.executive_producer_jwt)
+        results = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(results[1], {'line': 2, 'error': 'Invalid JSON.'})
+        self.assertEqual(Movie.query.get(results[2]['id']).title, 'Dune')
+        self.assertEqual(results[3]['created'], 2)
+
+        with unit_of_work():
+            for result in (results[0], results[2]):
+                Movie.query.get(result['id']).delete()
+
+    def test_400_for_bulk_body_not_array(self):
+        res = self.client().post('/actors/bulk', json=self.new_actor,
+                                 headers=self.executive_producer_jwt)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_unauthorize_for_add_movies_bulk(self):
+        res = self.client().post('/movies/bulk', json=[self.new_movie],
+                                 headers=self.casting_director_jwt)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['message']['description'],
+                         'Permission not found.')
+
+    # Run test to search actors and movies and Error occures
+
+    def delete_rows(self, rows):
+        with unit_of_work():
+            for row in rows:
+                row.delete()
+
+    def add_search_rows(self):
+        rows = [Actor(name='Zyxq Jones', age=30, gender='Male'),
+                Actor(name='Zyxq', age=40, gender='Female'),
+                Movie(title='The Zyxq', release_date='2001-01-01')]
+        with unit_of_work():
+            for row in rows:
+                row.insert()
+        self.addCleanup(self.delete_rows, rows)
+        return [row.id for row in rows]
+
+    def test_search_ranks_exact_then_prefix_matches(self):
+        jones, zyxq, movie = self.add_search_rows()
+        res = self.client().get('/search?q=ZYXQ')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [
+            {'type': 'actor', 'id': zyxq, 'name': 'Zyxq'},
+            {'type': 'actor', 'id': jones, 'name': 'Zyxq Jones'},
+            {'type': 'movie', 'id': movie, 'title': 'The Zyxq'}])
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_search_prefix_by_page(self):
+        jones, zyxq, movie = self.add_search_rows()
+        res = self.client().get('/search?q=zyx&prefix=true&limit=1')
+        first = json.loads(res.data)
+        res = self.client().get('/search?q=zyx&prefix=true&limit=1'
+                                '&cursor=%s' % first['next_cursor'])
+        second = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([item['id'] for item in first['results']], [zyxq])
+        self.assertEqual([item['id'] for item in second['results']],
+                         [jones])
+        self.assertEqual(second['next_cursor'], None)
+
+    def test_400_for_search_cursor_of_another_mode(self):
+        self.add_search_rows()
+        res = self.client().get('/search?q=zyx&prefix=true&limit=1')
+        prefix_cursor = json.loads(res.data)['next_cursor']
+        res = self.client().get('/search?q=zyx&limit=1')
+        fuzzy_cursor = json.loads(res.data)['next_cursor']
+
+        fuzzy = self.client().get('/search?q=zyx&limit=1&cursor=%s' %
+                                  prefix_cursor)
+        prefix = self.client().get('/search?q=zyx&prefix=true&limit=1'
+                                   '&cursor=%s' % fuzzy_cursor)
+
+        self.assertTrue(prefix_cursor and fuzzy_cursor)
+        self.assertEqual(fuzzy.status_code, 400)
+        self.assertEqual(prefix.status_code, 400)
+
+    def test_search_movies_only(self):
+        jones, zyxq, movie = self.add_search_rows()
+        res = self.client().get('/search?q=zyxq&type=movies')
+        data = json.loads(res.data)
+
+        self.assertEqual([item['id'] for item in data['results']], [movie])
+
+    def test_400_for_search_without_q(self):
+        res = self.client().get('/search?q=%20')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
+    # Run test to export and import tables and Error occures
+
+    def test_export_actors_csv(self):
+        res = self.client().get('/export/actors',
+                                headers=self.executive_producer_jwt)
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,name,gender,age')
+        self.assertEqual(len(lines) - 1, Actor.query.count())
+
+    def test_export_movies_ndjson(self):
+        res = self.client().get('/export/movies?format=ndjson',
+                                headers=self.executive_producer_jwt)
+        records = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(record['id'] for record in records),
+                         sorted(movie.id for movie in Movie.query.all()))
+        self.assertEqual(set(records[0]), {'id', 'title', 'release_date'})
+
+    def test_import_actors_csv_upserts(self):
+        actor = Actor.query.order_by(Actor.id).first()
+        actor_id, name = actor.id, actor.name
+        new_id = Actor.query.order_by(Actor.id.desc()).first().id + 1000
+        body = 'id,name,gender,age\n%d,Renamed Actor,%s,%d\n' % (
+            actor_id, actor.gender, actor.age)
+        body += '%d,Imported Actor,,\n' % new_id
+        res = self.client().post('/import/actors', data=body,
+                                 headers=self.executive_producer_jwt)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['rows'], 2)
+        self.assertEqual(Actor.query.get(actor_id).name, 'Renamed Actor')
+        self.assertEqual(Actor.query.get(new_id).name, 'Imported Actor')
+
+        with unit_of_work():
+            Actor.query.get(new_id).delete()
+            actor = Actor.query.get(actor_id)
+            actor.name = name
+            actor.update()
+
+    def test_422_for_import_of_links_to_missing_rows(self):
+        links = Movie_Actor.query.count()
+        res = self.client().post(
+            '/import/movie_actor?format=ndjson',
+            data='{"id":1,"movie_id":100000,"actor_id":100000}\n',
+            headers=self.executive_producer_jwt)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['message'], 'unprocessable')
+        self.assertEqual(Movie_Actor.query.count(), links)
+
+    def test_import_needs_post_permission(self):
+        movies = Movie.query.count()
+        res = self.client().post(
+            '/import/movies', data='id,title,release_date\n100000,New,\n',
+            headers=self.casting_director_jwt)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(Movie.query.count(), movies)
+
+    def test_400_for_unknown_export_format(self):
+        res = self.client().get('/export/actors?format=xml',
+                                headers=self.executive_producer_jwt)
+        self.assertEqual(res.status_code, 400)
+
     # Run test to update Actor and Error occures
 
     def test_update_actor_age(self):
@@ -177,6 +875,24 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['movies'])
         self.assertTrue(len(data['movies']))
 
+    def test_add_movie_with_release_timestamp(self):
+        res = self.client().post(
+            '/movies', json={'title': 'Air Force One',
+                             'release_date': '1997-07-25T00:00:00'},
+            headers=self.executive_producer_jwt)
+        movie_id = json.loads(res.data)['movies']['id']
+        patched = self.client().patch(
+            '/movies/%d' % movie_id,
+            json={'release_date': '1997-07-26T12:30:00'},
+            headers=self.executive_producer_jwt)
+        release_date = Movie.query.get(movie_id).release_date
+        self.client().delete('/movies/%d' % movie_id,
+                             headers=self.executive_producer_jwt)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(patched.status_code, 200)
+        self.assertEqual(release_date, datetime.date(1997, 7, 26))
+
     def test_405_if_movie_addition_not_allowed(self):
         res = self.client().post('/movies/45', json=self.new_movie,
                                  headers=self.executive_producer_jwt)
@@ -228,6 +944,92 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(selected_actors, ['10', '11'])
 
+    def test_unchanged_cast_is_not_rewritten(self):
+        self.client().patch('movies/6', json={'selected_actors': ['10']},
+                            headers=self.casting_director_jwt)
+        with count_queries(self.app) as statements:
+            res = self.client().patch(
+                'movies/6', json={'selected_actors': ['10']},
+                headers=self.casting_director_jwt)
+        cast_writes = [statement for statement in statements
+                       if statement.lstrip().upper().startswith(
+                           ('INSERT', 'DELETE'))]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(cast_writes, [])
+
+    def test_title_update_keeps_cast(self):
+        self.client().patch('movies/6', json={'selected_actors': ['10']},
+                            headers=self.casting_director_jwt)
+        res = self.client().patch('movies/6', json={'title': 'Godzilla'},
+                                  headers=self.casting_director_jwt)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [actor['id'] for actor in data['movie'][0]['selected_actors']],
+            [10])
+
+    def test_failed_cast_update_is_rolled_back(self):
+        self.client().patch('movies/6', json={'selected_actors': ['10']},
+                            headers=self.casting_director_jwt)
+        res = self.client().patch(
+            'movies/6', json={'selected_actors': ['11', '100000']},
+            headers=self.casting_director_jwt)
+        movie_actors = Movie_Actor.query.filter(
+            Movie_Actor.movie_id == 6).all()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([movie_actor.actor_id
+                          for movie_actor in movie_actors], [10])
+
+    def test_write_endpoints_commit_once(self):
+        with self.app.app_context():
+            engine = db.get_engine()
+        commits = []
+
+        def commit(conn):
+            commits.append(1)
+
+        event.listen(engine, 'commit', commit)
+        try:
+            res = self.client().post('/movies', json=self.new_movie,
+                                     headers=self.executive_producer_jwt)
+            movie_id = json.loads(res.data)['movies']['id']
+            self.client().patch(
+                'movies/%d' % movie_id,
+                json={'title': 'Air Force Two', 'selected_actors': ['10']},
+                headers=self.casting_director_jwt)
+            self.client().delete('movies/%d' % movie_id,
+                                 headers=self.executive_producer_jwt)
+        finally:
+            event.remove(engine, 'commit', commit)
+
+        self.assertEqual(len(commits), 3)
+
+    def test_unit_of_work_rolls_back_as_a_unit(self):
+        with self.assertRaises(RuntimeError):
+            with unit_of_work():
+                actor = Actor(name='Rolled Back', gender='Male', age=30)
+                actor.insert()
+                with unit_of_work():
+                    Movie(title='Rolled Back', release_date=None).insert()
+                raise RuntimeError()
+
+        self.assertIsNone(
+            Actor.query.filter(Actor.name == 'Rolled Back').first())
+        self.assertIsNone(
+            Movie.query.filter(Movie.title == 'Rolled Back').first())
+
+    def test_model_methods_do_not_commit(self):
+        actor = Actor(name='Staged Only', gender='Female', age=30)
+        actor.insert()
+        self.assertTrue(actor.id)
+        db.session.rollback()
+
+        self.assertIsNone(
+            Actor.query.filter(Actor.name == 'Staged Only').first())
+
     # Run test for Role base casting director doesn't have permission to
     # delete movie
 
@@ -261,6 +1063,790 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    def add_bulk_actors(self, count):
+        with unit_of_work():
+            actors = [Actor(name='Bulk %d' % number, gender='Male',
+                            age=90 + number) for number in range(count)]
+            for actor in actors:
+                actor.insert()
+        return [actor.id for actor in actors]
+
+    def test_delete_actors_by_ids(self):
+        actor_ids = self.add_bulk_actors(3)
+        with count_queries(self.app) as statements:
+            res = self.client().delete(
+                '/actors', json={'ids': actor_ids[::-1] + [100000]},
+                headers=self.executive_producer_jwt)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 3)
+        self.assertEqual(data['ids'], actor_ids)
+        self.assertEqual(Actor.query.filter(
+            Actor.id.in_(actor_ids)).count(), 0)
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('DELETE')]), 1)
+        self.assertFalse(Resource_Version.query.filter(
+            Resource_Version.name.in_(['actors/%d' % actor_id
+                                       for actor_id in actor_ids])).count())
+
+    def test_delete_movies_by_filter(self):
+        with unit_of_work():
+            movies = [Movie(title='Zzbulk %d' % number, release_date=None)
+                      for number in range(2)]
+            for movie in movies:
+                movie.insert()
+        res = self.client().delete('/movies?title_prefix=zzBULK',
+                                   headers=self.executive_producer_jwt)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['ids'], [movie.id for movie in movies])
+        self.assertEqual(
+            Movie.query.filter(Movie.title.like('Zzbulk%')).count(), 0)
+
+    def test_422_for_bulk_delete_over_the_cap(self):
+        actor_ids = self.add_bulk_actors(3)
+        with mock.patch('app.BULK_DELETE_MAX_ROWS', 2):
+            res = self.client().delete('/actors?age_min=90',
+                                       headers=self.executive_producer_jwt)
+        remaining = Actor.query.filter(Actor.id.in_(actor_ids)).count()
+        self.client().delete('/actors', json={'ids': actor_ids},
+                             headers=self.executive_producer_jwt)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(remaining, 3)
+
+    def test_400_for_bulk_delete_of_too_many_ids(self):
+        with mock.patch('app.BULK_DELETE_MAX_ROWS', 2), \
+                count_queries(self.app) as statements:
+            res = self.client().delete('/actors', json={'ids': [1, 2, 3, 3]},
+                                       headers=self.executive_producer_jwt)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse([statement for statement in statements
+                          if 'actors' in statement])
+
+    def test_400_for_bulk_delete_without_selection(self):
+        for path, body in (('/actors', None), ('/actors', {'ids': []}),
+                           ('/actors?age_min=90', {'ids': [1]}),
+                           ('/actors?name=Bulk', None),
+                           ('/movies', {'ids': '1,2'}),
+                           ('/movies?release_date_from=soon', None)):
+            res = self.client().delete(path, json=body,
+                                       headers=self.executive_producer_jwt)
+            self.assertEqual(res.status_code, 400)
+
+    def test_bulk_delete_needs_delete_permission(self):
+        res = self.client().delete('/movies', json={'ids': [1]},
+                                   headers=self.casting_director_jwt)
+        self.assertEqual(res.status_code, 401)
+
+    def test_delete_actor_leaves_cast_to_the_database(self):
+        actor_id, movie_ids = self.add_filmography(3)
+        with count_queries(self.app) as statements:
+            res = self.client().delete(
+                'actors/%d' % actor_id, headers=self.executive_producer_jwt)
+        links = Movie_Actor.query.filter(
+            Movie_Actor.actor_id == actor_id).count()
+        with unit_of_work():
+            for movie_id in movie_ids:
+                Movie.delete_by_id(movie_id)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(links, 0)
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith('DELETE') and
+                          'movie_actor' in statement])
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('DELETE')]), 1)
+
+    # Run test to get the catalog statistics
+
+    def rebuilt_stats(self):
+        with unit_of_work():
+            rebuild_stats()
+        return read_stats()[0]
+
+    def test_get_stats(self):
+        self.rebuilt_stats()
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors']['total'], Actor.query.count())
+        self.assertEqual(sum(data['actors']['by_gender'].values()),
+                         data['actors']['total'])
+        self.assertEqual(sum(data['actors']['by_age'].values()),
+                         data['actors']['total'])
+        self.assertEqual(data['movies']['total'], Movie.query.count())
+        self.assertEqual(sum(data['movies']['by_release_year'].values()),
+                         data['movies']['total'])
+        self.assertEqual(data['cast']['links'], Movie_Actor.query.count())
+        self.assertTrue(data['rebuilt_at'])
+
+    def test_get_stats_reads_only_the_counters(self):
+        self.rebuilt_stats()
+        with count_queries(self.app) as statements:
+            res = self.client().get('/stats')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse([statement for statement in statements
+                          if 'actors' in statement or 'movies' in statement
+                          or 'movie_actor' in statement])
+
+    def test_get_stats_builds_missing_counters(self):
+        with unit_of_work():
+            db.session.execute(Catalog_Stat.__table__.delete())
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors']['total'], Actor.query.count())
+        self.assertTrue(data['rebuilt_at'])
+
+    def test_stats_follow_add_and_delete(self):
+        before = self.rebuilt_stats()
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=self.executive_producer_jwt)
+        actor_id = json.loads(res.data)['actors']['id']
+        added = read_stats()[0]
+        self.client().delete('/actors/%d' % actor_id,
+                             headers=self.executive_producer_jwt)
+        deleted = read_stats()[0]
+
+        self.assertEqual(added['actors']['total'],
+                         before['actors']['total'] + 1)
+        self.assertEqual(added['actors']['by_gender']['Male'],
+                         before['actors']['by_gender'].get('Male', 0) + 1)
+        self.assertEqual(added['actors']['by_age']['40-49'],
+                         before['actors']['by_age'].get('40-49', 0) + 1)
+        self.assertEqual(deleted, before)
+
+    def test_stats_follow_string_age(self):
+        before = self.rebuilt_stats()
+        res = self.client().post('/actors', json=dict(self.new_actor,
+                                                      age='46'),
+                                 headers=self.executive_producer_jwt)
+        actor_id = json.loads(res.data)['actors']['id']
+        patched = self.client().patch('/actors/%d' % actor_id,
+                                      json={'age': '57'},
+                                      headers=self.executive_producer_jwt)
+        updated = read_stats()[0]
+        invalid = self.client().post('/actors', json=dict(self.new_actor,
+                                                          age='old'),
+                                     headers=self.executive_producer_jwt)
+        self.client().delete('/actors/%d' % actor_id,
+                             headers=self.executive_producer_jwt)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(patched.status_code, 200)
+        self.assertEqual(json.loads(patched.data)['actors'][0]['age'], 57)
+        self.assertEqual(updated['actors']['by_age']['50-59'],
+                         before['actors']['by_age'].get('50-59', 0) + 1)
+        self.assertEqual(updated['actors']['by_age'].get('40-49', 0),
+                         before['actors']['by_age'].get('40-49', 0))
+        self.assertEqual(invalid.status_code, 422)
+
+    def test_stats_follow_update_and_cast(self):
+        actor_id, movie_ids = self.add_filmography(2)
+        before = self.rebuilt_stats()
+        res = self.client().patch(
+            '/movies/%d' % movie_ids[0],
+            json={'release_date': '1950-01-01', 'selected_actors': []},
+            headers=self.executive_producer_jwt)
+        patched = read_stats()[0]
+        recounted = self.rebuilt_stats()
+        self.remove_filmography(actor_id, movie_ids)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(patched['cast']['links'],
+                         before['cast']['links'] - 1)
+        self.assertEqual(patched['movies']['by_release_year']['1950'],
+                         before['movies']['by_release_year'].get(
+                             '1950', 0) + 1)
+        self.assertEqual(patched['actors'], recounted['actors'])
+        self.assertEqual(patched['movies'], recounted['movies'])
+        self.assertEqual(patched['cast'], recounted['cast'])
+
+    def test_stats_follow_bulk_delete(self):
+        actor_ids = self.add_bulk_actors(3)
+        before = self.rebuilt_stats()
+        with mock.patch('app.BULK_DELETE_MAX_ROWS', 2):
+            self.client().delete('/actors?age_min=90',
+                                 headers=self.executive_producer_jwt)
+        rolled_back = read_stats()[0]
+        self.client().delete('/actors', json={'ids': actor_ids},
+                             headers=self.executive_producer_jwt)
+        deleted = read_stats()[0]
+
+        self.assertEqual(rolled_back, before)
+        self.assertEqual(deleted['actors']['total'],
+                         before['actors']['total'] - 3)
+        self.assertNotIn('90-99', deleted['actors']['by_age'])
+
+    def test_rebuild_stats_corrects_drift(self):
+        self.rebuilt_stats()
+        # written without the handlers, the counters do not see it
+        with unit_of_work():
+            actor = Actor(name='Unstaged', gender='Other', age=101)
+            actor.insert()
+        drifted = read_stats()[0]
+        rebuilt = self.rebuilt_stats()
+        with unit_of_work():
+            Actor.delete_by_id(actor.id)
+        self.rebuilt_stats()
+
+        self.assertEqual(drifted['actors']['total'],
+                         rebuilt['actors']['total'] - 1)
+        self.assertEqual(rebuilt['actors']['by_gender']['Other'], 1)
+        self.assertEqual(rebuilt['actors']['by_age']['100-109'], 1)
+
+    def test_get_stats_schedules_rebuild(self):
+        self.rebuilt_stats()
+        with mock.patch('stats.STATS_REBUILD_INTERVAL', 0), \
+                mock.patch('stats.threading.Thread') as thread:
+            res = self.client().get('/stats')
+        stats._rebuilding.release()
+
+        self.assertEqual(res.status_code, 200)
+        thread.return_value.start.assert_called_once_with()
+
+    # Run test to read the internal statistics
+
+    def test_get_internal_stats(self):
+        res = self.client().get('/internal/stats',
+                                headers=self.executive_producer_jwt)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('response_cache', data)
+        self.assertEqual(data['replicas'], [])
+
+    def test_internal_stats_need_permission(self):
+        anonymous = self.client().get('/internal/stats')
+        director = self.client().get('/internal/stats',
+                                     headers=self.casting_director_jwt)
+
+        self.assertEqual(anonymous.status_code, 401)
+        self.assertEqual(director.status_code, 401)
+
+    # Run test to read request and SQL metrics
+
+    def test_metrics_for_actors(self):
+        self.client().get('/actors?limit=2')
+        res = self.client().get('/metrics')
+        text = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('capstone_http_request_duration_seconds_count'
+                      '{route="/actors",method="GET",status="200"}', text)
+        self.assertIn('capstone_sql_statements_total{route="/actors"}', text)
+        self.assertIn('capstone_http_response_bytes_total{route="/actors"}',
+                      text)
+
+    def test_metrics_count_streamed_bytes(self):
+        res = self.client().get('/actors?stream=true')
+        size = len(res.data)
+        text = self.client().get('/metrics').data.decode('utf-8')
+
+        self.assertIn('capstone_http_response_bytes_total{route="/actors"}',
+                      text)
+        sent = [line for line in text.splitlines() if line.startswith(
+            'capstone_http_response_bytes_total{route="/actors"}')]
+        self.assertTrue(int(sent[0].split()[-1]) >= size)
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        self.jwks_dir = tempfile.TemporaryDirectory()
+        self.jwks_path = os.path.join(self.jwks_dir.name, 'jwks.json')
+        self.private_pem, self.public_jwk = generate_signing_key('key-1')
+        write_jwks(self.jwks_path, self.public_jwk)
+        self.store = JWKSKeyStore('file://' + self.jwks_path,
+                                  min_refresh_interval=60)
+
+    def tearDown(self):
+        self.jwks_dir.cleanup()
+
+    # Run test to load keys once and serve them from memory
+
+    def test_key_loaded_once(self):
+        first = self.store.get_key('key-1')
+        second = self.store.get_key('key-1')
+        stats = self.store.stats()
+
+        self.assertIsNotNone(first)
+        self.assertIs(first, second)
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_parsed_key_verifies_signature(self):
+        token = jwt.encode({'sub': 'tester'}, self.private_pem,
+                           algorithm='RS256', headers={'kid': 'key-1'})
+        key = self.store.get_key('key-1')
+
+        self.assertIsNone(verify_signature(token, key, 'RS256'))
+        with self.assertRaises(jwt.JWTError):
+            verify_signature(token[:-4] + 'AAAA', key, 'RS256')
+
+    # Run test to refetch an unknown kid at most once per interval
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key('key-1')
+        self.store.min_refresh_interval = 0
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.store.min_refresh_interval = 60
+        self.assertIsNone(self.store.get_key('key-3'))
+        stats = self.store.stats()
+
+        self.assertEqual(stats['refreshes'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_unknown_kid_picks_up_rotated_key(self):
+        self.store.get_key('key-1')
+        _, rotated_jwk = generate_signing_key('key-2')
+        write_jwks(self.jwks_path, self.public_jwk, rotated_jwk)
+        self.store.min_refresh_interval = 0
+
+        self.assertIsNotNone(self.store.get_key('key-2'))
+
+    # Run test to keep serving stale keys while refresh fails
+
+    def test_stale_keys_served_when_refresh_fails(self):
+        self.store.get_key('key-1')
+        os.remove(self.jwks_path)
+
+        self.assertFalse(self.store.refresh())
+        self.assertIsNotNone(self.store.get_key('key-1'))
+        self.assertEqual(self.store.stats()['refresh_failures'], 1)
+
+    def test_background_refresh_after_ttl(self):
+        self.store.get_key('key-1')
+        self.store.ttl = 0
+        self.store.min_refresh_interval = 0
+        self.store.get_key('key-1')
+        for _ in range(50):
+            if self.store.stats()['refreshes'] == 2:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(self.store.stats()['refreshes'], 2)
+
+    def test_failed_background_refresh_is_rate_limited(self):
+        self.store.get_key('key-1')
+        os.remove(self.jwks_path)
+        self.store.ttl = 0
+        self.store.min_refresh_interval = 0
+        self.store.get_key('key-1')
+        for _ in range(50):
+            if self.store.stats()['refresh_failures'] == 1:
+                break
+            time.sleep(0.01)
+        self.store.min_refresh_interval = 60
+        for _ in range(20):
+            self.assertIsNotNone(self.store.get_key('key-1'))
+            time.sleep(0.01)
+
+        self.assertEqual(self.store.stats()['refresh_failures'], 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.payload = {
+            'sub': 'tester',
+            'exp': time.time() + 60,
+            'permissions': ['get:actors', 'post:actors']
+        }
+
+    # Run test to serve a verified token from the cache
+
+    def test_cached_token_returns_payload_and_permissions(self):
+        self.cache.put('token-1', self.payload)
+        payload, permissions = self.cache.get('token-1')
+
+        self.assertEqual(payload, self.payload)
+        self.assertEqual(permissions, {'get:actors', 'post:actors'})
+        self.assertTrue(check_permissions('post:actors', payload,
+                                          permissions))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_expired_token_not_served(self):
+        self.payload['exp'] = time.time() - 1
+        self.cache.put('token-1', self.payload)
+
+        self.assertIsNone(self.cache.get('token-1'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_token_without_exp_not_cached(self):
+        del self.payload['exp']
+        self.cache.put('token-1', self.payload)
+
+        self.assertIsNone(self.cache.get('token-1'))
+
+    # Run test to evict the least recently used token at the size cap
+
+    def test_size_cap_evicts_least_recently_used(self):
+        self.cache.put('token-1', self.payload)
+        self.cache.put('token-2', self.payload)
+        self.cache.get('token-1')
+        self.cache.put('token-3', self.payload)
+
+        self.assertIsNotNone(self.cache.get('token-1'))
+        self.assertIsNone(self.cache.get('token-2'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_disabled_cache_stores_nothing(self):
+        self.cache.enabled = False
+        payload, permissions = self.cache.put('token-1', self.payload)
+
+        self.assertEqual(permissions, {'get:actors', 'post:actors'})
+        self.assertIsNone(self.cache.get('token-1'))
+
+    def test_missing_permissions_still_rejected(self):
+        del self.payload['permissions']
+        payload, permissions = self.cache.put('token-1', self.payload)
+
+        with self.assertRaises(AuthError) as error:
+            check_permissions('post:actors', payload, permissions)
+        self.assertEqual(error.exception.status_code, 400)
+
+
+class FakeSharedStore:
+    """In-memory stand-in for the Redis client of SharedCacheBackend"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache backends test case"""
+
+    # Run test to evict least recently used and expired responses
+
+    def test_local_backend_evicts_least_recently_used(self):
+        cache = ResponseCache(LocalCacheBackend(maxsize=2, ttl=60))
+        cache.set('/actors', ['actors'], {'body': 'a'})
+        cache.set('/movies', ['movies'], {'body': 'm'})
+        cache.get('/actors', ['actors'])
+        cache.set('/', [], {'body': 'root'})
+
+        self.assertIsNotNone(cache.get('/actors', ['actors']))
+        self.assertIsNone(cache.get('/movies', ['movies']))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['hit_ratio'], 2 / 3)
+
+    def test_local_backend_expires_entries(self):
+        cache = ResponseCache(LocalCacheBackend(maxsize=2, ttl=0))
+        cache.set('/actors', ['actors'], {'body': 'a'})
+
+        self.assertIsNone(cache.get('/actors', ['actors']))
+
+    # Run test to invalidate only the responses of a written resource
+
+    def test_local_backend_invalidates_by_tag(self):
+        cache = ResponseCache(LocalCacheBackend(maxsize=10, ttl=60))
+        cache.set('/actors', ['actors'], {'body': 'a'})
+        cache.set('/movies', ['movies', 'actors'], {'body': 'm'})
+        cache.set('/', [], {'body': 'root'})
+        cache.invalidate({'movies'})
+
+        self.assertIsNotNone(cache.get('/actors', ['actors']))
+        self.assertIsNone(cache.get('/movies', ['movies', 'actors']))
+        self.assertIsNotNone(cache.get('/', []))
+
+    def test_shared_backend_invalidates_by_tag(self):
+        store = FakeSharedStore()
+        worker_a = ResponseCache(SharedCacheBackend(store))
+        worker_b = ResponseCache(SharedCacheBackend(store))
+        worker_a.set('/actors', ['actors'], {'body': 'a'})
+        worker_a.set('/movies', ['movies', 'actors'], {'body': 'm'})
+
+        self.assertEqual(worker_b.get('/actors', ['actors']), {'body': 'a'})
+        worker_b.invalidate({'actors'})
+        self.assertIsNone(worker_a.get('/actors', ['actors']))
+        self.assertIsNone(worker_a.get('/movies', ['movies', 'actors']))
+
+
+class DateFormatterTestCase(unittest.TestCase):
+    """This class represents the cached release date formatting test case"""
+
+    def setUp(self):
+        self.formatter = DateFormatter(RELEASE_DATE_FORMAT, maxsize=16)
+
+    # Run test to format dates exactly like babel and memoize them
+
+    def test_matches_babel_format_date(self):
+        start = datetime.date(1994, 12, 25)
+        for offset in range(0, 400, 7):
+            release_date = start + datetime.timedelta(days=offset)
+            self.assertEqual(
+                self.formatter.format(release_date),
+                format_date(release_date, RELEASE_DATE_FORMAT))
+
+    def test_formatted_dates_are_memoized(self):
+        release_date = datetime.date(1997, 12, 19)
+        self.formatter.format(release_date)
+        self.formatter.format(release_date)
+
+        self.assertEqual(self.formatter.cache_info().hits, 1)
+        self.assertEqual(self.formatter.format(release_date),
+                         'Friday, 19 December 1997')
+
+    def test_formats_requested_locale(self):
+        release_date = datetime.date(1997, 12, 19)
+
+        self.assertEqual(self.formatter.format(release_date, 'fr'),
+                         format_date(release_date, RELEASE_DATE_FORMAT,
+                                     'fr'))
+        self.assertEqual(self.formatter.format(release_date, 'de-DE'),
+                         format_date(release_date, RELEASE_DATE_FORMAT,
+                                     'de_DE'))
+
+    # Run test to pick the locale from Accept-Language
+
+    def test_request_locale_from_accept_language(self):
+        app = Flask(__name__)
+        supported = formatting.SUPPORTED_LOCALES
+        formatting.SUPPORTED_LOCALES = ['en-US', 'fr']
+        try:
+            headers = {'Accept-Language': 'fr-CH, fr;q=0.9, en;q=0.8'}
+            with app.test_request_context(headers=headers):
+                self.assertEqual(request_locale(), 'fr')
+            with app.test_request_context():
+                self.assertEqual(request_locale(), None)
+        finally:
+            formatting.SUPPORTED_LOCALES = supported
+
+
+class PoolStatsTestCase(unittest.TestCase):
+    """This class represents the connection pool instrumentation test case"""
+
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            'sqlite:///' + os.path.join(self.db_dir.name, 'pool.db'),
+            poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=0,
+            pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.db_dir.cleanup()
+
+    # Run test to count checkouts, timeouts and invalidations
+
+    def test_checkouts_are_counted(self):
+        with self.engine.connect() as connection:
+            connection.execute('SELECT 1')
+            stats = pool_stats(self.engine)
+            self.assertEqual(stats['checked_out'], 1)
+        stats = pool_stats(self.engine)
+
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['connects'], 1)
+
+    def test_checkout_timeout_is_counted(self):
+        with self.engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                self.engine.connect()
+
+        self.assertEqual(pool_stats(self.engine)['checkout_timeouts'], 1)
+
+    def test_invalidations_survive_pool_recreate(self):
+        connection = self.engine.connect()
+        connection.invalidate()
+        connection.close()
+        self.engine.dispose()
+        self.engine.connect().close()
+        stats = pool_stats(self.engine)
+
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+
+    def test_pool_settings_only_for_server_databases(self):
+        options = engine_options('postgresql://localhost/capstone')
+
+        self.assertEqual(options['poolclass'], InstrumentedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(engine_options('sqlite://'), {})
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    """This class represents the Prometheus metrics registry test case"""
+
+    def create_registry(self, directory=''):
+        registry = MetricsRegistry(directory=directory, flush_interval=60)
+        registry.counter('requests_total', 'Requests')
+        registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        return registry
+
+    # Run test to render counters and cumulative histogram buckets
+
+    def test_render_prometheus_text(self):
+        registry = self.create_registry()
+        registry.inc('requests_total', (('route', '/actors'),))
+        registry.inc('requests_total', (('route', '/actors'),))
+        registry.observe('latency_seconds', (('route', '/'),), 0.05)
+        registry.observe('latency_seconds', (('route', '/'),), 0.5)
+        registry.observe('latency_seconds', (('route', '/'),), 5)
+        lines = registry.render().splitlines()
+
+        self.assertIn('# TYPE requests_total counter', lines)
+        self.assertIn('requests_total{route="/actors"} 2', lines)
+        self.assertIn('# TYPE latency_seconds histogram', lines)
+        self.assertIn('latency_seconds_bucket{route="/",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{route="/",le="1.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{route="/",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_sum{route="/"} 5.55', lines)
+        self.assertIn('latency_seconds_count{route="/"} 3', lines)
+
+    def test_label_values_are_escaped(self):
+        registry = self.create_registry()
+        registry.inc('requests_total', (('route', 'a"b\\c'),))
+
+        self.assertIn('requests_total{route="a\\"b\\\\c"} 1',
+                      registry.render())
+
+    def test_workers_are_summed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # another worker's flushed metrics
+            other = self.create_registry()
+            other.inc('requests_total', (('route', '/'),), 3)
+            other.observe('latency_seconds', (('route', '/'),), 0.5)
+            with open(os.path.join(directory, 'metrics_1.json'), 'w') as f:
+                json.dump(other.samples(), f)
+
+            registry = self.create_registry(directory)
+            registry.inc('requests_total', (('route', '/'),))
+            registry.observe('latency_seconds', (('route', '/'),), 0.05)
+            lines = registry.render().splitlines()
+
+        self.assertIn('requests_total{route="/"} 4', lines)
+        self.assertIn('latency_seconds_bucket{route="/",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_count{route="/"} 2', lines)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        # two SQLite files stand in for a primary and its replica
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.primary_url = 'sqlite:///' + os.path.join(
+            self.db_dir.name, 'primary.db')
+        self.replica_url = 'sqlite:///' + os.path.join(
+            self.db_dir.name, 'replica.db')
+        self.replica = create_engine(self.replica_url)
+        db.Model.metadata.create_all(self.replica)
+        self.replica.execute(Actor.__table__.insert(), name='On Replica')
+
+        db.session.remove()
+        self.app = create_app()
+        setup_db(self.app, self.primary_url, [self.replica_url])
+        with self.app.app_context():
+            db.create_all()
+            with unit_of_work():
+                Actor(name='On Primary', gender=None, age=None).insert()
+        self.client = self.app.test_client
+        response_cache.enabled = False
+
+    def tearDown(self):
+        response_cache.enabled = True
+        with self.app.app_context():
+            db.get_engine().dispose()
+        self.app.extensions['replicas'].dispose()
+        self.replica.dispose()
+        db.session.remove()
+        self.db_dir.cleanup()
+
+    def actor_names(self, method='GET'):
+        with self.app.test_request_context('/actors', method=method):
+            return [actor.name for actor in Actor.query.order_by(Actor.id)]
+
+    # Run test to route reads to the replica and writes to the primary
+
+    def test_get_reads_from_replica(self):
+        res = self.client().get('/actors?all=true')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['On Replica'])
+
+    def test_response_cached_from_lagging_replica_is_refreshed(self):
+        response_cache.enabled = True
+        response_cache.clear()
+        self.client().get('/actors?all=true')
+        with self.app.test_request_context('/actors', method='POST'):
+            with unit_of_work():
+                bump_versions('actors')
+                Actor(name='Written', gender=None, age=None).insert()
+        # the replica has not replayed the write yet
+        lagging = json.loads(self.client().get('/actors?all=true').data)
+        self.replica.execute(Actor.__table__.insert(), name='Written')
+        self.replica.execute(Resource_Version.__table__.insert(),
+                             name='actors', version=1,
+                             updated_at=datetime.datetime.utcnow())
+        replayed = json.loads(self.client().get('/actors?all=true').data)
+
+        self.assertEqual([actor['name'] for actor in lagging['actors']],
+                         ['On Replica'])
+        self.assertEqual([actor['name'] for actor in replayed['actors']],
+                         ['On Replica', 'Written'])
+
+    def test_other_methods_read_from_primary(self):
+        self.assertEqual(self.actor_names('POST'), ['On Primary'])
+        self.assertEqual(self.actor_names('GET'), ['On Replica'])
+
+    def test_reads_after_a_write_stay_on_primary(self):
+        with self.app.test_request_context('/actors', method='GET'):
+            with unit_of_work():
+                Actor(name='Written', gender=None, age=None).insert()
+            names = [actor.name for actor in Actor.query.order_by(Actor.id)]
+
+        self.assertEqual(names, ['On Primary', 'Written'])
+
+    def test_fallback_to_primary_when_replica_fails(self):
+        setup_db(self.app, self.primary_url,
+                 ['sqlite:///' + os.path.join(self.db_dir.name, 'missing',
+                                              'replica.db')])
+        names = self.actor_names()
+        stats = self.app.extensions['replicas'].stats()
+
+        self.assertEqual(names, ['On Primary'])
+        self.assertFalse(stats[0]['healthy'])
+        self.assertTrue(stats[0]['error'])
+
+    def test_fallback_to_primary_when_replica_lags(self):
+        replicas = self.app.extensions['replicas']
+        replicas.max_lag = -1
+
+        self.assertEqual(self.actor_names(), ['On Primary'])
+        self.assertEqual(replicas.stats()[0]['lag_seconds'], 0)
+        replicas.max_lag = 5
+        replicas.check_interval = 0
+        self.assertEqual(self.actor_names(), ['On Replica'])
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,381 @@
+import os
+import io
+import csv
+import json
+import queue
+import datetime
+import threading
+from itertools import islice
+
+from sqlalchemy import select
+
+from models import db, Actor, Movie, Movie_Actor, bump_versions
+
+TRANSFER_FORMATS = ('csv', 'ndjson')
+# rows per batch when the database has no COPY (SQLite)
+TRANSFER_BATCH_SIZE = int(os.environ.get('TRANSFER_BATCH_SIZE', 5000))
+# COPY output chunks buffered between the database and a slow client
+TRANSFER_QUEUE_SIZE = int(os.environ.get('TRANSFER_QUEUE_SIZE', 64))
+
+'''
+Catalog Transfer
+    actors, movies and movie_actor are exported and imported as CSV (with a
+    header line) or NDJSON, one table per file, with PostgreSQL COPY
+
+    export runs COPY ... TO STDOUT and hands its output on chunk by chunk.
+    import runs COPY ... FROM STDIN into a temporary staging table, checks
+    that cast links point at existing actors and movies, and upserts the
+    staged rows by id (cast links by movie_id and actor_id). Neither
+    direction holds more than a chunk of the data in memory.
+
+    Tables are listed parents first: import actors and movies before the
+    movie_actor links that reference them.
+'''
+
+TRANSFER_TABLES = {
+    'actors': Actor.__table__,
+    'movies': Movie.__table__,
+    'movie_actor': Movie_Actor.__table__
+}
+# resources whose cached responses an import changes
+TRANSFER_RESOURCES = {
+    'actors': ('actors', 'movies'),
+    'movies': ('movies',),
+    'movie_actor': ('movies',)
+}
+
+# NDJSON goes through COPY's csv format with a quote and delimiter that
+# never occur in row_to_json output, so each line is passed on unescaped
+NDJSON_COPY_OPTIONS = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
+
+
+def _columns(name):
+    return [column.name for column in TRANSFER_TABLES[name].columns]
+
+
+def _check(name, fmt):
+    if name not in TRANSFER_TABLES:
+        raise ValueError('Unknown table %s.' % name)
+    if fmt not in TRANSFER_FORMATS:
+        raise ValueError('Unknown format %s.' % fmt)
+
+
+def _copy_out_sql(name, fmt):
+    columns = ', '.join(_columns(name))
+    if fmt == 'csv':
+        return 'COPY %s (%s) TO STDOUT WITH (FORMAT csv, HEADER true)' % (
+            name, columns)
+    return ('COPY (SELECT row_to_json(r) FROM (SELECT %s FROM %s) r) '
+            'TO STDOUT WITH (%s)' % (columns, name, NDJSON_COPY_OPTIONS))
+
+
+'''
+export_table(name, fmt)
+    generator of the bytes of one table, for a streamed response
+
+    on PostgreSQL a background thread runs COPY on its own connection and
+    passes chunks through a bounded queue; the COPY is cancelled when the
+    generator is closed early. Other databases are read in batches through
+    a server-side cursor.
+'''
+
+
+def export_table(name, fmt):
+    _check(name, fmt)
+    engine = db.engine
+    if engine.dialect.name == 'postgresql':
+        return _copy_out(engine, _copy_out_sql(name, fmt))
+    return _select_out(engine, name, fmt)
+
+
+'''
+export_tables(directory, fmt)
+    writes every table to <directory>/<table>.<fmt> from one REPEATABLE READ
+    snapshot, so the exported links only reference exported rows, and
+    returns the file paths
+'''
+
+
+def export_tables(directory, fmt):
+    _check('actors', fmt)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    engine = db.engine
+    postgresql = engine.dialect.name == 'postgresql'
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if postgresql:
+            # the pool's pre-ping has already begun a transaction, and
+            # SET TRANSACTION must come before any query of the one it sets
+            connection.rollback()
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, '
+                           'READ ONLY')
+        for name in TRANSFER_TABLES:
+            path = os.path.join(directory, '%s.%s' % (name, fmt))
+            with open(path, 'wb') as output:
+                if postgresql:
+                    cursor.copy_expert(_copy_out_sql(name, fmt), output)
+                else:
+                    for chunk in _select_out(engine, name, fmt):
+                        output.write(chunk)
+            paths.append(path)
+        connection.rollback()
+    finally:
+        connection.close()
+    return paths
+
+
+class _QueueWriter:
+    '''file-like target of copy_expert that feeds a bounded queue'''
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+
+    def write(self, data):
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(data, timeout=0.1)
+                return len(data)
+            except queue.Full:
+                continue
+        # makes copy_expert abort the COPY
+        raise IOError('Export cancelled.')
+
+
+def _copy_out(engine, sql):
+    chunks = queue.Queue(TRANSFER_QUEUE_SIZE)
+    cancelled = threading.Event()
+    failures = []
+    done = object()
+
+    def run():
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert(sql, _QueueWriter(chunks, cancelled))
+            connection.rollback()
+        except Exception as error:
+            failures.append(error)
+        finally:
+            connection.close()
+            # the reader may be gone already
+            while not cancelled.is_set():
+                try:
+                    chunks.put(done, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        cancelled.set()
+    if failures:
+        raise failures[0]
+
+
+def _select_out(engine, name, fmt):
+    table = TRANSFER_TABLES[name]
+    columns = _columns(name)
+    with engine.connect() as connection:
+        rows = iter(connection.execution_options(stream_results=True)
+                    .execute(select([table]).order_by(table.c.id)))
+        if fmt == 'csv':
+            yield _csv_line(columns)
+        while True:
+            batch = list(islice(rows, TRANSFER_BATCH_SIZE))
+            if not batch:
+                break
+            if fmt == 'csv':
+                yield b''.join(_csv_line(row) for row in batch)
+            else:
+                yield b''.join(_json_line(columns, row) for row in batch)
+
+
+def _csv_line(values):
+    line = io.StringIO()
+    csv.writer(line, lineterminator='\n').writerow(
+        value.isoformat() if isinstance(value, datetime.date) else value
+        for value in values)
+    return line.getvalue().encode('utf-8')
+
+
+def _json_line(columns, row):
+    record = {column: value.isoformat()
+              if isinstance(value, datetime.date) else value
+              for column, value in zip(columns, row)}
+    return (json.dumps(record, separators=(',', ':'), ensure_ascii=False) +
+            '\n').encode('utf-8')
+
+
+'''
+import_table(name, fmt, stream)
+    loads a binary stream of one table in the current transaction and
+    returns {'table', 'rows'} with the number of rows read
+
+    raises ValueError for malformed data and for cast links to actors or
+    movies that do not exist; the caller commits or rolls back
+'''
+
+
+def import_table(name, fmt, stream):
+    _check(name, fmt)
+    bump_versions(*TRANSFER_RESOURCES[name])
+    if db.session.get_bind().dialect.name == 'postgresql':
+        rows = _copy_in(name, fmt, stream)
+    else:
+        rows = _batch_in(name, fmt, stream)
+    return {'table': name, 'rows': rows}
+
+
+def _copy_in(name, fmt, stream):
+    columns = ', '.join(_columns(name))
+    staging = 'transfer_%s' % name
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('CREATE TEMP TABLE %s (LIKE %s) ON COMMIT DROP' % (
+        staging, name))
+
+    if fmt == 'csv':
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN WITH (FORMAT csv, HEADER true)' % (
+                staging, columns), stream)
+    else:
+        cursor.execute('CREATE TEMP TABLE transfer_documents (doc json) '
+                       'ON COMMIT DROP')
+        cursor.copy_expert('COPY transfer_documents FROM STDIN WITH (%s)' %
+                           NDJSON_COPY_OPTIONS, stream)
+        cursor.execute(
+            'INSERT INTO %s (%s) SELECT %s FROM transfer_documents, '
+            'json_populate_record(NULL::%s, doc) r' % (
+                staging, columns,
+                ', '.join('r.' + column for column in _columns(name)),
+                staging))
+        cursor.execute('DROP TABLE transfer_documents')
+    cursor.execute('SELECT count(*) FROM %s' % staging)
+    rows = cursor.fetchone()[0]
+
+    if name == 'movie_actor':
+        cursor.execute(
+            'SELECT count(*) FROM %s s WHERE NOT EXISTS ('
+            'SELECT 1 FROM actors a WHERE a.id = s.actor_id) '
+            'OR NOT EXISTS (SELECT 1 FROM movies m WHERE m.id = s.movie_id)'
+            % staging)
+        orphans = cursor.fetchone()[0]
+        if orphans:
+            raise ValueError('%d cast links reference missing actors or '
+                             'movies.' % orphans)
+        # link ids are not kept, a link is its (movie_id, actor_id) pair
+        cursor.execute(
+            'INSERT INTO movie_actor (movie_id, actor_id) '
+            'SELECT DISTINCT movie_id, actor_id FROM %s '
+            'ON CONFLICT (movie_id, actor_id) DO NOTHING' % staging)
+        return rows
+
+    updates = ', '.join('%s = EXCLUDED.%s' % (column, column)
+                        for column in _columns(name) if column != 'id')
+    cursor.execute(
+        'INSERT INTO %s (%s) SELECT DISTINCT ON (id) %s FROM %s ORDER BY id '
+        'ON CONFLICT (id) DO UPDATE SET %s' % (
+            name, columns, columns, staging, updates))
+    # new rows came with their ids, move the sequence past them
+    cursor.execute(
+        "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+        "COALESCE((SELECT max(id) FROM %s), 0) + 1, false)" % (name, name))
+    return rows
+
+
+def _batch_in(name, fmt, stream):
+    table = TRANSFER_TABLES[name]
+    columns = _columns(name)
+    records = _read_records(columns, fmt, stream)
+    rows = 0
+    while True:
+        batch = [_typed(table, record)
+                 for record in islice(records, TRANSFER_BATCH_SIZE)]
+        if not batch:
+            break
+        rows += len(batch)
+        if name == 'movie_actor':
+            _insert_links(batch)
+        else:
+            _upsert_rows(table, batch)
+    return rows
+
+
+def _read_records(columns, fmt, stream):
+    lines = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if fmt == 'csv':
+        reader = csv.reader(lines)
+        next(reader, None)
+        for values in reader:
+            if len(values) != len(columns):
+                raise ValueError('Expected %d columns.' % len(columns))
+            yield dict(zip(columns, [value or None for value in values]))
+        return
+    for line in lines:
+        if line.strip():
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Expected a JSON object.')
+            yield record
+
+
+def _typed(table, record):
+    row = {}
+    for column in table.columns:
+        value = record.get(column.name)
+        if value is not None:
+            if column.type.python_type is int:
+                value = int(value)
+            elif column.type.python_type is datetime.date:
+                value = datetime.date.fromisoformat(value)
+        row[column.name] = value
+    if row['id'] is None:
+        raise ValueError('id is required.')
+    return row
+
+
+def _upsert_rows(table, batch):
+    batch = list({row['id']: row for row in batch}.values())
+    existing = {row.id for row in db.session.execute(
+        select([table.c.id]).where(table.c.id.in_([row['id']
+                                                   for row in batch])))}
+    for row in batch:
+        if row['id'] in existing:
+            db.session.execute(table.update().where(
+                table.c.id == row['id']).values(row))
+    new = [row for row in batch if row['id'] not in existing]
+    if new:
+        db.session.execute(table.insert(), new)
+
+
+def _insert_links(batch):
+    actor_ids = {row['actor_id'] for row in batch}
+    movie_ids = {row['movie_id'] for row in batch}
+    actors, movies = Actor.__table__, Movie.__table__
+    found_actors = {row.id for row in db.session.execute(
+        select([actors.c.id]).where(actors.c.id.in_(actor_ids)))}
+    found_movies = {row.id for row in db.session.execute(
+        select([movies.c.id]).where(movies.c.id.in_(movie_ids)))}
+    orphans = [row for row in batch if row['actor_id'] not in found_actors or
+               row['movie_id'] not in found_movies]
+    if orphans:
+        raise ValueError('%d cast links reference missing actors or '
+                         'movies.' % len(orphans))
+
+    links = Movie_Actor.__table__
+    pairs = {(row['movie_id'], row['actor_id']) for row in batch}
+    existing = {(row.movie_id, row.actor_id) for row in db.session.execute(
+        select([links.c.movie_id, links.c.actor_id]).where(
+            links.c.movie_id.in_({movie_id for movie_id, _ in pairs})))}
+    new = [{'movie_id': movie_id, 'actor_id': actor_id}
+           for movie_id, actor_id in sorted(pairs - existing)]
+    if new:
+        db.session.execute(links.insert(), new)